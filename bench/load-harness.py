@@ -0,0 +1,634 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ネットワークにつながっていないマシン1台で polo2mqtt / poloprivate2mqtt / xmr-wallet2mqtt に負荷をかけて測る。
+#
+# 外部のサービスは全てこのプロセスの中の偽物に置き換える:
+#   - Poloniex の public/private WebSocket (subscribe / candles_minute_10 / auth / account)
+#   - Poloniex のローソク足の REST API、Monero ウォレットの JSON-RPC、p2pool の stratum の状態
+#   - MQTTブローカー(MQTT 3.1.1 と 5 の PUBLISH と購読だけを扱う最小限のもの。--external-broker で既存のものを使う)
+#
+# ブリッジはそれぞれ別のプロセスとして起動し、偽のサーバーから指定したレートでメッセージを送る。
+# 送った時刻からブリッジの画像がブローカーに届くまでを遅延とし、スループット、遅延のパーセンタイル、
+# CPU使用率、RSSを報告する。入力の ts にはそれぞれ異なる時刻を入れ、ブリッジがそれを MQTT v5 の
+# event-ts として付けて返すので、どの入力の出力かを突き合わせられる(時刻の付かない xmr-wallet は、
+# それまでに送った最新の入力の出力とみなす)。出力されずに新しい入力にまとめられた入力は coalesced として数える。
+#
+#   bench/load-harness.py --rate 20 --duration 30 --json result.json
+#
+# ブリッジはMQTTの既定のポート(1883)に接続するので、組み込みのブローカーはそのポートで待ち受ける。
+import os,sys,json,time,base64,hashlib,struct,random,logging,threading,argparse,tempfile,subprocess,collections
+import socketserver,http.server
+import paho.mqtt.client as mqtt_client # dev-python/paho-mqtt
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import framepacer,mqttpublisher
+
+MQTT_PORT = 1883
+BRIDGES = {
+    # name -> (script, 画像が届くトピック)
+    "polo": ("polo2mqtt.py", "poloniex/xmrusdt"),
+    "poloprivate": ("poloprivate2mqtt.py", "poloniex/balance"),
+    "xmr-wallet": ("xmr-wallet2mqtt.py", "xmr/balance"),
+}
+DEFAULT_RATE = 10.0
+DEFAULT_DURATION = 30.0
+DEFAULT_WARMUP = 5.0
+SAMPLE_INTERVAL = 0.5
+
+# ---------------------------------------------------------------------------
+# 計測
+
+class Metrics:
+    """1つのブリッジについて、入力を送った時刻とブリッジの出力が届いた時刻を対応させる"""
+    def __init__(self, name, topic):
+        self.name = name
+        self.topic = topic
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict() # まだ出力が届いていない入力: ts -> 送った時刻。ts の順
+        self.last_key = 0
+        self.sent = [] # 入力を送った時刻
+        self.samples = [] # (入力の時刻, 遅延)
+        self.received = [] # 出力が届いた時刻
+        self.unmatched = 0 # 対応する入力のない出力(起動時の出力など)
+        self.coalesced = 0 # 出力されずに後の入力にまとめられた入力
+
+    def on_sent(self):
+        """入力を送る直前に呼び、その入力の ts に入れる時刻(ミリ秒、入力ごとに異なる)を返す"""
+        now = time.monotonic()
+        with self.lock:
+            key = self.last_key = max(int(time.time() * 1000), self.last_key + 1)
+            self.pending[key] = now
+            self.sent.append(now)
+        return key
+
+    def on_received(self, key=None):
+        """key は出力に付いていた event-ts。なければそれまでに送った最新の入力の出力とみなす"""
+        now = time.monotonic()
+        with self.lock:
+            self.received.append(now)
+            if key is None:
+                key = next(reversed(self.pending), None)
+            if key not in self.pending:
+                self.unmatched += 1
+                return
+            #else
+            # それより前に送った入力は、この出力にまとめられた
+            while True:
+                pending_key, sent = self.pending.popitem(last=False)
+                if pending_key == key: break
+                #else
+                self.coalesced += 1
+            self.samples.append((sent, now - sent))
+
+    def report(self, start, end):
+        with self.lock:
+            sent = sum(1 for t in self.sent if start <= t < end)
+            received = sum(1 for t in self.received if start <= t < end)
+            latencies = sorted(latency for t, latency in self.samples if start <= t < end)
+            backlog = len(self.pending)
+        def percentile(p):
+            if not latencies: return None
+            #else
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+        duration = end - start
+        return {
+            "sent": sent,
+            "received": received,
+            "input_rate": sent / duration,
+            "throughput": received / duration,
+            "latency_ms": {
+                "p50": percentile(0.5),
+                "p90": percentile(0.9),
+                "p99": percentile(0.99),
+                "max": latencies[-1] * 1000 if latencies else None,
+            },
+            "backlog": backlog,
+            "unmatched": self.unmatched,
+            "coalesced": self.coalesced,
+        }
+
+class ProcessSampler(threading.Thread):
+    """子プロセスのCPU時間とRSSを /proc から定期的に読む"""
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.samples = [] # (time, cpu_seconds, rss_bytes)
+        self.running = True
+
+    def read(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{self.pid}/statm") as f:
+            rss = int(f.read().split()[1]) * self.PAGE_SIZE
+        return (int(fields[11]) + int(fields[12])) / self.CLOCK_TICKS, rss
+
+    def run(self):
+        while self.running:
+            try:
+                cpu, rss = self.read()
+            except (OSError, IndexError, ValueError):
+                break
+            self.samples.append((time.monotonic(), cpu, rss))
+            time.sleep(SAMPLE_INTERVAL)
+
+    def report(self, start, end):
+        samples = [sample for sample in self.samples if start <= sample[0] <= end]
+        if len(samples) < 2: return {"cpu_percent": None, "rss_mb": None, "peak_rss_mb": None}
+        #else
+        (t0, cpu0, _), (t1, cpu1, rss1) = samples[0], samples[-1]
+        return {
+            "cpu_percent": (cpu1 - cpu0) / (t1 - t0) * 100,
+            "rss_mb": rss1 / 1024 / 1024,
+            "peak_rss_mb": max(rss for _, _, rss in samples) / 1024 / 1024,
+        }
+
+# ---------------------------------------------------------------------------
+# MQTTブローカー(MQTT 3.1.1 と 5 の最小限のサブセット)
+
+def topic_matches(pattern, topic):
+    pattern_levels, topic_levels = pattern.split("/"), topic.split("/")
+    for i, level in enumerate(pattern_levels):
+        if level == "#": return True
+        if i >= len(topic_levels): return False
+        if level != "+" and level != topic_levels[i]: return False
+    return len(pattern_levels) == len(topic_levels)
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length > 0 else 0))
+        if length == 0: return bytes(encoded)
+
+def decode_length(data, position):
+    """data[position:] の可変長整数を読み、(値, 次の位置) を返す"""
+    length, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        length |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80: return length, position
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.subscriptions = set()
+        self.write_lock = threading.Lock()
+        self.rfile = self.request.makefile("rb")
+        self.mqtt5 = False
+
+    def send_packet(self, header, body=b""):
+        with self.write_lock:
+            self.request.sendall(bytes([header]) + encode_length(len(body)) + body)
+
+    def send_publish(self, topic, payload, properties=b"\x00"):
+        """properties は MQTT 5 のプロパティ(長さを含む)。3.1.1 のクライアントには送らない"""
+        encoded = topic.encode("utf-8")
+        self.send_packet(0x30, struct.pack(">H", len(encoded)) + encoded + (properties if self.mqtt5 else b"") + payload)
+
+    def read_packet(self):
+        header = self.rfile.read(1)
+        if not header: return None, None
+        #else
+        length, shift = 0, 0
+        while True:
+            byte = self.rfile.read(1)[0]
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80: break
+        return header[0], self.rfile.read(length)
+
+    def skip_properties(self, body, position):
+        """MQTT 5 ならプロパティを読み飛ばし、(プロパティ, 次の位置) を返す"""
+        if not self.mqtt5: return b"\x00", position
+        #else
+        length, start = decode_length(body, position)
+        return body[position:start + length], start + length
+
+    def handle(self):
+        broker = self.server
+        try:
+            while True:
+                header, body = self.read_packet()
+                if header is None: break
+                #else
+                packet_type, flags = header >> 4, header & 0x0f
+                if packet_type == 1: # CONNECT
+                    self.mqtt5 = body[6] == 5 # "MQTT" の後のプロトコルレベル
+                    self.send_packet(0x20, b"\x00\x00\x00" if self.mqtt5 else b"\x00\x00")
+                    with broker.lock:
+                        broker.sessions.add(self)
+                elif packet_type == 3: # PUBLISH
+                    qos, retain = (flags >> 1) & 3, flags & 1
+                    topic_length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode("utf-8")
+                    position = 2 + topic_length
+                    if qos > 0:
+                        packet_id = body[position:position + 2]
+                        position += 2
+                        self.send_packet(0x40 if qos == 1 else 0x50, packet_id) # PUBACK / PUBREC
+                    properties, position = self.skip_properties(body, position)
+                    broker.route(topic, body[position:], retain, properties)
+                elif packet_type == 6: # PUBREL
+                    self.send_packet(0x70, body[:2]) # PUBCOMP
+                elif packet_type == 8: # SUBSCRIBE
+                    packet_id = body[:2]
+                    _, position = self.skip_properties(body, 2)
+                    granted = bytearray()
+                    while position < len(body):
+                        topic_length = struct.unpack(">H", body[position:position + 2])[0]
+                        pattern = body[position + 2:position + 2 + topic_length].decode("utf-8")
+                        position += 2 + topic_length + 1
+                        self.subscriptions.add(pattern)
+                        granted.append(0) # 配信は全て QoS 0 で行う
+                    self.send_packet(0x90, packet_id + (b"\x00" if self.mqtt5 else b"") + bytes(granted))
+                    for topic, payload, properties in broker.retained_for(self.subscriptions):
+                        self.send_publish(topic, payload, properties)
+                elif packet_type == 10: # UNSUBSCRIBE
+                    _, position = self.skip_properties(body, 2)
+                    count = 0
+                    while position < len(body):
+                        topic_length = struct.unpack(">H", body[position:position + 2])[0]
+                        self.subscriptions.discard(body[position + 2:position + 2 + topic_length].decode("utf-8"))
+                        position += 2 + topic_length
+                        count += 1
+                    self.send_packet(0xb0, body[:2] + (b"\x00" + b"\x00" * count if self.mqtt5 else b""))
+                elif packet_type == 12: # PINGREQ
+                    self.send_packet(0xd0)
+                elif packet_type == 14: # DISCONNECT
+                    break
+        except (OSError, IndexError):
+            pass
+
+    def finish(self):
+        with self.server.lock:
+            self.server.sessions.discard(self)
+
+class MiniBroker(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, BrokerHandler)
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.retained = {}
+
+    def route(self, topic, payload, retain, properties=b"\x00"):
+        with self.lock:
+            if retain:
+                if payload: self.retained[topic] = (payload, properties)
+                else: self.retained.pop(topic, None)
+            targets = [session for session in self.sessions if any(topic_matches(pattern, topic) for pattern in session.subscriptions)]
+        for session in targets:
+            try:
+                session.send_publish(topic, payload, properties)
+            except OSError:
+                pass
+
+    def retained_for(self, patterns):
+        with self.lock:
+            return [(topic, payload, properties) for topic, (payload, properties) in self.retained.items() if any(topic_matches(pattern, topic) for pattern in patterns)]
+
+# ---------------------------------------------------------------------------
+# WebSocketサーバー(テキストフレームだけ)
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+class WebSocketHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        path = self.rfile.readline().decode("latin-1").split()[1]
+        headers = {}
+        while True:
+            line = self.rfile.readline().decode("latin-1").strip()
+            if not line: break
+            #else
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        self.write_lock = threading.Lock()
+        self.closed = False
+        app = self.server.apps[path](self)
+        try:
+            while True:
+                opcode, payload = self.read_frame()
+                if opcode is None or opcode == 0x8: break
+                #else
+                if opcode == 0x9:
+                    self.send_frame(0xa, payload)
+                elif opcode == 0x1:
+                    app.on_message(payload.decode("utf-8"))
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            app.on_close()
+
+    def read_frame(self):
+        header = self.rfile.read(2)
+        if len(header) < 2: return None, None
+        #else
+        opcode, length = header[0] & 0x0f, header[1] & 0x7f
+        if length == 126:
+            length = struct.unpack(">H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if header[1] & 0x80 else None
+        payload = self.rfile.read(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    def send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, length])
+        elif length < 65536:
+            header = bytes([0x80 | opcode, 126]) + struct.pack(">H", length)
+        else:
+            header = bytes([0x80 | opcode, 127]) + struct.pack(">Q", length)
+        with self.write_lock:
+            self.wfile.write(header + payload)
+
+    def send(self, message):
+        self.send_frame(0x1, json.dumps(message).encode("utf-8"))
+
+class WebSocketServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, apps):
+        super().__init__(address, WebSocketHandler)
+        self.apps = apps # path -> factory(connection)
+
+class Feeder(threading.Thread):
+    """接続が閉じるか止められるまで、rate 回/秒 make_message() を送る"""
+    def __init__(self, connection, rate, make_message, metrics, stop):
+        super().__init__(daemon=True)
+        self.connection = connection
+        self.pacer = framepacer.FramePacer(1.0 / rate, framepacer.SKIP, name=f"{metrics.name} feed")
+        self.make_message = make_message
+        self.metrics = metrics
+        self.stop = stop
+
+    def run(self):
+        while not self.stop.is_set() and not self.connection.closed:
+            self.pacer.wait()
+            # 出力が先に届いても突き合わせられるよう、送る前に記録する
+            key = self.metrics.on_sent()
+            try:
+                self.connection.send(self.make_message(key))
+            except OSError:
+                break
+
+class FakePoloniexPublic:
+    def __init__(self, connection, harness):
+        self.connection = connection
+        self.harness = harness
+        self.price = 150.0
+        self.start_time = int(time.time() // 600 * 600 * 1000)
+        self.count = 0
+
+    def candle(self, ts):
+        self.price = max(1.0, self.price + random.gauss(0, 0.2))
+        self.count += 1
+        if self.count % 50 == 0: self.start_time += 600 * 1000 # 時々新しい足にする
+        return {"channel": "candles_minute_10", "data": [{"symbol": "XMR_USDT", "startTime": self.start_time, "close": f"{self.price:.2f}", "ts": ts}]}
+
+    def on_message(self, text):
+        message = json.loads(text)
+        if message.get("event") == "ping":
+            self.connection.send({"event": "pong"})
+        elif message.get("event") == "subscribe":
+            self.connection.send({"event": "subscribe", "channel": "candles_minute_10", "symbols": message.get("symbols", [])})
+            self.harness.start_feed("polo", self.connection, self.candle)
+
+    def on_close(self):
+        pass
+
+class FakePoloniexPrivate:
+    def __init__(self, connection, harness):
+        self.connection = connection
+        self.harness = harness
+        self.eq = 1000.0
+
+    def account(self, ts):
+        self.eq += random.gauss(0, 1)
+        return {"channel": "account", "data": [{"eq": f"{self.eq:.4f}", "upl": f"{self.eq - 1000:.4f}", "ts": ts}]}
+
+    def on_message(self, text):
+        message = json.loads(text)
+        if message.get("event") != "subscribe": return
+        #else
+        channels = message.get("channel", [])
+        if "auth" in channels:
+            self.connection.send({"channel": "auth", "data": {"success": True, "ts": int(time.time() * 1000)}})
+        elif "account" in channels:
+            for channel in channels:
+                self.connection.send({"event": "subscribe", "channel": channel})
+            self.harness.start_feed("poloprivate", self.connection, self.account)
+
+    def on_close(self):
+        pass
+
+# ---------------------------------------------------------------------------
+# HTTP(ローソク足、ウォレットのJSON-RPC、p2pool)
+
+class FakeHttpHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/candles"):
+            now = int(time.time() // 600 * 600 * 1000)
+            price = 150.0
+            candles = []
+            for i in range(144):
+                price += random.gauss(0, 0.5)
+                candles.append([now - (143 - i) * 600 * 1000, f"{price:.2f}", f"{price:.2f}", f"{price:.2f}"])
+            self.send_json({"code": 200, "data": candles})
+        elif self.path.startswith("/stratum"):
+            self.send_json({"hashrate_15m": random.randint(1000, 20000), "workers": [f"[::1]:{40000 + i},850,176095,5869,rig{i:02d}" for i in range(3)]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        method = request.get("method")
+        if method == "refresh":
+            self.send_json({"jsonrpc": "2.0", "id": request.get("id"), "result": {"blocks_fetched": 0, "received_money": False}})
+        elif method == "get_balance":
+            balance = random.randint(10**11, 10**13)
+            self.server.harness.metrics["xmr-wallet"].on_sent()
+            self.send_json({"jsonrpc": "2.0", "id": request.get("id"), "result": {"balance": balance, "unlocked_balance": balance // 2}})
+        else:
+            self.send_json({"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32601, "message": "Method not found"}})
+
+class FakeHttpServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, harness):
+        super().__init__(address, FakeHttpHandler)
+        self.harness = harness
+
+# ---------------------------------------------------------------------------
+
+class Harness:
+    def __init__(self, bridges, rates, external_broker=None):
+        self.bridges = bridges
+        self.rates = rates
+        self.external_broker = external_broker
+        self.stop = threading.Event()
+        self.metrics = {name: Metrics(name, BRIDGES[name][1]) for name in BRIDGES}
+        self.feeders = []
+        self.processes = {}
+        self.samplers = {}
+
+    def start_feed(self, name, connection, make_message):
+        feeder = Feeder(connection, self.rates[name], make_message, self.metrics[name], self.stop)
+        self.feeders.append(feeder)
+        feeder.start()
+
+    def start_servers(self):
+        if self.external_broker is None:
+            self.broker = MiniBroker(("127.0.0.1", MQTT_PORT))
+            threading.Thread(target=self.broker.serve_forever, daemon=True).start()
+        self.ws_server = WebSocketServer(("127.0.0.1", 0), {
+            "/ws/public": lambda connection: FakePoloniexPublic(connection, self),
+            "/ws/v3/private": lambda connection: FakePoloniexPrivate(connection, self),
+        })
+        threading.Thread(target=self.ws_server.serve_forever, daemon=True).start()
+        self.http_server = FakeHttpServer(("127.0.0.1", 0), self)
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+
+    def start_subscriber(self):
+        topics = {self.metrics[name].topic: self.metrics[name] for name in self.bridges}
+        def on_connect(client, userdata, flags, rc, properties):
+            for topic in topics:
+                client.subscribe(topic)
+        def on_message(client, userdata, message):
+            metrics = topics.get(message.topic)
+            if metrics is not None:
+                metrics.on_received(mqttpublisher.read_trace(getattr(message, "properties", None)).get(mqttpublisher.EVENT_TS))
+        # event-ts を受け取るため MQTT v5 で接続する
+        self.subscriber = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5)
+        self.subscriber.on_connect = on_connect
+        self.subscriber.on_message = on_message
+        self.subscriber.connect(self.external_broker or "127.0.0.1", MQTT_PORT)
+        self.subscriber.loop_start()
+
+    def bridge_command(self, name, workdir):
+        mqtt_host = self.external_broker or "127.0.0.1"
+        ws_base = f"ws://127.0.0.1:{self.ws_server.server_address[1]}"
+        http_base = f"http://127.0.0.1:{self.http_server.server_address[1]}"
+        script = os.path.join(REPO_DIR, BRIDGES[name][0])
+        # 本番のスナップショットやアラートのルール、足のストアを使わないよう --no-snapshot などを付けて動かす
+        if name == "polo":
+            return [sys.executable, script, "--mqtt", mqtt_host, "--loglevel", "warning", "--no-snapshot", "--no-alerts", "--no-candle-store",
+                    "--ws-url", f"{ws_base}/ws/public", "--candles-url", f"{http_base}/candles"]
+        elif name == "poloprivate":
+            key_file = os.path.join(workdir, "poloniex-api-key")
+            with open(key_file, "w") as f:
+                json.dump({"api_key": "harness", "api_secret": "harness"}, f)
+            return [sys.executable, script, "--mqtt", mqtt_host, "--loglevel", "warning", "--no-snapshot", "--no-alerts",
+                    "--ws-url", f"{ws_base}/ws/v3/private", "--api-key-file", key_file]
+        elif name == "xmr-wallet":
+            return [sys.executable, script, "--mqtt", mqtt_host, "--no-snapshot", "--interval", str(1.0 / self.rates[name]),
+                    "--wallet-rpc-url", f"{http_base}/json_rpc", "--p2pool-status-url", f"{http_base}/stratum"]
+
+    def run(self, duration, warmup):
+        self.start_servers()
+        self.start_subscriber()
+        with tempfile.TemporaryDirectory(prefix="load-harness-") as workdir:
+            for name in self.bridges:
+                process = subprocess.Popen(self.bridge_command(name, workdir), cwd=REPO_DIR)
+                self.processes[name] = process
+                self.samplers[name] = ProcessSampler(process.pid)
+                self.samplers[name].start()
+                logging.info(f"Started {name} (pid {process.pid})")
+            try:
+                logging.info(f"Warming up for {warmup}s")
+                time.sleep(warmup)
+                start = time.monotonic()
+                logging.info(f"Measuring for {duration}s")
+                time.sleep(duration)
+                end = time.monotonic()
+                time.sleep(1.0) # 計測期間の最後に送った入力の出力を待つ
+            finally:
+                self.stop.set()
+                for name, process in self.processes.items():
+                    if process.poll() is not None:
+                        logging.error(f"{name} exited early with code {process.returncode}")
+                    process.terminate()
+                for process in self.processes.values():
+                    try:
+                        process.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                for sampler in self.samplers.values():
+                    sampler.running = False
+                self.subscriber.loop_stop()
+        return {
+            "duration": end - start,
+            "bridges": {name: dict(rate=self.rates[name], **self.metrics[name].report(start, end), **self.samplers[name].report(start, end)) for name in self.bridges},
+        }
+
+def format_report(result):
+    def fmt(value, width):
+        return f"{'-':>{width}}" if value is None else f"{value:>{width}.1f}"
+    lines = [f"{'bridge':<12} {'rate':>6} {'sent':>6} {'recv':>6} {'coal':>6} {'msg/s':>7} {'p50ms':>7} {'p90ms':>7} {'p99ms':>7} {'maxms':>7} {'cpu%':>6} {'rssMB':>7}"]
+    for name, r in result["bridges"].items():
+        latency = r["latency_ms"]
+        lines.append(f"{name:<12} {r['rate']:>6.1f} {r['sent']:>6} {r['received']:>6} {r['coalesced']:>6} {r['throughput']:>7.1f} "
+                     f"{fmt(latency['p50'], 7)} {fmt(latency['p90'], 7)} {fmt(latency['p99'], 7)} {fmt(latency['max'], 7)} "
+                     f"{fmt(r['cpu_percent'], 6)} {fmt(r['peak_rss_mb'], 7)}")
+    return "\n".join(lines)
+
+def parse_bridge_rate(value):
+    name, _, rate = value.partition("=")
+    if name not in BRIDGES: raise argparse.ArgumentTypeError(f"Unknown bridge: {name}")
+    #else
+    return name, float(rate)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load harness for polo2mqtt, poloprivate2mqtt and xmr-wallet2mqtt")
+    parser.add_argument("--bridges", type=str, default=",".join(BRIDGES), help=f"Comma separated bridges to run ({', '.join(BRIDGES)})")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="Input messages per second for every bridge")
+    parser.add_argument("--bridge-rate", type=parse_bridge_rate, action="append", default=[], help="Override the rate of one bridge, e.g. polo=50")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="Seconds to measure")
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP, help="Seconds to run before measuring")
+    parser.add_argument("--external-broker", type=str, help="Use the MQTT broker on this host (port 1883) instead of the embedded one")
+    parser.add_argument("--json", type=str, help="Also write the results to this file")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    bridges = [name for name in args.bridges.split(",") if name]
+    for name in bridges:
+        if name not in BRIDGES: parser.error(f"Unknown bridge: {name}")
+    rates = {name: args.rate for name in BRIDGES}
+    rates.update(dict(args.bridge_rate))
+
+    harness = Harness(bridges, rates, args.external_broker)
+    result = harness.run(args.duration, args.warmup)
+    result["rates"] = {name: rates[name] for name in bridges}
+    print(format_report(result))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
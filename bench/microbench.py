@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# タイルの描画・PNGエンコード・変化の判定と、polo2mqtt の統計(rollingstats)・足のストア(candlestore)のマイクロベンチマーク。
+#
+# 入力は bench/fixtures の固定のデータ(XMR/USDT の10分足、残高)と、sekai-kabuka の既定のレイアウトに
+# 合わせて固定の乱数から作ったスクリーンショット(--frames で実際に保存したPNGに置き換えられる)。
+# 結果はJSONで保存でき、--compare で前回の結果と中央値を比べて、遅くなったものがあれば終了コード1で終わる。
+#
+#   bench/microbench.py --output before.json
+#   bench/microbench.py --compare before.json --threshold 0.1
+#
+# cairo や PyGObject がなくて読み込めないブリッジは飛ばし、理由を結果に残す。
+import os,sys,gc,json,time,math,atexit,random,shutil,tempfile,platform,argparse,statistics,subprocess,datetime
+import importlib.machinery,importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+sys.path.insert(0, REPO_DIR) # tilering.py などを読み込めるように
+
+DEFAULT_ITERATIONS = 50
+DEFAULT_WARMUP = 5
+DEFAULT_THRESHOLD = 0.10 # 中央値がこれ以上(割合)遅くなったら劣化とみなす
+SCREENSHOT_SEED = 20251019
+CHANGED_CELLS = 4 # 2枚目のスクリーンショットで数値が変わるセルの数
+
+def load_script(script):
+    """ハイフンを含むスクリプトも読み込めるよう SourceFileLoader を使う(sys.modules には登録しない)"""
+    path = os.path.join(REPO_DIR, f"{script}.py")
+    loader = importlib.machinery.SourceFileLoader(script.replace("-", "_"), path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        return json.load(f)
+
+def measure(func, iterations, warmup):
+    """func を warmup 回空回ししてから iterations 回呼び、1回ごとの時間(ミリ秒)の統計を返す"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter_ns()
+            func()
+            samples.append((time.perf_counter_ns() - start) / 1e6)
+    finally:
+        if gc_was_enabled: gc.enable()
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "min_ms": samples[0],
+        "median_ms": statistics.median(samples),
+        "mean_ms": statistics.fmean(samples),
+        "p90_ms": samples[min(len(samples) - 1, int(len(samples) * 0.9))],
+        "max_ms": samples[-1],
+        "stdev_ms": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+def cycle(values):
+    """呼ぶたびに values を順に返す関数"""
+    state = {"i": 0}
+    def next_value():
+        value = values[state["i"] % len(values)]
+        state["i"] += 1
+        return value
+    return next_value
+
+def surface_changed(a, b):
+    """2つの cairo surface の画素が異なれば True(再配信するかどうかの判定にかかる時間を測るため)"""
+    import numpy as np
+    a.flush()
+    b.flush()
+    return not np.array_equal(np.frombuffer(a.get_data(), np.uint8), np.frombuffer(b.get_data(), np.uint8))
+
+# ---------------------------------------------------------------------------
+# ベンチマーク。それぞれ {名前: 引数なしの関数} を返す
+
+def bench_polo():
+    polo = load_script("polo2mqtt")
+    history = load_fixture("xmrusdt-candles.json")
+    # 最新の足の終値だけが変わった履歴(新しい約定が来たとき)
+    ticked = history[:-1] + [[history[-1][0], history[-1][1] + 0.01]]
+    stats = polo.rollingstats.RollingStats()
+    stats.seed(history)
+    overlay = stats.stats()
+    surface = polo.render_xmrusdt(history)
+    ticked_surface = polo.render_xmrusdt(ticked)
+    return {
+        "polo/xmrusdt/render": lambda: polo.render_xmrusdt(history),
+        "polo/xmrusdt/render-overlay": lambda: polo.render_xmrusdt(history, overlay),
+        "polo/xmrusdt/encode": lambda: polo.encode_png(surface),
+        "polo/xmrusdt/diff": lambda: surface_changed(surface, ticked_surface),
+    }
+
+def bench_rollingstats():
+    import rollingstats
+    history = load_fixture("xmrusdt-candles.json")
+    stats = rollingstats.RollingStats()
+    stats.seed(history)
+    # 同じ足の更新と、足が確定して窓が1本進む更新を交互に
+    state = {"start": history[-1][0], "price": history[-1][1]}
+    def tick():
+        state["price"] += 0.01
+        stats.update(state["start"], state["price"], quote_volume=1.0, base_volume=state["price"])
+    def roll():
+        state["start"] += 600 * 1000
+        stats.update(state["start"], state["price"])
+    return {
+        "rollingstats/update": tick,
+        "rollingstats/roll": roll,
+        "rollingstats/stats": stats.stats,
+        "rollingstats/seed": lambda: stats.seed(history),
+    }
+
+def bench_candlestore():
+    import candlestore
+    directory = tempfile.mkdtemp(prefix="microbench-candles-")
+    store = candlestore.CandleStore(directory)
+    history = load_fixture("xmrusdt-candles.json")
+    # 10分足で約1年分
+    start_time = history[0][0]
+    for i in range(52560):
+        close = history[i % len(history)][1]
+        store.write("XMR_USDT", "MINUTE_10", start_time + i * 600 * 1000, close, close, close, close, 1.0, 1.0)
+    middle = start_time + 26280 * 600 * 1000
+    state = {"start": start_time + 52560 * 600 * 1000}
+    def append():
+        state["start"] += 600 * 1000
+        store.write("XMR_USDT", "MINUTE_10", state["start"], 1.0, 1.0, 1.0, 1.0)
+    atexit.register(shutil.rmtree, directory, True)
+    return {
+        "candlestore/write-same": lambda: store.write("XMR_USDT", "MINUTE_10", start_time + 52559 * 600 * 1000, 1.0, 1.0, 1.0, 1.0),
+        "candlestore/append": append,
+        "candlestore/read-page": lambda: store.read("XMR_USDT", "MINUTE_10", middle, None, candlestore.PAGE_SIZE),
+        "candlestore/read-max-page": lambda: store.read("XMR_USDT", "MINUTE_10", middle, None, candlestore.MAX_PAGE_SIZE),
+    }
+
+def bench_poloprivate():
+    poloprivate = load_script("poloprivate2mqtt")
+    balances = [(balance["eq"], balance["upl"]) for balance in load_fixture("balances.json")["poloprivate"]]
+    next_balance = cycle(balances)
+    surfaces = [poloprivate.render(eq, upl) for eq, upl in balances[:2]]
+    return {
+        "poloprivate/balance/render": lambda: poloprivate.render(*next_balance()),
+        "poloprivate/balance/encode": lambda: poloprivate.encode_png(surfaces[0]),
+        "poloprivate/balance/diff": lambda: surface_changed(*surfaces),
+    }
+
+def bench_xmr_wallet():
+    xmr_wallet = load_script("xmr-wallet2mqtt")
+    balances = [(balance["balance"], balance["unlocked_balance"], balance["p2pool"]) for balance in load_fixture("balances.json")["xmr-wallet"]]
+    next_balance = cycle(balances)
+    text = "ハッシュレート: 18423H/s\nワーカー: 2(rig07, rig02)\nウォレット残高: 1.2346XMR"
+    surfaces = [xmr_wallet.render(*balance) for balance in balances[:2]]
+    return {
+        "xmr-wallet/balance/fit_text": lambda: xmr_wallet.fit_text_to_rect(text, "Sans Serif", xmr_wallet.CELL_WIDTH - 6, xmr_wallet.CELL_HEIGHT),
+        "xmr-wallet/balance/render": lambda: xmr_wallet.render(*next_balance()),
+        "xmr-wallet/balance/encode": lambda: xmr_wallet.encode_png(surfaces[0]),
+        "xmr-wallet/balance/diff": lambda: surface_changed(*surfaces),
+    }
+
+def make_screenshots(page, seed=SCREENSHOT_SEED):
+    """
+    page のクリップと同じ大きさの白地に、セルごとに枠と数値を描いた2枚のスクリーンショットを作る。
+    2枚目は CHANGED_CELLS 個のセルの数値だけが異なる
+    """
+    import numpy as np
+    import cv2
+    rng = random.Random(seed)
+    height, width = page.clip["height"], page.clip["width"]
+    values = {name: rng.uniform(10, 40000) for name, _ in page.rois}
+    changed = set(rng.sample(sorted(values), min(CHANGED_CELLS, len(values))))
+    frames = []
+    for frame_index in range(2):
+        frame = np.full((height, width, 3), 255, np.uint8)
+        for name, (rows, columns) in page.rois:
+            value = values[name] * (1.001 if frame_index == 1 and name in changed else 1.0)
+            cell = frame[rows, columns]
+            cv2.rectangle(cell, (0, 0), (cell.shape[1] - 1, cell.shape[0] - 1), (128, 128, 128), 1)
+            cv2.putText(cell, name, (6, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+            cv2.putText(cell, f"{value:,.2f}", (6, 80), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 160), 2, cv2.LINE_AA)
+        frames.append(frame)
+    return frames
+
+def bench_sekai_kabuka(frames=None, page_name="dow30"):
+    import numpy as np
+    import cv2
+    sekai = load_script("sekai-kabuka2mqtt")
+    page = next(page for page in sekai.compile_layout(sekai.DEFAULT_LAYOUT) if page.name == page_name)
+    if frames:
+        screenshots = [cv2.imdecode(np.fromfile(path, np.uint8), cv2.IMREAD_UNCHANGED) for path in frames]
+    else:
+        screenshots = make_screenshots(page)
+    pngs = [cv2.imencode(".png", screenshot)[1].tobytes() for screenshot in screenshots]
+    next_png = cycle(pngs)
+    next_screenshot = cycle(screenshots)
+
+    def diff_unchanged():
+        # 前回と同じフレーム: 全てのセルを比べて、どれも配信しない
+        sekai.process_screenshot(screenshots[0], page.rois, now=0.0)
+    def diff_changed():
+        # フレームを交互に入れ替え、毎回一部のセルが変化する
+        sekai.process_screenshot(next_screenshot(), page.rois, now=0.0)
+    cells = {name: screenshots[0][roi] for name, roi in page.rois}
+    def encode_cells():
+        for image in cells.values():
+            sekai.encode_cell(image)
+
+    sekai.last_published.clear()
+    sekai.process_screenshot(screenshots[0], page.rois, now=0.0)
+    return {
+        f"sekai-kabuka/{page_name}/decode": lambda: cv2.imdecode(np.frombuffer(next_png(), np.uint8), cv2.IMREAD_UNCHANGED),
+        f"sekai-kabuka/{page_name}/diff-unchanged": diff_unchanged,
+        f"sekai-kabuka/{page_name}/diff-changed": diff_changed,
+        f"sekai-kabuka/{page_name}/encode": encode_cells,
+    }
+
+# ---------------------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(groups, iterations, warmup, pattern=None):
+    results, skipped = {}, {}
+    for group, setup in groups.items():
+        try:
+            benchmarks = setup()
+        except Exception as e: # ImportError のほか、gi の require_version は ValueError を投げる
+            skipped[group] = f"{type(e).__name__}: {e}"
+            print(f"{group}: skipped ({skipped[group]})", file=sys.stderr)
+            continue
+        for name, func in benchmarks.items():
+            if pattern and pattern not in name: continue
+            #else
+            results[name] = measure(func, iterations, warmup)
+            print(f"{name:<40} median {results[name]['median_ms']:9.3f}ms  p90 {results[name]['p90_ms']:9.3f}ms", file=sys.stderr)
+    return results, skipped
+
+def compare(results, baseline, threshold):
+    """中央値を baseline と比べて表を出し、threshold を超えて遅くなった名前のリストを返す"""
+    regressions = []
+    print(f"{'benchmark':<40} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<40} {'-':>10} {result['median_ms']:>8.3f}ms {'new':>8}")
+            continue
+        #else
+        change = result["median_ms"] / before["median_ms"] - 1 if before["median_ms"] > 0 else math.inf
+        mark = ""
+        if change > threshold:
+            regressions.append(name)
+            mark = "  REGRESSION"
+        print(f"{name:<40} {before['median_ms']:>8.3f}ms {result['median_ms']:>8.3f}ms {change:>+8.1%}{mark}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the tile renderers, encoders and change detection")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS, help="Timed calls per benchmark")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="Untimed calls before timing")
+    parser.add_argument("--filter", type=str, help="Only run benchmarks whose name contains this string")
+    parser.add_argument("--frames", type=str, nargs="+", help="Screenshot PNGs of the sekai-kabuka page to use instead of the generated ones")
+    parser.add_argument("--page", type=str, default="dow30", help="sekai-kabuka page whose cells are benchmarked")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    parser.add_argument("--compare", type=str, help="Compare the medians with a previous JSON result")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    groups = {
+        "polo": bench_polo,
+        "rollingstats": bench_rollingstats,
+        "candlestore": bench_candlestore,
+        "poloprivate": bench_poloprivate,
+        "xmr-wallet": bench_xmr_wallet,
+        "sekai-kabuka": lambda: bench_sekai_kabuka(args.frames, args.page),
+    }
+    results, skipped = run_benchmarks(groups, args.iterations, args.warmup, args.filter)
+    output = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "frames": args.frames,
+        },
+        "results": results,
+        "skipped": skipped,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
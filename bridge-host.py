@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 複数のブリッジ(polo2mqtt など)を1つのプロセスで動かす。
+# MQTTの接続と cairo/Pango などのライブラリは全てのブリッジで共有し、ブリッジはそれぞれ別のスレッドで動かす。
+# ブリッジが落ちたら(または終了したら)、そのブリッジだけをモジュールから読み込み直して起動し直す。
+#
+#   bridge-host polo poloprivate "sekai-kabuka:--user-data-dir /var/tmp/sekai-kabuka --shm" xmr-wallet
+#
+# "名前:引数" の引数は、そのブリッジを単独で動かすときのコマンドライン引数と同じ(--mqtt は無視される)。
+# プロファイルは全てのブリッジのスレッドをまとめて取るので、bridge-host 自身の --profile を使う(SIGUSR2 でも切り替えられる)
+import os,sys,time,logging,threading,argparse,shlex
+import importlib.machinery,importlib.util
+import paho.mqtt.client as mqtt_client # dev-python/paho-mqtt
+import sampleprofiler
+
+BRIDGES = {
+    "polo": "polo2mqtt",
+    "poloprivate": "poloprivate2mqtt",
+    "sekai-kabuka": "sekai-kabuka2mqtt",
+    "xmr-wallet": "xmr-wallet2mqtt",
+}
+
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+STABLE_RUN = 600 # これ以上動いてから落ちたブリッジは、すぐに起動し直す
+
+class SharedClient(mqtt_client.Client):
+    """
+    ブリッジが subscribe したトピックを覚えておき、ブローカーに再接続したら購読し直すクライアント。
+    ブリッジが付ける遅延の追跡用のプロパティを送れるよう MQTT v5 で接続する。
+    コールバックで起きた例外はログに出して捨て、1つのブリッジのせいで全てのブリッジのネットワークのスレッドが止まらないようにする
+    """
+    def __init__(self):
+        super().__init__(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5)
+        self.suppress_exceptions = True
+        self.enable_logger(logging.getLogger("paho")) # 捨てた例外(on_publish など)もログに出るように
+        self.subscriptions = {} # topic -> qos
+        self.subscriptions_lock = threading.Lock()
+        self.on_connect = self._on_connect
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        if isinstance(topic, str):
+            with self.subscriptions_lock:
+                self.subscriptions[topic] = qos
+        return super().subscribe(topic, qos, options, properties)
+
+    def unsubscribe(self, topic, properties=None):
+        if isinstance(topic, str):
+            with self.subscriptions_lock:
+                self.subscriptions.pop(topic, None)
+        return super().unsubscribe(topic, properties)
+
+    def message_callback_add(self, sub, callback):
+        def guarded(client, userdata, message):
+            try:
+                callback(client, userdata, message)
+            except Exception:
+                logging.exception(f"Callback for {sub} failed on a message to {message.topic}")
+        super().message_callback_add(sub, guarded)
+
+    def _on_connect(self, client, userdata, flags, rc, properties):
+        logging.info(f"Connected to MQTT broker with result code {rc}")
+        with self.subscriptions_lock:
+            subscriptions = list(self.subscriptions.items())
+        for topic, qos in subscriptions:
+            super().subscribe(topic, qos)
+
+def load_bridge(name, directory):
+    """
+    ブリッジのスクリプトを毎回新しいモジュールとして読み込む(sys.modules には登録しない)。
+    make install で拡張子なしで置かれたものも読めるように SourceFileLoader を使う
+    """
+    script = BRIDGES[name]
+    for filename in (f"{script}.py", script):
+        path = os.path.join(directory, filename)
+        if os.path.exists(path): break
+    else:
+        raise FileNotFoundError(f"{script} not found in {directory}")
+    loader = importlib.machinery.SourceFileLoader(script.replace("-", "_"), path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+class Bridge(threading.Thread):
+    def __init__(self, name, argv, client, directory):
+        super().__init__(name=name, daemon=True)
+        self.argv = argv
+        self.client = client
+        self.directory = directory
+        # 引数の誤りは起動する前に分かるように、ここで一度読み込んでおく
+        self.module = load_bridge(name, directory)
+        self.args = self.module.build_parser().parse_args(argv)
+        self.restarts = 0
+
+    def run(self):
+        delay = RESTART_DELAY
+        while True:
+            started = time.monotonic()
+            try:
+                if self.module is None:
+                    # 前回の状態(モジュールのグローバル変数)を持ち越さないよう読み込み直す
+                    self.module = load_bridge(self.name, self.directory)
+                    self.args = self.module.build_parser().parse_args(self.argv)
+                logging.info(f"Starting {self.name}")
+                self.module.run(self.args, self.client)
+                logging.warning(f"{self.name} exited")
+            except BaseException as e:
+                if isinstance(e, KeyboardInterrupt): raise
+                #else
+                logging.exception(f"{self.name} crashed: {e}")
+            self.module = None
+            self.restarts += 1
+            if time.monotonic() - started > STABLE_RUN:
+                delay = RESTART_DELAY
+            logging.info(f"Restarting {self.name} in {delay}s (restart #{self.restarts})")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+def parse_bridge_spec(spec):
+    """'name' または 'name:args' を (name, argv) にする"""
+    name, _, args = spec.partition(":")
+    if name not in BRIDGES:
+        raise argparse.ArgumentTypeError(f"Unknown bridge: {name} (choose from {', '.join(BRIDGES)})")
+    return name, shlex.split(args)
+
+def main(mqtt_host, specs, directory):
+    client = SharedClient()
+    bridges = [Bridge(name, argv, client, directory) for name, argv in specs]
+    client.connect(mqtt_host)
+    client.loop_start()
+    for bridge in bridges:
+        bridge.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        logging.info("Exiting...")
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        logging.info("MQTT disconnected")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several MQTT bridges in one process sharing one MQTT connection")
+    parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
+    parser.add_argument("--bridge-dir", type=str, default=os.path.dirname(os.path.abspath(__file__)), help="Directory containing the bridge scripts")
+    parser.add_argument("--loglevel", type=str, default="info", help="Set the logging level (debug, info, warning, error)")
+    sampleprofiler.add_arguments(parser)
+    parser.add_argument("bridges", type=parse_bridge_spec, nargs="+", help=f"Bridges to run, each as NAME or NAME:ARGS ({', '.join(BRIDGES)})")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper(), format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+    if args.bridge_dir not in sys.path:
+        sys.path.insert(0, args.bridge_dir) # tilering.py などを読み込めるように
+    sampleprofiler.setup(args, "bridge-host")
+    main(args.mqtt, args.bridges, args.bridge_dir)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# polo2mqtt が貯めている足を MQTT v5 の request/response で問い合わせ、CSV(または JSON Lines)で出力する。
+#
+#   candle-query --symbol XMR_USDT --start 2025-10-01 --end 2025-10-08 > xmrusdt.csv
+#
+# 返事は candlestore.RECORD を並べたバイナリで、ページごとに next-start を辿って最後まで取る。
+import sys,json,uuid,logging,argparse,datetime,threading
+import paho.mqtt.client as mqtt_client # dev-python/paho-mqtt
+from paho.mqtt.packettypes import PacketTypes
+import candlestore
+
+TIMEOUT = 10 # 1ページの返事を待つ秒数
+COLUMNS = ["start_time", "open", "high", "low", "close", "amount", "quantity"]
+
+def parse_time(value):
+    """ミリ秒の UNIX 時刻か ISO 8601 の日時(タイムゾーンがなければ UTC)をミリ秒にする"""
+    if value.isdigit(): return int(value)
+    #else
+    t = datetime.datetime.fromisoformat(value)
+    if t.tzinfo is None: t = t.replace(tzinfo=datetime.timezone.utc)
+    return int(t.timestamp() * 1000)
+
+class CandleQueryClient:
+    def __init__(self, mqtt_host, query_topic=candlestore.QUERY_TOPIC):
+        self.query_topic = query_topic
+        self.response_topic = f"candle-query/{uuid.uuid4().hex}"
+        self.replies = {} # correlation -> (payload, user properties)
+        self.cond = threading.Condition()
+        self.subscribed = threading.Event()
+        self.client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5)
+        self.client.on_connect = lambda client, userdata, flags, rc, properties: client.subscribe(self.response_topic, qos=1)
+        self.client.on_subscribe = lambda client, userdata, mid, reason_codes, properties: self.subscribed.set()
+        self.client.on_message = self.on_message
+        self.client.connect(mqtt_host)
+        self.client.loop_start()
+        if not self.subscribed.wait(TIMEOUT):
+            raise TimeoutError(f"Could not subscribe to {self.response_topic}")
+
+    def on_message(self, client, userdata, message):
+        correlation = getattr(message.properties, "CorrelationData", None)
+        with self.cond:
+            self.replies[correlation] = (message.payload, dict(getattr(message.properties, "UserProperty", [])))
+            self.cond.notify_all()
+
+    def request(self, query):
+        correlation = uuid.uuid4().bytes
+        properties = mqtt_client.Properties(PacketTypes.PUBLISH)
+        properties.ResponseTopic = self.response_topic
+        properties.CorrelationData = correlation
+        self.client.publish(self.query_topic, json.dumps(query), qos=1, properties=properties)
+        with self.cond:
+            if not self.cond.wait_for(lambda: correlation in self.replies, TIMEOUT):
+                raise TimeoutError(f"No reply to {query} within {TIMEOUT}s (is polo2mqtt running with the candle store?)")
+            #else
+            return self.replies.pop(correlation)
+
+    def query(self, symbol, interval, start=0, end=None, limit=candlestore.PAGE_SIZE):
+        """start から end まで全てのページを取り、足を順に返す"""
+        while True:
+            query = {"symbol": symbol, "interval": interval, "start": start, "limit": limit}
+            if end is not None: query["end"] = end
+            payload, user_properties = self.request(query)
+            if "error" in user_properties:
+                raise RuntimeError(user_properties["error"])
+            #else
+            yield from candlestore.unpack(payload)
+            if "next-start" not in user_properties: return
+            #else
+            start = int(user_properties["next-start"])
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch stored candles from polo2mqtt over MQTT request/response")
+    parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
+    parser.add_argument("--symbol", type=str, default="XMR_USDT", help="Symbol such as XMR_USDT or BTC_USDT")
+    parser.add_argument("--interval", type=str, default="MINUTE_10", help="Candle interval")
+    parser.add_argument("--start", type=parse_time, default=0, help="Start time (milliseconds or ISO 8601, inclusive)")
+    parser.add_argument("--end", type=parse_time, help="End time (milliseconds or ISO 8601, exclusive)")
+    parser.add_argument("--page-size", type=int, default=candlestore.PAGE_SIZE, help=f"Candles per reply (max {candlestore.MAX_PAGE_SIZE})")
+    parser.add_argument("--query-topic", type=str, default=candlestore.QUERY_TOPIC, help="Topic polo2mqtt answers queries on")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per line instead of CSV")
+    parser.add_argument("--loglevel", type=str, default="warning", help="Set the logging level (debug, info, warning, error)")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+
+    client = CandleQueryClient(args.mqtt, args.query_topic)
+    try:
+        if not args.json: print(",".join(COLUMNS))
+        for candle in client.query(args.symbol, args.interval, args.start, args.end, args.page_size):
+            print(json.dumps(dict(zip(COLUMNS, candle))) if args.json else ",".join(str(value) for value in candle))
+    except (TimeoutError, RuntimeError) as e:
+        logging.error(e)
+        sys.exit(1)
+    finally:
+        client.close()
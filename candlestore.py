@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# ローソク足をシンボル・足の長さごとのファイルに貯め、MQTT v5 の request/response で期間を指定して返す。
+#
+# ファイル($XDG_STATE_HOME/market-streamer/candles/<SYMBOL>-<INTERVAL>.candles)の構成:
+#   ヘッダ: magic(8) version(4) レコードの長さ(4)
+#   レコード: startTime(ms) open high low close amount quantity (RECORD)。startTime の昇順に並べる
+# レコードは固定長で昇順なので、mmap したファイルをそのまま二分探索でき、返すときもそのままの bytes を切り出して送る。
+#
+# 問い合わせ: query_topic に JSON {"symbol": "XMR_USDT", "interval": "MINUTE_10", "start": ms, "end": ms, "limit": n}
+# を、ResponseTopic(と必要なら CorrelationData)を付けて送る。返事は RECORD を並べたもので、続きがあれば
+# ユーザープロパティ next-start にその startTime が入るので、start をそれにしてもう一度問い合わせる。
+import os,re,mmap,json,time,bisect,struct,logging,threading
+import mqttpublisher
+import paho.mqtt.client as mqtt_client # dev-python/paho-mqtt
+from paho.mqtt.packettypes import PacketTypes
+
+MAGIC = b"CANDLES\0"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<q6d") # startTime, open, high, low, close, amount(USDT), quantity(XMR)
+CONTENT_TYPE = "application/x-market-streamer-candles"
+QUERY_TOPIC = "poloniex/candles/query"
+PAGE_SIZE = 500 # limit を指定しなかったときの1回の返事のレコード数
+MAX_PAGE_SIZE = 5000
+SERIES_NAME = re.compile(r"[A-Za-z0-9_]+")
+
+def default_dir():
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(state_home, "market-streamer", "candles")
+
+def unpack(payload):
+    """返事のペイロードを [(startTime, open, high, low, close, amount, quantity), ...] にする"""
+    return list(RECORD.iter_unpack(payload))
+
+class StartTimes:
+    """mmap したファイルのレコードの startTime を、bisect で探せる列として見せる"""
+    def __init__(self, buffer, count):
+        self.buffer, self.count = buffer, count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from("<q", self.buffer, HEADER.size + i * RECORD.size)[0]
+
+class CandleStore:
+    def __init__(self, directory=None):
+        self.directory = directory or default_dir()
+        self.lock = threading.Lock() # 書いている途中のレコードを読まないように
+        self.files = {} # (symbol, interval) -> 書き込み用のファイル記述子
+        self.last = {} # (symbol, interval) -> 最後のレコードの startTime
+
+    def path(self, symbol, interval):
+        if not SERIES_NAME.fullmatch(symbol) or not SERIES_NAME.fullmatch(interval):
+            raise ValueError(f"invalid symbol or interval: {symbol} {interval}")
+        #else
+        return os.path.join(self.directory, f"{symbol}-{interval}.candles")
+
+    def _open(self, key):
+        fd = self.files.get(key)
+        if fd is not None: return fd
+        #else
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self.path(*key), os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(fd).st_size
+        if size < HEADER.size:
+            os.pwrite(fd, HEADER.pack(MAGIC, VERSION, RECORD.size), 0)
+            os.ftruncate(fd, HEADER.size)
+            self.last[key] = None
+        else:
+            magic, version, record_size = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+            if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+                os.close(fd)
+                raise ValueError(f"{self.path(*key)} is not a candle store (version {VERSION})")
+            #else
+            count = (size - HEADER.size) // RECORD.size
+            os.ftruncate(fd, HEADER.size + count * RECORD.size) # 書いている途中で落ちた半端なレコードを捨てる
+            self.last[key] = RECORD.unpack(os.pread(fd, RECORD.size, HEADER.size + (count - 1) * RECORD.size))[0] if count else None
+        self.files[key] = fd
+        return fd
+
+    def last_start(self, symbol, interval):
+        """最後の足の startTime。まだ1本もなければ None"""
+        key = (symbol, interval)
+        with self.lock:
+            self._open(key)
+            return self.last[key]
+
+    def write(self, symbol, interval, start_time, open_, high, low, close, amount=0.0, quantity=0.0):
+        """
+        足を1本書く。最後の足と同じ startTime なら上書きし、新しければ後ろに足す。
+        それより古い足は(並びが崩れるので)書かずに False を返す
+        """
+        key = (symbol, interval)
+        with self.lock:
+            fd = self._open(key)
+            last = self.last[key]
+            if last is not None and start_time < last: return False
+            #else
+            record = RECORD.pack(start_time, open_, high, low, close, amount, quantity)
+            if start_time == last:
+                os.pwrite(fd, record, os.fstat(fd).st_size - RECORD.size)
+            else:
+                os.pwrite(fd, record, os.fstat(fd).st_size)
+                self.last[key] = start_time
+            return True
+
+    def read(self, symbol, interval, start=0, end=None, limit=PAGE_SIZE):
+        """
+        start <= startTime < end の足を最大 limit 本、RECORD を並べた bytes で返す。
+        (bytes, 続きの最初の startTime または None)
+        """
+        path = self.path(symbol, interval)
+        with self.lock:
+            try:
+                with open(path, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    count = (size - HEADER.size) // RECORD.size
+                    if count <= 0: return b"", None
+                    #else
+                    with mmap.mmap(f.fileno(), HEADER.size + count * RECORD.size, access=mmap.ACCESS_READ) as buffer:
+                        magic, version, record_size = HEADER.unpack_from(buffer, 0)
+                        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+                            raise ValueError(f"{path} is not a candle store (version {VERSION})")
+                        #else
+                        times = StartTimes(buffer, count)
+                        first = bisect.bisect_left(times, start)
+                        last = count if end is None else bisect.bisect_left(times, end, first)
+                        stop = min(last, first + limit)
+                        data = buffer[HEADER.size + first * RECORD.size:HEADER.size + stop * RECORD.size]
+                        return data, (times[stop] if stop < last else None)
+            except FileNotFoundError:
+                return b"", None
+
+    def close(self):
+        with self.lock:
+            for fd in self.files.values():
+                os.close(fd)
+            self.files.clear()
+
+class CandleQueryService:
+    """query_topic への問い合わせに store から答える。返事は1つも捨てられないよう、client の publisher の send で送る"""
+    def __init__(self, store, query_topic=QUERY_TOPIC):
+        self.store = store
+        self.query_topic = query_topic
+
+    def subscribe(self, client):
+        """client の購読に加える(再接続したときは on_connect からもう一度呼ぶ)"""
+        client.message_callback_add(self.query_topic, self.on_request)
+        client.subscribe(self.query_topic, qos=1)
+
+    def unsubscribe(self, client):
+        """subscribe の逆。bridge-host のクライアントのようにブリッジより長く使われるクライアントから外す"""
+        client.unsubscribe(self.query_topic)
+        client.message_callback_remove(self.query_topic)
+
+    def on_request(self, client, userdata, message):
+        request_properties = getattr(message, "properties", None)
+        response_topic = getattr(request_properties, "ResponseTopic", None)
+        if not response_topic:
+            logging.warning(f"Ignoring candle query without a response topic: {message.payload[:100]}")
+            return
+        #else
+        properties = mqtt_client.Properties(PacketTypes.PUBLISH)
+        correlation = getattr(request_properties, "CorrelationData", None)
+        if correlation is not None:
+            properties.CorrelationData = correlation
+        properties.ContentType = CONTENT_TYPE
+        started = time.perf_counter()
+        try:
+            query = json.loads(message.payload)
+            if not isinstance(query, dict):
+                raise TypeError(f"query must be a JSON object, not {type(query).__name__}")
+            #else
+            limit = max(1, min(int(query.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE))
+            end = query.get("end")
+            data, next_start = self.store.read(str(query["symbol"]), str(query.get("interval", "MINUTE_10")),
+                                               int(query.get("start", 0)), None if end is None else int(end), limit)
+        except Exception as e:
+            # 誰でも送れる問い合わせなので、何が起きても返事にして paho のスレッドには上げない
+            properties.UserProperty = [("error", f"{type(e).__name__}: {e}")]
+            mqttpublisher.get_publisher(client).send(response_topic, b"", qos=message.qos, properties=properties)
+            return
+        #else
+        user_properties = [("count", str(len(data) // RECORD.size)), ("record-format", RECORD.format)]
+        if next_start is not None:
+            user_properties.append(("next-start", str(next_start)))
+        properties.UserProperty = user_properties
+        mqttpublisher.get_publisher(client).send(response_topic, data, qos=message.qos, properties=properties)
+        logging.debug(f"Answered candle query {query} with {len(data) // RECORD.size} candles in {(time.perf_counter() - started) * 1000:.1f}ms")
@@ -1,47 +1,149 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import logging,time,json
+import logging,time,threading,functools
+import concurrent.futures
 import paho.mqtt.client as mqtt_client
 import requests
 import bs4
+import numpy as np
 
-def get_data(alias, mini=False):
-    # fetch https://p2pool.observer/miner/{alias} and parse the html
-    url = f"https://p2pool.observer/miner/{alias}" if not mini else f"https://mini.p2pool.observer/miner/{alias}"
-    soup = bs4.BeautifulSoup(requests.get(url).text, "html.parser")
+# shares, uncles, payouts の各系列は p2pool.observer に表示される 120 枠のシェア数。
+# 16進の文字列ではなく、この順に 120 個ずつ並べた uint8 (360バイト)として配信する
+WINDOW = 120
+SEPARATOR, INVALID = 254, 255
+SLOT_VALUES = np.full(256, INVALID, np.uint8) # 表示の文字 -> 枠のシェア数
+for i, c in enumerate(b"0123456789abcdef"):
+    SLOT_VALUES[c] = SLOT_VALUES[bytes([c]).upper()[0]] = i
+SLOT_VALUES[ord(".")] = 0
+SLOT_VALUES[ord("|")] = SEPARATOR
+
+REQUEST_TIMEOUT = (5, 20) # (接続, 読み込み) 秒
+MAX_WORKERS = 4
+COALESCE_WINDOW = 30 # この秒数以内に取得したばかりなら、REQUEST ALL には取得し直さずに応える
+UPDATE_INTERVAL = 300
+
+def parse_window(text):
+    """'[|..1.|...]' のような表示を uint8 の配列にする。解釈できなければ None"""
+    values = SLOT_VALUES[np.frombuffer(text[2:-2].encode("ascii", "replace"), np.uint8)]
+    values = values[values != SEPARATOR]
+    if len(values) != WINDOW or (values == INVALID).any(): return None
+    #else
+    return values
+
+def parse_page(html):
+    """p2pool.observer のマイナーのページから shares, uncles, payouts の枠を取り出し、配信するバイト列にする"""
+    soup = bs4.BeautifulSoup(html, "html.parser")
     # select all div > code[class="mono"]
     elements = soup.select("div > code[class='mono']")
     # get the text of the first element
     if len(elements) < 4:
         logging.warning(f"No sufficient data found(expected 5): {elements}")
         return
-    shares = elements[2].get_text()[2:-2].replace("|", "").replace(".","0")
-    uncles = elements[3].get_text()[2:-2].replace("|", "").replace(".","0")
-    payouts = elements[4].get_text()[2:-2].replace("|", "").replace(".","0") if len(elements) > 4 else "0" * 120
-    if len(shares) != 120 or len(uncles) != 120 or len(payouts) != 120:
-        logging.warning(f"Data length mismatch(expected 120): {shares}, {uncles}, {payouts}")
+    shares = parse_window(elements[2].get_text())
+    uncles = parse_window(elements[3].get_text())
+    payouts = parse_window(elements[4].get_text()) if len(elements) > 4 else np.zeros(WINDOW, np.uint8)
+    if shares is None or uncles is None or payouts is None:
+        logging.warning(f"Unexpected data (expected {WINDOW} slots): {[element.get_text() for element in elements[2:5]]}")
         return
-    logging.debug(f"shares: {shares}, uncles: {uncles}, payouts: {payouts}")
-    return {
-        "shares": shares,
-        "uncles": uncles,
-        "payouts": payouts
-    }
-
-def get_data_and_publish(client, aliases, mini=False):
-    for alias in aliases:
-        data = get_data(alias, mini)
-        if data:
-            # Publish the data to MQTT
-            client.publish(f"p2pool/{alias}", json.dumps(data), qos=1)
-            logging.debug(f"Published data to p2pool/{alias}: {data}")
+    logging.debug(f"shares: {shares.sum()}, uncles: {uncles.sum()}, payouts: {payouts.sum()} in {WINDOW} slots")
+    return np.stack([shares, uncles, payouts]).tobytes()
+
+class Scraper:
+    """
+    エイリアスごとのページ取得をスレッドプールで並行して行い、取れたものから配信する。
+    paho のスレッドからは request_all で取得を始めるだけなので、p2pool.observer が遅くてもMQTTの送受信は止まらない。
+    - 接続はセッションで使い回し、ETag/Last-Modified で条件付きリクエストにする(304 なら前回のデータを使う)
+    - 取得中に来た要求は、その取得の結果で応えたことにする
+    - COALESCE_WINDOW 以内に取得したばかりなら、取得し直さずに前回のデータを配信し直す
+    """
+    def __init__(self, client, aliases, mini=False, max_workers=MAX_WORKERS):
+        self.client = client
+        self.aliases = aliases
+        self.mini = mini
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="p2pool-scraper")
+        self.lock = threading.Lock() # 以下の状態はワーカーのスレッドからも触るので、読み書きはこれを取ってから
+        self.outstanding = set() # 取得中のエイリアス
+        self.last_scrape = None
+        self.validators = {} # url -> (etag, last_modified, payload)
+        self.payloads = {} # alias -> 最後に配信したデータ
+
+    def url(self, alias):
+        # fetch https://p2pool.observer/miner/{alias} and parse the html
+        return f"https://p2pool.observer/miner/{alias}" if not self.mini else f"https://mini.p2pool.observer/miner/{alias}"
+
+    def fetch(self, alias):
+        url = self.url(alias)
+        headers = {}
+        with self.lock:
+            cached = self.validators.get(url)
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag: headers["If-None-Match"] = etag
+            if last_modified: headers["If-Modified-Since"] = last_modified
+        response = self.session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304 and cached is not None:
+            logging.debug(f"{url} not modified")
+            return cached[2]
+        #else
+        response.raise_for_status()
+        payload = parse_page(response.text)
+        if payload is not None:
+            with self.lock:
+                self.validators[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"), payload)
+        return payload
+
+    def publish(self, alias, payload):
+        self.client.publish(f"p2pool/{alias}", payload, qos=1)
+        logging.debug(f"Published {len(payload)} bytes to p2pool/{alias}")
+
+    def request_all(self, force=False):
+        """全エイリアスの取得を始めてすぐ返る。force なら取得したばかりでも取得し直す"""
+        with self.lock:
+            if self.outstanding:
+                logging.debug("Scrape already in progress, coalescing request")
+                return
+            #else
+            if not force and self.last_scrape is not None and time.monotonic() - self.last_scrape < COALESCE_WINDOW:
+                payloads = list(self.payloads.items())
+            else:
+                payloads = None
+                self.outstanding = set(self.aliases)
+        if payloads is not None:
+            logging.debug(f"Scraped recently, republishing {len(payloads)} cached results")
+            for alias, payload in payloads:
+                self.publish(alias, payload)
+            return
+        #else
+        for alias in self.aliases:
+            future = self.executor.submit(self.fetch, alias)
+            future.add_done_callback(functools.partial(self._on_fetched, alias))
+
+    def _on_fetched(self, alias, future):
+        try:
+            payload = future.result()
+        except Exception as e:
+            logging.warning(f"Error fetching {alias}: {e}")
+            payload = None
+        if payload:
+            self.publish(alias, payload)
         else:
             logging.warning(f"No data to publish for {alias}")
+        with self.lock:
+            if payload: self.payloads[alias] = payload
+            self.outstanding.discard(alias)
+            if not self.outstanding:
+                self.last_scrape = time.monotonic()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
 
 def on_connect(client, userdata, flags, rc, properties=None):
     logging.info(f"Connected to MQTT broker with result code {rc}")
-    get_data_and_publish(client, userdata["aliases"], userdata["mini"])
-    # Subscribe to the topic with userdata = aliases
+    userdata.request_all()
+    # Subscribe to the topic with userdata = scraper
     client.subscribe(f"p2pool", qos=1)
     logging.info(f"Subscribed to p2pool")
 
@@ -51,15 +153,16 @@ def on_message(client, userdata, msg):
         logging.warning(f"Unexpected topic: {msg.topic}")
         return
     #else
-    get_data_and_publish(client, userdata["aliases"])
+    userdata.request_all()
 
-def main(mqtt_host, alias, mini=False):
+def main(mqtt_host, aliases, mini=False, max_workers=MAX_WORKERS):
     # MQTTクライアント設定
     mqtt = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2)
     # MQTTのコールバック関数
 
-    # Set the userdata to the aliases
-    mqtt.user_data_set({"aliases": [alias], "mini": mini})
+    # Set the userdata to the scraper
+    scraper = Scraper(mqtt, aliases, mini, max_workers)
+    mqtt.user_data_set(scraper)
     # Set the callback function
     mqtt.on_connect = on_connect
     mqtt.on_message = on_message
@@ -69,10 +172,11 @@ def main(mqtt_host, alias, mini=False):
     mqtt.loop_start()
     try:
         while True:
-            get_data_and_publish(mqtt, [alias], mini)
-            time.sleep(300)
+            time.sleep(UPDATE_INTERVAL)
+            scraper.request_all(force=True)
     except KeyboardInterrupt:
         logging.info("Exiting...")
+        scraper.shutdown()
         mqtt.loop_stop()
         mqtt.disconnect()
         logging.info("MQTT disconnected")
@@ -85,9 +189,10 @@ if __name__ == "__main__":
     parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
     parser.add_argument("--mini", action="store_true", help="Refer mini chain")
-    parser.add_argument("alias", type=str, help="P2pool alias")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Number of pages fetched concurrently")
+    parser.add_argument("alias", type=str, nargs="+", help="P2pool alias(es)")
     args = parser.parse_args()
     # Set logging level
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     #print(get_data())
-    main(args.mqtt, args.alias, args.mini)
+    main(args.mqtt, args.alias, args.mini, args.workers)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# 一定間隔で回すループのためのペーサー
+#
+# time.time() で経過時間を測って time.sleep(interval - elapsed) で待つやり方は、処理時間のばらつきが
+# そのまま次の周期にずれとして積み重なり、時計の調整(NTPなど)でも狂う。ここでは単調時計上の絶対的な
+# 期限を interval ずつ進め、その期限まで待つ。期限に遅れたときの扱いは policy で選ぶ:
+#   CATCH_UP: 遅れた分の刻みを待たずに続けて返し、刻みの数を実時間に合わせる(ffmpeg の -r のように
+#             入力フレーム数から時刻を決めるものに書き込む場合)。max_catch_up 刻みより遅れたら諦めて飛ばす
+#   SKIP    : 遅れた刻みは飛ばし、次の期限に合わせる(描画やポーリングのように回数に意味がない場合)
+import time,math,logging,collections
+
+CATCH_UP = "catch-up"
+SKIP = "skip"
+
+DEFAULT_MAX_CATCH_UP = 10
+JITTER_WINDOW = 1000
+REPORT_INTERVAL = 300
+
+def sleep_until(deadline, clock=time.monotonic):
+    """単調時計の deadline まで待つ。既に過ぎていればすぐ返る"""
+    delay = deadline - clock()
+    if delay > 0: time.sleep(delay)
+
+class JitterStats:
+    """期限に対して実際に起きた時刻の遅れ(秒)を直近 window 回分記録し、report_interval ごとにログに出す"""
+    def __init__(self, name="loop", window=JITTER_WINDOW, report_interval=REPORT_INTERVAL, clock=time.monotonic):
+        self.name = name
+        self.report_interval = report_interval
+        self.clock = clock
+        self.lateness = collections.deque(maxlen=window)
+        self.count = 0
+        self.skipped = 0
+        self.caught_up = 0
+        self.last_report = clock()
+
+    def record(self, lateness):
+        self.lateness.append(lateness)
+        self.count += 1
+        now = self.clock()
+        if now - self.last_report >= self.report_interval:
+            logging.info(f"{self.name} pacing: {self.summary()}")
+            self.last_report = now
+
+    def percentiles(self):
+        """直近の遅れの (p50, p99, max) をミリ秒で返す"""
+        if not self.lateness: return 0.0, 0.0, 0.0
+        #else
+        values = sorted(self.lateness)
+        def at(p): return values[min(len(values) - 1, int(len(values) * p))] * 1000
+        return at(0.5), at(0.99), values[-1] * 1000
+
+    def summary(self):
+        p50, p99, worst = self.percentiles()
+        return f"{self.count} ticks, lateness p50={p50:.1f}ms p99={p99:.1f}ms max={worst:.1f}ms, {self.caught_up} caught up, {self.skipped} skipped"
+
+class FramePacer:
+    def __init__(self, interval, policy=SKIP, max_catch_up=DEFAULT_MAX_CATCH_UP, name="loop", report_interval=REPORT_INTERVAL, clock=time.monotonic):
+        if policy not in (CATCH_UP, SKIP):
+            raise ValueError(f"Unknown pacing policy: {policy}")
+        self.interval = interval
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.name = name
+        self.clock = clock
+        self.stats = JitterStats(name, report_interval=report_interval, clock=clock)
+        self.deadline = None
+
+    def reset(self):
+        """次の wait はすぐに返り、そこから刻み直す(止まっていた処理を再開するときなど)"""
+        self.deadline = None
+
+    def set_interval(self, interval):
+        """次の期限から interval を変える"""
+        if self.deadline is not None:
+            self.deadline += interval - self.interval
+        self.interval = interval
+
+    def wait(self):
+        """次の期限まで待ち、その期限に対する遅れ(秒)を返す"""
+        now = self.clock()
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self.deadline += self.interval
+            behind = int((now - self.deadline) // self.interval)
+            if behind > 0:
+                if self.policy == SKIP or behind > self.max_catch_up:
+                    # 遅れた刻みを飛ばして、直近の期限に合わせる
+                    self.deadline += behind * self.interval
+                    self.stats.skipped += behind
+                    logging.debug(f"{self.name}: {behind} ticks behind, skipping")
+                else:
+                    self.stats.caught_up += 1
+            sleep_until(self.deadline, self.clock)
+            now = self.clock()
+        lateness = now - self.deadline
+        self.stats.record(lateness)
+        return lateness
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Measure the pacing jitter of this host")
+    parser.add_argument("--fps", type=float, default=5.0, help="Ticks per second")
+    parser.add_argument("--seconds", type=float, default=10.0, help="How long to run")
+    parser.add_argument("--policy", choices=[CATCH_UP, SKIP], default=SKIP, help="What to do when a deadline is missed")
+    args = parser.parse_args()
+    pacer = FramePacer(1.0 / args.fps, args.policy)
+    for _ in range(math.ceil(args.seconds * args.fps)):
+        pacer.wait()
+    print(pacer.stats.summary())
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import subprocess,logging,time,io,json
+import os,subprocess,logging,time,io,json,threading,collections
 
 import cairo,cairosvg # media-gfx/cairosvg
 from gi import require_version
@@ -10,8 +10,9 @@ from gi.repository import Pango, PangoCairo
 
 import paho.mqtt.client as mqtt_client # dev-python/paho-mqtt
 import requests
+import numpy as np
+import tilering,framepacer
 
-charts = {}
 topics = {}
 xmrusdt_price_history = []
 xmr_balance = None
@@ -30,7 +31,11 @@ upl = None
 UPDATE_FPS = 5
 MOVIE_FPS = 15
 BGCOLOR_R, BGCOLOR_G, BGCOLOR_B = (0.0, 1.0, 0.0)
-frame_count = 0
+ENCODER_QUEUE_SIZE = 2 # 書き込み待ちにしておくフレームの数。溢れたら古いものから捨てる
+ENCODER_STALL_TIMEOUT = 10.0 # これ以上 ffmpeg への書き込みが進まなければ ffmpeg を起動し直す
+ENCODER_RESTART_DELAY = 5.0
+ENCODER_MAX_CATCH_UP = UPDATE_FPS * 2 # ffmpeg への書き込みがこの刻み数以上遅れたら、取り戻さずに飛ばす
+ENCODER_STATS_INTERVAL = 300
 
 WIDTH, HEIGHT = 1216, 684
 CELL_WIDTH, CELL_HEIGHT = 187, 154
@@ -135,6 +140,123 @@ def run_ffmpeg(rtmp_url):
     stderr=subprocess.DEVNULL
     )
 
+class EncoderFeed:
+    """
+    合成したフレームを専用のスレッドで ffmpeg に書き込む。ffmpeg や RTMP が詰まっても合成は止まらない。
+    - 合成側は変化のあったフレームだけを submit する。キューが一杯なら古いフレームから捨てる
+    - 書き込みスレッドは UPDATE_FPS の刻みごとにキューの最新のフレームを書き、それより古いものは捨てる。
+      ffmpeg は入力のフレーム数から時刻を決めるので、書き込みが遅れた刻みは続けて書いて取り戻す
+    - 新しいフレームがなければ直前のフレームをもう一度書き、ffmpeg に渡すフレームの間隔を一定に保つ
+    - ffmpeg が終了するか書き込みが stall_timeout 以上進まなければ、ffmpeg を起動し直す
+    """
+    def __init__(self, rtmp_url, queue_size=ENCODER_QUEUE_SIZE, stall_timeout=ENCODER_STALL_TIMEOUT):
+        self.rtmp_url = rtmp_url
+        self.stall_timeout = stall_timeout
+        self.lock = threading.Lock()
+        self.frames = collections.deque(maxlen=queue_size)
+        self.ffmpeg = None
+        self.killed = None # check で止めて、書き込みスレッドが起動し直すのを待っている ffmpeg
+        self.running = False
+        self.thread = None
+        self.last_write = time.monotonic()
+        self.last_stats = time.monotonic()
+        self.written = 0
+        self.duplicated = 0
+        self.dropped = 0
+        self.restarts = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="encoder-feed", daemon=True)
+        self.thread.start()
+
+    def submit(self, frame):
+        """frame は書き込みスレッドに渡すので、合成に使っているサーフェスのコピーを渡すこと"""
+        with self.lock:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+
+    def _take(self):
+        with self.lock:
+            if not self.frames: return None
+            #else
+            frame = self.frames.pop()
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            return frame
+
+    def _start_ffmpeg(self):
+        self.ffmpeg = run_ffmpeg(self.rtmp_url)
+        self.last_write = time.monotonic()
+        logging.info("FFmpeg started")
+
+    def _stop_ffmpeg(self):
+        if self.ffmpeg is None: return
+        #else
+        try:
+            self.ffmpeg.stdin.close()
+        except Exception as e:
+            logging.debug(f"Error closing ffmpeg stdin: {e}")
+        try:
+            self.ffmpeg.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.ffmpeg.kill()
+            self.ffmpeg.wait()
+        self.ffmpeg = None
+
+    def _run(self):
+        pacer = framepacer.FramePacer(1.0 / UPDATE_FPS, framepacer.CATCH_UP, max_catch_up=ENCODER_MAX_CATCH_UP, name="encoder feed")
+        frame = None
+        while self.running:
+            if self.ffmpeg is None:
+                self._start_ffmpeg()
+                pacer.reset()
+            pacer.wait()
+            new_frame = self._take()
+            if new_frame is not None:
+                frame = new_frame
+            elif frame is not None:
+                self.duplicated += 1
+            if frame is None: continue
+            #else
+            try:
+                self.ffmpeg.stdin.write(frame)
+                self.ffmpeg.stdin.flush()
+                self.written += 1
+                self.last_write = time.monotonic()
+            except (OSError, ValueError) as e:
+                if not self.running: break
+                #else
+                logging.error(f"FFmpeg write error (exit code {self.ffmpeg.poll()}): {e}")
+                self._stop_ffmpeg()
+                self.restarts += 1
+                time.sleep(ENCODER_RESTART_DELAY)
+
+    def check(self):
+        """合成側のスレッドから定期的に呼び、ffmpeg が終了・停止していたら止めて書き込みスレッドに起動し直させる"""
+        now = time.monotonic()
+        ffmpeg = self.ffmpeg
+        if ffmpeg is not None and ffmpeg is not self.killed:
+            if ffmpeg.poll() is not None:
+                logging.warning(f"FFmpeg exited with code {ffmpeg.returncode}")
+                self.killed = ffmpeg # 書き込み側が BrokenPipeError で気付いて起動し直す
+            elif now - self.last_write > self.stall_timeout:
+                logging.warning(f"FFmpeg has not accepted a frame for {now - self.last_write:.1f}s, killing it")
+                ffmpeg.kill()
+                self.killed = ffmpeg
+        if now - self.last_stats > ENCODER_STATS_INTERVAL:
+            logging.info(f"Encoder feed: {self.written} written, {self.duplicated} duplicated, {self.dropped} dropped, {self.restarts} restarts")
+            self.last_stats = now
+
+    def stop(self):
+        self.running = False
+        if self.ffmpeg is not None:
+            self.ffmpeg.kill() # 書き込み中なら止める
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self._stop_ffmpeg()
+
 def on_poloniex_public_message(message):
     global xmrusdt_price_history
     # convert the message to JSON
@@ -165,6 +287,7 @@ def on_poloniex_public_message(message):
                 xmrusdt_price_history_new.pop(0)
         # 更新された履歴を保存
         xmrusdt_price_history = xmrusdt_price_history_new
+        tiles.invalidate("xmrusdt")
 
     except json.JSONDecodeError as e:
         logging.error(f"JSON decode error: {e}")
@@ -180,27 +303,44 @@ def on_poloniex_account_message(message):
     eq = float(eq_str) if eq_str is not None else None
     upl_str = data.get("upl")
     upl = float(upl_str) if upl_str is not None else None
+    tiles.invalidate("balance")
 
 def on_poloniex_positions_message(message):
     pass
 
+P2POOL_WINDOW = 120 # p2pool2mqtt が送ってくる1系列あたりの枠の数
+P2POOL_SERIES = ["shares", "uncles", "payouts"]
+HEX_DIGITS = np.zeros(256, np.uint8) # 16進の文字 -> 値
+for i, c in enumerate(b"0123456789abcdef"):
+    HEX_DIGITS[c] = HEX_DIGITS[bytes([c]).upper()[0]] = i
+
 def on_p2pool_message(message):
     global p2pool_data
-    data = json.loads(message.payload)
-    shares = []
-    for n in data["shares"]:
-        shares.append(int(n, 16))
-    uncles = []
-    for n in data["uncles"]:
-        uncles.append(int(n, 16))
-    payouts = []
-    for n in data["payouts"]:
-        payouts.append(int(n, 16))
-    p2pool_data = {
-        "shares": shares,
-        "uncles": uncles,
-        "payouts": payouts
-    }
+    payload = message.payload
+    # paho のスレッドで呼ばれるので、おかしなペイロード(retain を消す空のものなど)は例外にせず捨てる
+    if payload[:1] == b"{":
+        # 以前の形式: {"shares": "0010...", ...} の16進文字列
+        try:
+            data = json.loads(payload)
+            digits = [data[name].encode("ascii") for name in P2POOL_SERIES]
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logging.warning(f"Ignoring invalid p2pool message on {message.topic}: {e}")
+            return
+        #else
+        if len(set(map(len, digits))) != 1:
+            logging.warning(f"Ignoring p2pool message on {message.topic}: series have different lengths {list(map(len, digits))}")
+            return
+        #else
+        windows = np.array([HEX_DIGITS[np.frombuffer(d, np.uint8)] for d in digits])
+    else:
+        # shares, uncles, payouts の順に P2POOL_WINDOW 個ずつ並んだ uint8
+        if len(payload) != len(P2POOL_SERIES) * P2POOL_WINDOW:
+            logging.warning(f"Ignoring p2pool message on {message.topic}: {len(payload)} bytes, expected {len(P2POOL_SERIES) * P2POOL_WINDOW}")
+            return
+        #else
+        windows = np.frombuffer(payload, np.uint8).reshape(len(P2POOL_SERIES), P2POOL_WINDOW)
+    p2pool_data = dict(zip(P2POOL_SERIES, windows))
+    tiles.invalidate("p2pool")
 
 def on_connect(client, userdata, flags, rc, properties):
     logging.info(f"Connected to MQTT broker with result code {rc}")
@@ -233,7 +373,7 @@ def on_message(client, userdata, message):
     #logging.info(f"Received message: {topic}")
     if topic.startswith("sekai-kabuka/"):
         name = topic.split("/")[-1]
-        charts[name] = message.payload
+        tiles.put(name, message.payload)
     elif topic == "poloniex/public":
         on_poloniex_public_message(message)
     elif topic == "poloniex/account":
@@ -243,10 +383,114 @@ def on_message(client, userdata, message):
     elif topic.startswith("p2pool/"):
         on_p2pool_message(message)
 
-def draw_png(ctx, png, x, y):
-    if png is None: return
+class TileCache:
+    """
+    タイルのデコード済みサーフェスを保持する。PNGのデコードは新しいペイロードが届いたタイルについて
+    次のフレームを合成するときに一度だけ行い、再描画が必要なタイルの名前を dirty として返す。
+    自前で描くタイル(xmrusdt など)は元になるデータが更新されたら invalidate する(タイルリングで受け取っていればそれを貼る)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.payloads = {} # name -> png (デコード待ち)
+        self.dirty = set()
+        self.surfaces = {} # name -> cairo.ImageSurface
+        self.ring_paths = [] # 共有メモリのタイルリング
+        self.readers = {} # path -> TileRingReader(まだファイルがなければない)
+        self.ring_seqs = {} # name -> 最後に取り込んだ (inode, seq)
+
+    def put(self, name, png):
+        with self.lock:
+            self.payloads[name] = png
+
+    def invalidate(self, name):
+        with self.lock:
+            self.dirty.add(name)
+
+    def add_ring(self, path):
+        """path のタイルリングから読む。まだファイルがなくても、できたら読み始める"""
+        self.ring_paths.append(path)
+
+    def get(self, name):
+        return self.surfaces.get(name)
+
+    def from_ring(self, name):
+        """name のタイルをタイルリングから受け取っていれば True(自前で描くタイルの代わりに貼る)"""
+        return name in self.ring_seqs
+
+    def _reader(self, path):
+        """
+        path の今のファイルの reader を返す。書き込み側が起動し直してファイルが置き換えられていたら開き直し、
+        ファイルがなければ None
+        """
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            inode = None
+        reader = self.readers.get(path)
+        if reader is not None and reader.inode != inode:
+            logging.info(f"Tile ring {path} was {'recreated' if inode is not None else 'removed'}, reopening")
+            reader.close()
+            del self.readers[path]
+            reader = None
+        if reader is None and inode is not None:
+            try:
+                reader = self.readers[path] = tilering.TileRingReader(path)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Cannot open tile ring {path} yet: {e}")
+        return reader
+
+    def _poll_rings(self, dirty):
+        for path in self.ring_paths:
+            reader = self._reader(path)
+            if reader is None: continue
+            #else
+            try:
+                self._read_ring(reader, dirty)
+            except RuntimeError as e:
+                logging.warning(f"Skipping tile ring {path}: {e}")
+
+    def _read_ring(self, reader, dirty):
+        for name, (index, seq) in reader.index().items():
+            if self.ring_seqs.get(name) == (reader.inode, seq): continue
+            #else
+            seq, width, height, stride, timestamp, pixels = reader.read(index)
+            scratch = bytes(pixels)
+            pixels.release()
+            # コピーしている間に上書きされていたら、サーフェスには書かずに次のフレームで取り込み直す
+            if not reader.is_valid(index, seq): continue
+            #else
+            surface = self.surfaces.get(name)
+            if surface is None or surface.get_width() != width or surface.get_height() != height:
+                surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            surface.flush()
+            data = surface.get_data()
+            surface_stride = surface.get_stride()
+            row = min(stride, surface_stride)
+            for y in range(height):
+                data[y * surface_stride:y * surface_stride + row] = scratch[y * stride:y * stride + row]
+            surface.mark_dirty()
+            self.surfaces[name] = surface
+            self.ring_seqs[name] = (reader.inode, seq)
+            dirty.add(name)
+
+    def take_dirty(self):
+        with self.lock:
+            payloads, self.payloads = self.payloads, {}
+            dirty, self.dirty = self.dirty, set()
+        for name, png in payloads.items():
+            try:
+                self.surfaces[name] = cairo.ImageSurface.create_from_png(io.BytesIO(png))
+                dirty.add(name)
+            except Exception as e:
+                logging.error(f"Error decoding {name}: {e}")
+        self._poll_rings(dirty)
+        return dirty
+
+tiles = TileCache()
+
+def draw_png(ctx, surface, x, y):
+    if surface is None: return
     # Draw a cell at the given coordinates
-    surface = cairo.ImageSurface.create_from_png(io.BytesIO(png))
     ctx.set_source_surface(surface, x, y)
     ctx.paint()
 
@@ -477,32 +721,26 @@ def draw_balance(ctx, x, y):
     ctx.stroke()
 
 def draw_p2pool_chart(ctx, x, y, height, data, color=(0, 0, 1)):
-    min_data = 0
-    max_data = max(data)
-    # 青色を設定
+    """data は uint8 の配列"""
+    max_data = int(data.max()) if len(data) > 0 else 0
 
     ctx.set_source_rgb(*color)
     ctx.set_line_width(1)
 
-    def fit_to_chart(data):
-        """データをチャートの高さにスケールする関数"""
-        if max_data == 0: return height
-        return height - ((data - min_data) / (max_data - min_data) * height)
-
-    # 価格をチャート高さに正規化して折れ線を描画
-    for i in range(len(data)):
-        # 現在のデータポイント
-        current_data = data[i]
-        plot_y = fit_to_chart(current_data) + y  # チャートのY座標を計算
-        # 横軸：1データポイント=1ピクセル
-        plot_x = x + i
+    # データをチャートの高さにスケールしたY座標をまとめて計算する
+    if max_data == 0:
+        plot_ys = np.full(len(data), y + height, dtype=float)
+    else:
+        plot_ys = y + height - data * (height / max_data)
 
+    # 横軸：1データポイント=1ピクセル
+    for i, plot_y in enumerate(plot_ys.tolist()):
         if i == 0:
             # 最初の点：線を開始
-            ctx.move_to(plot_x, plot_y)
+            ctx.move_to(x, plot_y)
         else:
             # 以降の点：線を引く
-            ctx.line_to(plot_x, plot_y)
+            ctx.line_to(x + i, plot_y)
 
     # 線を描画
     ctx.stroke()
@@ -540,61 +778,79 @@ def draw_p2pool(ctx, x, y):
     ctx.rectangle(x, y, width, height)
     ctx.stroke()
 
-def draw_frame(surface):
-    global frame_count, charts, eq, upl
-    ctx = cairo.Context(surface)
-
+# 画面上のタイルの配置 (name, x, y, width, height, draw)。draw が None のタイルは受け取った画像を貼る
+# 重なっている部分(枠線)は後のタイルが上に描かれる
+def build_layout():
+    layout = []
     x, y = GAP_X, GAP_Y
-    draw_png(ctx, charts.get("sunday_dow"), x, y)
-    x += CELL_WIDTH
-    draw_png(ctx, charts.get("nasdaq100_sunday"), x, y)
-    x -= CELL_WIDTH
+    layout.append(("sunday_dow", x, y, CELL_WIDTH, CELL_HEIGHT, None))
+    layout.append(("nasdaq100_sunday", x + CELL_WIDTH, y, CELL_WIDTH, CELL_HEIGHT, None))
     y += CELL_HEIGHT
-    draw_png(ctx, charts.get("sp500_cfd"), x, y)
-    x += CELL_WIDTH
-    draw_png(ctx, charts.get("russel2000_cfd"), x, y)
-    x -= CELL_WIDTH
+    layout.append(("sp500_cfd", x, y, CELL_WIDTH, CELL_HEIGHT, None))
+    layout.append(("russel2000_cfd", x + CELL_WIDTH, y, CELL_WIDTH, CELL_HEIGHT, None))
     y += CELL_HEIGHT + GAP_Y
-    draw_png(ctx, charts.get("vix"), x, y)
-    x += CELL_WIDTH
-    draw_png(ctx, charts.get("yield"), x, y)
-
-    x -= CELL_WIDTH
+    layout.append(("vix", x, y, CELL_WIDTH, CELL_HEIGHT, None))
+    layout.append(("yield", x + CELL_WIDTH, y, CELL_WIDTH, CELL_HEIGHT, None))
     y += CELL_HEIGHT + GAP_Y
-    draw_png(ctx, charts.get("date"), x, y)
-    x += CELL_WIDTH
-    draw_balance(ctx, x, y)
+    layout.append(("date", x, y, CELL_WIDTH, CELL_HEIGHT, None))
+    layout.append(("balance", x + CELL_WIDTH, y, CELL_WIDTH, 114, draw_balance))
 
-    x += CELL_WIDTH + GAP_X
+    x += CELL_WIDTH * 2 + GAP_X
     y = GAP_Y
-    draw_png(ctx, charts.get("n225_cfd"), x, y)
-    x += CELL_WIDTH
-    draw_png(ctx, charts.get("sunday_dollar"), x, y)
+    layout.append(("n225_cfd", x, y, CELL_WIDTH, CELL_HEIGHT, None))
+    layout.append(("sunday_dollar", x + CELL_WIDTH, y, CELL_WIDTH, CELL_HEIGHT, None))
     y += CELL_HEIGHT + GAP_Y
-    x -= CELL_WIDTH
-    draw_png(ctx, charts.get("btcusd"), x, y)
-    x += CELL_WIDTH
-    draw_xmrusdt(ctx, x, y)
-    x -= CELL_WIDTH
+    layout.append(("btcusd", x, y, CELL_WIDTH, CELL_HEIGHT, None))
+    layout.append(("xmrusdt", x + CELL_WIDTH, y, CELL_WIDTH, CELL_HEIGHT, draw_xmrusdt))
     y += CELL_HEIGHT + GAP_Y
-    draw_p2pool(ctx, x, y)
+    layout.append(("p2pool", x, y, 122, 64, draw_p2pool))
 
+    x += CELL_WIDTH * 2 + GAP_X
     y = GAP_Y
-    x += CELL_WIDTH + CELL_WIDTH + GAP_X
-    draw_png(ctx, charts.get("gold_sunday"), x, y)
-    y += CELL_HEIGHT
-    draw_png(ctx, charts.get("lng"), x, y)
-    y += CELL_HEIGHT
-    draw_png(ctx, charts.get("palladium"), x, y)
-    y = GAP_Y
+    for name in ["gold_sunday", "lng", "palladium"]:
+        layout.append((name, x, y, CELL_WIDTH, CELL_HEIGHT, None))
+        y += CELL_HEIGHT
     x += CELL_WIDTH
-    draw_png(ctx, charts.get("wti"), x, y)
-    y += CELL_HEIGHT
-    draw_png(ctx, charts.get("copper"), x, y)
+    y = GAP_Y
+    for name in ["wti", "copper"]:
+        layout.append((name, x, y, CELL_WIDTH, CELL_HEIGHT, None))
+        y += CELL_HEIGHT
+    return layout
+
+LAYOUT = build_layout()
 
-def main(mqtt_host, rtmp_url):
-    global frame_count, xmrusdt_price_history, xmr_balance, xmr_unlocked_balance
+def overlaps(a, b, margin=1):
+    """タイルの矩形が枠線の太さ(margin)を含めて重なっていれば True"""
+    _, ax, ay, aw, ah, _ = a
+    _, bx, by, bw, bh, _ = b
+    return ax - margin < bx + bw + margin and bx - margin < ax + aw + margin and ay - margin < by + bh + margin and by - margin < ay + ah + margin
+
+def draw_frame(surface, dirty=None):
+    """
+    dirty のタイルだけを描き直し、描き直したタイルの矩形 [(x, y, width, height), ...] を返す。
+    描き直したタイルに重なっている後ろのタイルも、重なり順を保つため描き直す。dirty が None なら全て描く
+    """
+    ctx = cairo.Context(surface)
+    redrawn = []
+    for tile in LAYOUT:
+        name, x, y, width, height, draw = tile
+        if dirty is not None and name not in dirty and not any(overlaps(tile, other) for other in redrawn): continue
+        #else
+        if draw is not None and not tiles.from_ring(name):
+            draw(ctx, x, y)
+        else:
+            # タイルリングで受け取った xmrusdt / balance はブリッジが描いたものを貼る
+            draw_png(ctx, tiles.get(name), x, y)
+        redrawn.append(tile)
+    surface.flush()
+    return [(x, y, width, height) for _, x, y, width, height, _ in redrawn]
+
+def main(mqtt_host, rtmp_url, shm_paths=()):
+    global xmrusdt_price_history, xmr_balance, xmr_unlocked_balance
     xmrusdt_price_history = fetch_xmrusdt_price_history()
+    for path in shm_paths:
+        tiles.add_ring(path)
+        logging.info(f"Reading tiles from {path}")
 
     # MQTTクライアント設定
     mqtt = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2)
@@ -604,43 +860,42 @@ def main(mqtt_host, rtmp_url):
     mqtt.connect(mqtt_host)
     mqtt.loop_start()  # run in a separate thread
 
-    ffmpeg = run_ffmpeg(rtmp_url)
-    logging.info("FFmpeg started")
-
     surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
     ctx = cairo.Context(surface)
     ctx.set_source_rgb(BGCOLOR_R, BGCOLOR_G, BGCOLOR_B)
     ctx.rectangle(0, 0, WIDTH, HEIGHT)
     ctx.fill()
     del ctx
+    draw_frame(surface) # 最初のフレームは全てのタイルを描く
+
+    feed = EncoderFeed(rtmp_url)
+    feed.submit(bytes(surface.get_data()))
+    feed.start()
 
-    last_xmr_balance_check = 0
+    last_xmr_balance_check = None
+    pacer = framepacer.FramePacer(1.0 / UPDATE_FPS, framepacer.SKIP, name="composition")
 
     try:
         while True:
-            start_time = time.time()
+            pacer.wait()
+            start_time = time.monotonic()
 
             # Check if we need to fetch new XMR price history
-            if start_time - last_xmr_balance_check > 60 * 10:
+            if last_xmr_balance_check is None or start_time - last_xmr_balance_check > 60 * 10:
                 xmr_balance, xmr_unlocked_balance = fetch_xmr_balance()
                 last_xmr_balance_check = start_time
-
-            draw_frame(surface)
-
-            ffmpeg.stdin.write(surface.get_data())
-            ffmpeg.stdin.flush()
-            frame_count += 1
-
-            current_time = time.time()
-            elapsed_time = current_time - start_time
-            if elapsed_time < 1.0 / UPDATE_FPS:
-                time.sleep(1.0 / UPDATE_FPS - elapsed_time)
-            else:
-                logging.warning("Frame processing took too long, skipping frame")
+                tiles.invalidate("p2pool")
+
+            dirty = tiles.take_dirty()
+            if dirty:
+                rects = draw_frame(surface, dirty)
+                logging.debug(f"Redrew {len(rects)} tiles: {', '.join(sorted(dirty))}")
+                feed.submit(bytes(surface.get_data()))
+            feed.check()
     except KeyboardInterrupt:
         logging.info("Exiting...")
     finally:
-        ffmpeg.stdin.close()
+        feed.stop()
         mqtt.loop_stop()
         mqtt.disconnect()
         logging.info("MQTT disconnected")
@@ -652,8 +907,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Market streamer")
     parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
     parser.add_argument("--rtmp", type=str, default=DEFAULT_RTMP_SERVER, help="RTMP server address")
+    parser.add_argument("--shm", type=str, action="append", default=[], help="Read raw tiles from a shared-memory tile ring written with --shm (e.g. /dev/shm/sekai-kabuka.tiles). Can be given more than once")
     parser.add_argument("--loglevel", type=str, default="info", help="Set the logging level (debug, info, warning, error)")
     args = parser.parse_args()
     logging.basicConfig(level=args.loglevel.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 
-    main(args.mqtt, args.rtmp)
\ No newline at end of file
+    main(args.mqtt, args.rtmp, args.shm)
\ No newline at end of file
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ブリッジが MQTT v5 のユーザープロパティに付けた時刻(mqttpublisher.trace_properties)から、
+# タイルが元のイベントから何ミリ秒後にここ(表示側)に届いたかをトピックごとに集計する。
+#
+#   mqtt-latency --topic 'poloniex/#' --topic 'sekai-kabuka/#' --interval 60
+#
+# 段階ごとの内訳も出す: event→recv(取引所などからブリッジまで)、recv→render(描画とエンコード)、
+# render→publish(送信待ち)、publish→here(ブローカーを経てここまで)。
+# ブリッジとこのマシンの時計がずれていると(NTPで合わせていないと)その分だけ値がずれる。
+import time,json,logging,argparse,threading,collections
+import paho.mqtt.client as mqtt_client # dev-python/paho-mqtt
+import mqttpublisher
+
+DEFAULT_TOPICS = ["poloniex/#", "sekai-kabuka/#", "xmr/#"]
+WINDOW = 1000 # トピックごとに直近何件のメッセージで集計するか
+REPORT_INTERVAL = 60
+STAGES = [
+    ("event->recv", mqttpublisher.EVENT_TS, mqttpublisher.RECEIVE_TS),
+    ("recv->render", mqttpublisher.RECEIVE_TS, mqttpublisher.RENDER_TS),
+    ("render->publish", mqttpublisher.RENDER_TS, mqttpublisher.PUBLISH_TS),
+    ("publish->here", mqttpublisher.PUBLISH_TS, None),
+]
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class LatencyStats:
+    def __init__(self, window=WINDOW):
+        self.lock = threading.Lock()
+        self.window = window
+        self.total = collections.defaultdict(lambda: collections.deque(maxlen=self.window)) # topic -> 元の時刻からの遅延
+        self.stages = collections.defaultdict(lambda: collections.deque(maxlen=self.window)) # (topic, stage) -> 遅延
+        self.untraced = collections.Counter() # 時刻の付いていないメッセージの数
+
+    def record(self, topic, trace, now_ms):
+        with self.lock:
+            # 元のイベントの時刻がなければ(xmr-wallet など)、ブリッジが受け取った時刻から測る
+            source = trace.get(mqttpublisher.EVENT_TS, trace.get(mqttpublisher.RECEIVE_TS))
+            if source is None:
+                self.untraced[topic] += 1
+                return
+            #else
+            self.total[topic].append(now_ms - source)
+            for stage, start, end in STAGES:
+                if start in trace and (end is None or end in trace):
+                    self.stages[(topic, stage)].append((now_ms if end is None else trace[end]) - trace[start])
+
+    def summary(self):
+        """{topic: {"count", "p50", "p90", "p99", "max", "stages": {stage: p50}}} をミリ秒で返す"""
+        with self.lock:
+            result = {}
+            for topic, latencies in sorted(self.total.items()):
+                values = sorted(latencies)
+                stages = {}
+                for stage, _, _ in STAGES:
+                    stage_values = sorted(self.stages.get((topic, stage), ()))
+                    if stage_values: stages[stage] = percentile(stage_values, 0.5)
+                result[topic] = {
+                    "count": len(values),
+                    "p50": percentile(values, 0.5),
+                    "p90": percentile(values, 0.9),
+                    "p99": percentile(values, 0.99),
+                    "max": values[-1],
+                    "stages": stages,
+                }
+            for topic, count in self.untraced.items():
+                result.setdefault(topic, {"count": 0})["untraced"] = count
+            return result
+
+def format_summary(summary):
+    lines = [f"{'topic':<36} {'n':>5} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  stage p50 (ms)"]
+    for topic, s in summary.items():
+        if "p50" not in s:
+            lines.append(f"{topic:<36} {s['count']:>5}  (no timestamps on {s['untraced']} messages; bridge connected with MQTT 3.1.1?)")
+            continue
+        #else
+        stages = " ".join(f"{stage}={value}" for stage, value in s["stages"].items())
+        lines.append(f"{topic:<36} {s['count']:>5} {s['p50']:>8} {s['p90']:>8} {s['p99']:>8} {s['max']:>8}  {stages}")
+    return "\n".join(lines)
+
+def main(mqtt_host, topics, interval, duration=None, as_json=False):
+    stats = LatencyStats()
+
+    def on_connect(client, userdata, flags, rc, properties):
+        logging.info(f"Connected to MQTT broker with result code {rc}")
+        for topic in topics:
+            client.subscribe(topic)
+
+    def on_message(client, userdata, message):
+        stats.record(message.topic, mqttpublisher.read_trace(getattr(message, "properties", None)), mqttpublisher.now_ms())
+
+    client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(mqtt_host)
+    client.loop_start()
+    started = time.monotonic()
+    try:
+        while duration is None or time.monotonic() - started < duration:
+            time.sleep(interval if duration is None else min(interval, max(0, duration - (time.monotonic() - started))))
+            summary = stats.summary()
+            print(json.dumps(summary) if as_json else format_summary(summary), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report source-to-display latency of tiles from the timestamps the bridges attach")
+    parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
+    parser.add_argument("--topic", type=str, action="append", help=f"Topic filter to watch (repeatable, default: {' '.join(DEFAULT_TOPICS)})")
+    parser.add_argument("--interval", type=float, default=REPORT_INTERVAL, help="Seconds between reports")
+    parser.add_argument("--duration", type=float, help="Exit after this many seconds")
+    parser.add_argument("--json", action="store_true", help="Print each report as one JSON line")
+    parser.add_argument("--loglevel", type=str, default="warning", help="Set the logging level (debug, info, warning, error)")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    main(args.mqtt, args.topic or DEFAULT_TOPICS, args.interval, args.duration, args.json)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# ブローカーが遅い・つながらない間もメモリを使い切らないMQTTの送信キュー
+#
+# paho の publish は送れない間も全てのメッセージを抱え込むので、ブローカーの再起動中などに
+# 画像のトピックが多いブリッジのメモリが増え続ける。CoalescingPublisher はメッセージをトピックごとに
+# 最新の1つだけ保持し(同じトピックの送信待ちは新しいもので置き換える)、送信待ちの合計が max_bytes を
+# 超えたら古いトピックから捨てる。paho には接続中かつ未完了の送信が max_inflight 未満のときだけ渡す。
+# アラートや問い合わせへの返事のように1つも捨てられないメッセージは send で送る(まとめず、予算でも捨てず、
+# publish の送信待ちより先に送る)。
+#
+# タイルがどれだけ古くなって表示側に届いたかを追えるよう、MQTT v5 のユーザープロパティに各段階の時刻
+# (ミリ秒単位のUNIX時刻)を付けられる。trace_properties で作ったプロパティを publish に渡すと、
+# paho に渡す直前に publish-ts を書き足す。MQTT 3.1.1 で接続したクライアントではプロパティは送られない。
+import copy,time,logging,threading,weakref,collections
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+MAX_PENDING_BYTES = 8 * 1024 * 1024
+MAX_INFLIGHT = 16
+INFLIGHT_TIMEOUT = 30.0 # これ以上 on_publish が来ない送信は(切断などで)失われたものとみなす
+STATS_INTERVAL = 300
+MESSAGE_EXPIRY = 60 # ブローカーがこれ以上配信できずにいるタイルは捨てさせる(秒)
+
+EVENT_TS = "event-ts" # 元のイベント(取引所の約定、キャプチャなど)の時刻
+RECEIVE_TS = "recv-ts" # ブリッジが受け取った時刻
+RENDER_TS = "render-ts" # タイルを描き終えた(エンコードし終えた)時刻
+PUBLISH_TS = "publish-ts" # 送信待ちから paho に渡した時刻
+TRACE_KEYS = (EVENT_TS, RECEIVE_TS, RENDER_TS, PUBLISH_TS)
+
+def now_ms():
+    return int(time.time() * 1000)
+
+def trace_properties(event_ts=None, recv_ts=None, render_ts=None, expiry=MESSAGE_EXPIRY):
+    """時刻(ミリ秒)のユーザープロパティと Message Expiry Interval(expiry 秒。0 か None なら付けない)を持つ PUBLISH のプロパティ"""
+    properties = Properties(PacketTypes.PUBLISH)
+    timestamps = [(key, str(int(value))) for key, value in ((EVENT_TS, event_ts), (RECEIVE_TS, recv_ts), (RENDER_TS, render_ts)) if value is not None]
+    if timestamps:
+        properties.UserProperty = timestamps
+    if expiry:
+        properties.MessageExpiryInterval = int(expiry)
+    return properties
+
+def read_trace(properties):
+    """受け取ったメッセージのプロパティから {EVENT_TS: ミリ秒, ...} を返す"""
+    if properties is None: return {}
+    #else
+    return {key: int(value) for key, value in getattr(properties, "UserProperty", []) if key in TRACE_KEYS and value.isdigit()}
+
+class CoalescingPublisher:
+    def __init__(self, client, max_bytes=MAX_PENDING_BYTES, max_inflight=MAX_INFLIGHT, name="mqtt"):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.max_inflight = max_inflight
+        self.name = name
+        self.cond = threading.Condition()
+        self.pending = {} # topic -> (payload, qos, retain, properties)。挿入順が古い順
+        self.pending_bytes = 0
+        self.queue = collections.deque() # send で入れた (topic, payload, qos, retain, properties)。入れた順に全て送る
+        self.inflight = {} # mid -> 渡した時刻
+        self.publishing = False # paho の publish を呼んでいる間だけ True
+        self.early_acks = set() # その間に on_publish が来た mid(自分の送信のものかはまだわからない)
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.last_stats = time.monotonic()
+        client.on_publish = self._on_publish
+        self.thread = threading.Thread(target=self._run, name=f"{name}-publisher", daemon=True)
+        self.thread.start()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        """送信待ちに入れてすぐ返る。同じトピックの送信待ちがあれば置き換える。properties は MQTT v5 のプロパティ"""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif payload is None:
+            payload = b""
+        with self.cond:
+            # 置き換えるときは送信待ちの順番を保ち、更新の多いトピックが後回しにされ続けないようにする
+            previous = self.pending.get(topic)
+            if previous is not None:
+                self.pending_bytes -= len(previous[0])
+                self.coalesced += 1
+            self.pending[topic] = (payload, qos, retain, properties)
+            self.pending_bytes += len(payload)
+            # 予算を超えたら古いトピックから捨てる(入れたばかりのものは残す)
+            while self.pending_bytes > self.max_bytes and len(self.pending) > 1:
+                old_topic = next(iter(self.pending))
+                old_payload = self.pending.pop(old_topic)[0]
+                self.pending_bytes -= len(old_payload)
+                self.dropped += 1
+                logging.debug(f"Dropped pending message to {old_topic} ({len(old_payload)} bytes)")
+            self.cond.notify()
+
+    def send(self, topic, payload=None, qos=1, retain=False, properties=None):
+        """まとめず、捨てずに送る。publish の送信待ちより先に、入れた順に送る"""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif payload is None:
+            payload = b""
+        with self.cond:
+            self.queue.append((topic, payload, qos, retain, properties))
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.pending),
+                "queued": len(self.queue),
+                "pending_bytes": self.pending_bytes,
+                "inflight": len(self.inflight),
+                "published": self.published,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+            }
+
+    def _on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        with self.cond:
+            # paho の publish から戻る前に届いた自分の送信の完了だけを覚える。それ以外で inflight にない mid は
+            # publisher を通さずに送られたものなので、覚えておくと mid が一巡したあとで自分の送信を完了扱いにしてしまう
+            if self.inflight.pop(mid, None) is None and self.publishing:
+                self.early_acks.add(mid)
+            self.cond.notify()
+
+    def _expire_inflight(self, now):
+        expired = [mid for mid, sent in self.inflight.items() if now - sent > INFLIGHT_TIMEOUT]
+        for mid in expired:
+            del self.inflight[mid]
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                self._expire_inflight(now)
+                if now - self.last_stats > STATS_INTERVAL:
+                    logging.info(f"{self.name} publisher: {len(self.pending)} pending ({self.pending_bytes} bytes), {len(self.queue)} queued, {len(self.inflight)} in flight, "
+                                 f"{self.published} published, {self.coalesced} coalesced, {self.dropped} dropped")
+                    self.last_stats = now
+                if not (self.queue or self.pending) or len(self.inflight) >= self.max_inflight or not self.client.is_connected():
+                    # 接続状態の変化は通知されないので時々見直す
+                    self.cond.wait(0.5)
+                    continue
+                #else
+                if self.queue:
+                    topic, payload, qos, retain, properties = self.queue.popleft()
+                else:
+                    topic = next(iter(self.pending))
+                    payload, qos, retain, properties = self.pending.pop(topic)
+                    self.pending_bytes -= len(payload)
+                self.publishing = True
+            if properties is not None:
+                # 同じプロパティが複数のトピックや再送に使われるので、書き足すのはコピーに
+                properties = copy.copy(properties)
+                properties.UserProperty = (PUBLISH_TS, str(now_ms()))
+            info = self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+            with self.cond:
+                self.publishing = False
+                acked = info.mid in self.early_acks
+                self.early_acks.clear() # 自分の mid 以外は他の送信の完了
+                if info.rc == 0:
+                    self.published += 1
+                    if not acked and not info.is_published():
+                        self.inflight[info.mid] = time.monotonic()
+                else:
+                    logging.warning(f"Failed to publish to {topic}: rc={info.rc}")
+
+_publishers = weakref.WeakKeyDictionary()
+_publishers_lock = threading.Lock()
+
+def get_publisher(client, **kwargs):
+    """client に送る CoalescingPublisher を返す。1つのクライアントには1つだけ作る(bridge-host で共有するため)"""
+    with _publishers_lock:
+        publisher = _publishers.get(client)
+        if publisher is None:
+            publisher = CoalescingPublisher(client, **kwargs)
+            _publishers[client] = publisher
+        return publisher
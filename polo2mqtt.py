@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import time,threading,logging,json,argparse,io
+import time,threading,logging,json,argparse,io,struct
 import websocket,requests,cairo,cairosvg # media-gfx/cairosvg
 import paho.mqtt.client as mqtt_client
+import tilering,mqttpublisher,statesnapshot,sampleprofiler,rollingstats,pricealerts,candlestore
 
 from gi import require_version
 require_version("Pango", "1.0")
@@ -12,8 +13,18 @@ from gi.repository import Pango, PangoCairo
 channel = ["candles_minute_10"]
 symbols = ["XMR_USDT", "BTC_USDT"]
 xmrusdt_price_history = []
+xmrusdt_stats = rollingstats.RollingStats() # 履歴から VWAP などを逐次計算する
 
 mqtt = None
+ws_url = "wss://ws-web.poloniex.com/ws/public"
+candles_url = "https://poloniex.com/proxy/sapi/spot/quotation/candlesticks?symbol=XMR_USDT&interval=MINUTE_10&limit=144"
+tile_ring = None # --shm が指定されたときの共有メモリのタイルリング
+message_expiry = mqttpublisher.MESSAGE_EXPIRY
+snapshot = None # 再起動したときに読み戻す状態(--no-snapshot なら None)
+stats_overlay = False # タイルに VWAP/SMA の線とボラティリティを重ねるか
+alerts = None # シンボルの終値でしきい値を調べる(--no-alerts なら None)
+candle_store = None # 受け取った足を全部貯めておく(--no-candle-store なら None)
+candle_query = None # candle_store の足を MQTT の問い合わせに返す
 
 CELL_WIDTH, CELL_HEIGHT = 187, 154
 
@@ -31,11 +42,9 @@ def fetch_xmrusdt_price_history():
               startTimeはUnixタイムスタンプ（ミリ秒）、closeはfloat。
               失敗した場合は空リストを返す。
     """
-    url = "https://poloniex.com/proxy/sapi/spot/quotation/candlesticks?symbol=XMR_USDT&interval=MINUTE_10&limit=144"
-    
     try:
         # APIリクエストを送信
-        response = requests.get(url, timeout=10)
+        response = requests.get(candles_url, timeout=10)
         response.raise_for_status()  # ステータスコードが200でない場合例外を発生
         
         # JSONデータをパース
@@ -62,10 +71,13 @@ def fetch_xmrusdt_price_history():
         return []
 
 def on_poloniex_public_message(data):
+    """ローソク足のメッセージで履歴を更新し、XMR_USDT の更新があればそのイベントの時刻(ミリ秒)を返す"""
     global xmrusdt_price_history
     # convert the message to JSON
     # copy xmrusdt_price_history to a new list
     xmrusdt_price_history_new = [item[:] for item in xmrusdt_price_history]
+    ticks = [] # 履歴を更新できたら統計に取り込む足
+    event_ts = None
     try:
         # check if the message is a candle
         if "data" not in data or not isinstance(data["data"], list): return
@@ -77,6 +89,8 @@ def on_poloniex_public_message(data):
             if symbol != "XMR_USDT": continue
             start_time = trade["startTime"]
             current_price = float(trade["close"])
+            event_ts = trade.get("ts", event_ts)
+            ticks.append((start_time, current_price) + tuple(float(trade[key]) if key in trade else None for key in ("high", "low", "amount", "quantity")))
             last_price_in_history = xmrusdt_price_history_new[-1] if xmrusdt_price_history_new else None
             if last_price_in_history is not None:
                 if last_price_in_history[0] == start_time:
@@ -90,6 +104,9 @@ def on_poloniex_public_message(data):
                 xmrusdt_price_history_new.pop(0)
         # 更新された履歴を保存
         xmrusdt_price_history = xmrusdt_price_history_new
+        for tick in ticks:
+            xmrusdt_stats.update(*tick)
+        return event_ts
 
     except json.JSONDecodeError as e:
         logging.error(f"JSON decode error: {e}")
@@ -115,7 +132,8 @@ def rasterize_svg(svg_data, size):
     # PNGデータをCairoのImageSurfaceとして読み込み
     return cairo.ImageSurface.create_from_png(png_data)
 
-def draw_xmrusdt_chart(ctx, xmrusdt_price_history, x, y):
+def draw_xmrusdt_chart(ctx, xmrusdt_price_history, x, y, levels=()):
+    """levels: チャートに重ねる水平線 [(価格, (r, g, b)), ...]。チャートの範囲外のものは描かない"""
     # 価格（close）の最小値と最大値を計算
     prices = [candle[1] for candle in xmrusdt_price_history]
     start_price = prices[0]  # 最初の価格
@@ -166,6 +184,17 @@ def draw_xmrusdt_chart(ctx, xmrusdt_price_history, x, y):
     # 線を描画
     ctx.stroke()
 
+    # VWAP などの水平線(点線)
+    for level, rgb in levels:
+        if level is None or not min_price <= level <= max_price: continue
+        #else
+        ctx.set_source_rgb(*rgb)
+        ctx.set_dash([3, 2])
+        ctx.move_to(x, y + fit_to_chart(level))
+        ctx.line_to(x + len(xmrusdt_price_history) - 1, y + fit_to_chart(level))
+        ctx.stroke()
+        ctx.set_dash([])
+
     # draw left arrow at the position of current price
     # black stroke, white fill
     ctx.set_source_rgb(1, 1, 1)  # RGB: (1, 1, 1) = 白
@@ -185,7 +214,8 @@ def draw_xmrusdt_chart(ctx, xmrusdt_price_history, x, y):
     ctx.close_path()
     ctx.stroke()
 
-def draw_xmrusdt(xmrusdt_price_history):
+def render_xmrusdt(xmrusdt_price_history, stats=None):
+    """XMR/USDT のタイルを描いた surface を返す。stats (RollingStats.stats()) を渡すとその値を重ねる"""
     global monero_surface
     # create a Cairo surface
     surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, CELL_WIDTH, CELL_HEIGHT)
@@ -209,7 +239,13 @@ def draw_xmrusdt(xmrusdt_price_history):
     ctx.show_text("XMR/USDT")
 
     if xmrusdt_price_history is not None and len(xmrusdt_price_history) > 0:
-        draw_xmrusdt_chart(ctx, xmrusdt_price_history, 1, 50)
+        levels = [(stats["vwap"], (1, 0.5, 0)), (stats["sma"], (0.5, 0, 0.5))] if stats is not None else []
+        draw_xmrusdt_chart(ctx, xmrusdt_price_history, 1, 50, levels)
+        if stats is not None and stats["volatility"] is not None:
+            ctx.set_source_rgb(0.3, 0.3, 0.3)
+            ctx.set_font_size(9)
+            ctx.move_to(140, 14)
+            ctx.show_text(f"σ{stats['volatility']:.2f}%")
 
         start_price = xmrusdt_price_history[0][1]
         current_price = xmrusdt_price_history[-1][1]
@@ -274,12 +310,21 @@ def draw_xmrusdt(xmrusdt_price_history):
     ctx.set_source_rgb(0.5, 0.5, 0.5)
     ctx.rectangle(0, 0, CELL_WIDTH, CELL_HEIGHT)
     ctx.stroke()
+    return surface
 
-    # return as PNG binary
+def encode_png(surface):
     buf = io.BytesIO()
     surface.write_to_png(buf)
     return buf.getvalue()
 
+def draw_xmrusdt(xmrusdt_price_history, stats=None):
+    surface = render_xmrusdt(xmrusdt_price_history, stats)
+    if tile_ring is not None:
+        surface.flush()
+        tile_ring.write("xmrusdt", surface.get_data(), CELL_WIDTH, CELL_HEIGHT, surface.get_stride())
+    # return as PNG binary
+    return encode_png(surface)
+
 def ping_thread(ws):
     try:
         while True:
@@ -291,7 +336,22 @@ def ping_thread(ws):
 
 def on_open(ws):
     global xmrusdt_price_history
-    xmrusdt_price_history = fetch_xmrusdt_price_history()
+    history = fetch_xmrusdt_price_history()
+    if history or not xmrusdt_price_history:
+        xmrusdt_price_history = history
+    else:
+        logging.warning("Failed to fetch the price history, keeping the restored one")
+    xmrusdt_stats.seed(xmrusdt_price_history)
+    if candle_store is not None:
+        # REST API の履歴は終値しかないので、ストアの最後の足より新しいものだけ埋めておく(後でストリームの足で上書きされる)。
+        # 最後の足と同じ startTime のものを書くと、ストリームで受け取った足を終値だけの足で上書きしてしまう
+        try:
+            last = candle_store.last_start("XMR_USDT", "MINUTE_10")
+            for start_time, close in xmrusdt_price_history:
+                if last is None or start_time > last:
+                    candle_store.write("XMR_USDT", "MINUTE_10", start_time, close, close, close, close)
+        except (ValueError, TypeError, OSError, struct.error) as e:
+            logging.error(f"Failed to store the price history: {e}")
 
     logging.info("WebSocket connection opened")
     SUBSCRIPTION_MESSAGE = {
@@ -301,16 +361,45 @@ def on_open(ws):
     }       
     ws.send(json.dumps(SUBSCRIPTION_MESSAGE))
     # Start ping thread
-    threading.Thread(target=ping_thread, args=(ws,), daemon=True).start()
+    threading.Thread(target=ping_thread, args=(ws,), name="ping", daemon=True).start()
+
+def store_candles(data):
+    """ストリームの足(全てのシンボル)を candle_store に書く"""
+    interval = data.get("channel", channel[0]).removeprefix("candles_").upper() # candles_minute_10 -> MINUTE_10
+    for candle in data["data"]:
+        try:
+            candle_store.write(candle["symbol"], interval, int(candle["startTime"]),
+                               *(float(candle.get(key, candle["close"])) for key in ("open", "high", "low", "close")),
+                               float(candle.get("amount", 0)), float(candle.get("quantity", 0)))
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            logging.error(f"Failed to store candle {candle}: {e}")
+
+def on_mqtt_connect(client, userdata, flags, rc, properties):
+    logging.info(f"Connected to MQTT broker with result code {rc}")
+    if candle_query is not None: candle_query.subscribe(client) # 再接続したら購読し直す
 
 def on_message(ws, message):
     logging.debug(f"Received message: {message}")
     # MQTTにメッセージを送信
     if "data" in message:
+        recv_ts = mqttpublisher.now_ms()
         #mqtt.publish("poloniex/public", message)
-        on_poloniex_public_message(json.loads(message))
-        png = draw_xmrusdt(xmrusdt_price_history)
-        mqtt.publish("poloniex/xmrusdt", png)
+        data = json.loads(message)
+        event_ts = on_poloniex_public_message(data)
+        if alerts is not None and isinstance(data.get("data"), list):
+            for candle in data["data"]:
+                if "symbol" in candle and "close" in candle: alerts.update(candle["symbol"], float(candle["close"]))
+        if candle_store is not None and isinstance(data.get("data"), list):
+            store_candles(data)
+        stats = xmrusdt_stats.stats()
+        png = draw_xmrusdt(xmrusdt_price_history, stats if stats_overlay else None)
+        trace = {"event_ts": event_ts, "recv_ts": recv_ts, "render_ts": mqttpublisher.now_ms()}
+        mqtt.publish("poloniex/xmrusdt", png, properties=mqttpublisher.trace_properties(**trace, expiry=message_expiry))
+        if stats is not None:
+            # 表示側が PNG から読み取らなくても済むよう、数値は JSON でも配信する
+            mqtt.publish("poloniex/xmrusdt/stats", json.dumps(stats), properties=mqttpublisher.trace_properties(**trace, expiry=message_expiry))
+        if snapshot is not None:
+            snapshot.update({"xmrusdt_price_history": xmrusdt_price_history}, {"poloniex/xmrusdt": (png, {"trace": trace})})
 
 def on_error(ws, error):
     logging.error(f"WebSocket error: {error}")
@@ -318,21 +407,64 @@ def on_error(ws, error):
 def on_close(ws, close_status_code, close_msg):
     logging.info("WebSocket closed with code: {close_status_code}, message: {close_msg}")
 
-if __name__ == "__main__":
-    # Argument parser
+def build_parser():
     parser = argparse.ArgumentParser(description="Poloniex WebSocket to MQTT bridge")
     parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
     parser.add_argument("--loglevel", type=str, default="info", help="Set the logging level (debug, info, warning, error)")
-    args = parser.parse_args()
-    # Set logging level
-    logging.basicConfig(level=args.loglevel.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
-    # MQTTクライアント設定
-    mqtt = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2)
-    mqtt.connect(args.mqtt)
-    mqtt.loop_start() # run in a separate thread
-
-    # WebSocket server settings
-    ws_url = "wss://ws-web.poloniex.com/ws/public"
+    parser.add_argument("--ws-url", type=str, default=ws_url, help="Poloniex public WebSocket URL")
+    parser.add_argument("--candles-url", type=str, default=candles_url, help="Poloniex REST URL returning the XMR_USDT 10-minute candles")
+    parser.add_argument("--message-expiry", type=int, default=mqttpublisher.MESSAGE_EXPIRY, help="Seconds the broker may hold an undelivered tile (0 to disable)")
+    parser.add_argument("--snapshot", type=str, default=statesnapshot.default_path("polo2mqtt"), help="File to keep the price history and last tile in across restarts")
+    parser.add_argument("--no-snapshot", action="store_true", help="Do not save or restore the snapshot")
+    parser.add_argument("--ma-period", type=int, default=rollingstats.MA_PERIOD, help="Number of 10-minute candles in the SMA/EMA published on poloniex/xmrusdt/stats")
+    parser.add_argument("--stats-overlay", action="store_true", help="Draw the VWAP (orange) and SMA (purple) lines and the realized volatility on the tile")
+    parser.add_argument("--alerts", type=str, default=pricealerts.default_path(), help="JSON file of alert rules, reloaded when it changes (source: symbol such as XMR_USDT)")
+    parser.add_argument("--no-alerts", action="store_true", help="Do not publish alerts")
+    parser.add_argument("--candle-store", type=str, default=candlestore.default_dir(), help="Directory to keep every streamed candle in, for history queries")
+    parser.add_argument("--no-candle-store", action="store_true", help="Do not store candles or answer history queries")
+    parser.add_argument("--query-topic", type=str, default=candlestore.QUERY_TOPIC, help="Topic of MQTT v5 request/response candle history queries")
+    parser.add_argument("--shm", type=str, nargs="?", const=tilering.default_path("polo"), help="Also write raw BGRA tiles to a shared-memory tile ring (default path: /dev/shm/polo.tiles)")
+    sampleprofiler.add_arguments(parser)
+    return parser
+
+def run(args, client=None):
+    """
+    WebSocket が閉じるまで動かす。client に接続済みのMQTTクライアントを渡すと
+    自前で接続せずにそれを使う(bridge-host から動かす場合)
+    """
+    global mqtt, tile_ring, ws_url, candles_url, message_expiry, snapshot, xmrusdt_price_history, xmrusdt_stats, stats_overlay, alerts, candle_store, candle_query
+    ws_url, candles_url = args.ws_url, args.candles_url
+    message_expiry = args.message_expiry
+    xmrusdt_stats = rollingstats.RollingStats(ma_period=args.ma_period)
+    stats_overlay = args.stats_overlay
+    if not args.no_candle_store:
+        candle_store = candlestore.CandleStore(args.candle_store)
+        candle_query = candlestore.CandleQueryService(candle_store, args.query_topic)
+    hosted = client is not None
+    if not hosted:
+        # MQTTクライアント設定(遅延の追跡用のプロパティを送るため MQTT v5 で接続する)
+        client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5)
+        client.on_connect = on_mqtt_connect
+        client.connect(args.mqtt)
+        client.loop_start() # run in a separate thread
+    elif candle_query is not None:
+        candle_query.subscribe(client) # bridge-host のクライアントは再接続したら自分で購読し直す
+    mqtt = mqttpublisher.get_publisher(client) # ブローカーが詰まったら古い画像を捨てる
+    if args.shm is not None:
+        tile_ring = tilering.TileRingWriter(args.shm, CELL_WIDTH * CELL_HEIGHT * 4, max_tiles=1)
+    state = {}
+    if not args.no_snapshot:
+        # 前回の履歴とタイルを読み戻し、REST API から取り直すのを待たずに配信する
+        snapshot = statesnapshot.Snapshotter(args.snapshot)
+        state, tiles = snapshot.restore()
+        xmrusdt_price_history = state.get("xmrusdt_price_history", [])
+        xmrusdt_stats.seed(xmrusdt_price_history)
+        statesnapshot.publish_tiles(mqtt, tiles, message_expiry)
+    if not args.no_alerts:
+        # アラートは捨てられると困るので、まとめたり捨てたりしない send で QoS 1 で送る。
+        # 配信したルールの id はスナップショットに残し、止まっている間に消されたルールの retain も消せるようにする
+        alerts = pricealerts.AlertEngine(args.alerts, mqtt.send, published=state.get("alerts", []),
+                                         on_published=None if snapshot is None else lambda ids: snapshot.update({"alerts": ids})).watch()
 
     # Create WebSocket client
     ws = websocket.WebSocketApp(ws_url,
@@ -342,4 +474,19 @@ if __name__ == "__main__":
                                 on_close=on_close)
     
     # Start WebSocket in a separate thread
-    ws.run_forever()
+    try:
+        ws.run_forever()
+    finally:
+        if snapshot is not None: snapshot.close()
+        if alerts is not None: alerts.close()
+        if hosted and candle_query is not None:
+            candle_query.unsubscribe(client) # 起動し直したブリッジが閉じたストアで答えないように
+        if candle_store is not None: candle_store.close()
+
+if __name__ == "__main__":
+    # Argument parser
+    args = build_parser().parse_args()
+    # Set logging level
+    logging.basicConfig(level=args.loglevel.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    sampleprofiler.setup(args, "polo2mqtt")
+    run(args)
@@ -4,6 +4,7 @@ import os,time,threading,logging,json,argparse,hashlib,hmac,base64,io
 
 import websocket,cairo
 import paho.mqtt.client as mqtt_client
+import tilering,mqttpublisher,statesnapshot,sampleprofiler,pricealerts
 
 from gi import require_version
 require_version("Pango", "1.0")
@@ -14,6 +15,10 @@ api_key = None
 api_secret = None
 ws_url = "wss://ws.poloniex.com/ws/v3/private"
 mqtt = None
+tile_ring = None # --shm が指定されたときの共有メモリのタイルリング
+message_expiry = mqttpublisher.MESSAGE_EXPIRY
+snapshot = None # 再起動したときに読み戻す状態(--no-snapshot なら None)
+alerts = None # eq / upl でしきい値を調べる(--no-alerts なら None)
 
 # poloniex account balance
 eq = None
@@ -46,7 +51,8 @@ def on_open(ws):
     ws.send(json.dumps(subscribe_message))
     logging.debug("認証メッセージ送信:", subscribe_message)
 
-def draw(eq, upl):
+def render(eq, upl):
+    """残高のタイルを描いた surface を返す"""
     surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, CELL_WIDTH, CELL_HEIGHT)
     ctx = cairo.Context(surface)
     ctx.set_source_rgb(1, 1, 1)
@@ -98,25 +104,42 @@ def draw(eq, upl):
     ctx.set_source_rgb(0.5, 0.5, 0.5)
     ctx.rectangle(0, 0, CELL_WIDTH, CELL_HEIGHT)
     ctx.stroke()
-    # return as PNG binary
+    return surface
+
+def encode_png(surface):
     buf = io.BytesIO()
     surface.write_to_png(buf)
     return buf.getvalue()
 
-def on_account(data):
+def draw(eq, upl):
+    surface = render(eq, upl)
+    if tile_ring is not None:
+        surface.flush()
+        tile_ring.write("balance", surface.get_data(), CELL_WIDTH, CELL_HEIGHT, surface.get_stride())
+    # return as PNG binary
+    return encode_png(surface)
+
+def on_account(data, recv_ts=None):
     global eq, upl
     eq_str = data.get("eq")
     eq = float(eq_str) if eq_str is not None else None
     upl_str = data.get("upl")
     upl = float(upl_str) if upl_str is not None else None
+    if alerts is not None:
+        alerts.update("eq", eq)
+        alerts.update("upl", upl)
     png = draw(eq, upl)
-    mqtt.publish("poloniex/balance", png)
+    trace = {"event_ts": data.get("ts"), "recv_ts": recv_ts, "render_ts": mqttpublisher.now_ms()}
+    mqtt.publish("poloniex/balance", png, properties=mqttpublisher.trace_properties(**trace, expiry=message_expiry))
+    if snapshot is not None:
+        snapshot.update({"eq": eq, "upl": upl}, {"poloniex/balance": (png, {"trace": trace})})
 
 def on_positions(data):
     pass
 
 def on_message(ws, message):
     logging.debug(f"Received message: {message}")
+    recv_ts = mqttpublisher.now_ms()
     json_message = json.loads(message)
     event = json_message.get("event")
     channel = json_message.get("channel")
@@ -137,14 +160,14 @@ def on_message(ws, message):
                 "symbols": ["BTC_USDT_PERP"]
             }
             ws.send(json.dumps(SUBSCRIBE_MESSAGE))
-            threading.Thread(target=ping_thread, args=(ws,), daemon=True).start()
+            threading.Thread(target=ping_thread, args=(ws,), name="ping", daemon=True).start()
         else:
             logging.error("Failed to authenticate")
         return
     elif channel == "account":
         #https://api-docs.poloniex.com/v3/futures/websocket/private/account
         #mqtt.publish("poloniex/account", json.dumps(data[0]))
-        on_account(data[0])
+        on_account(data[0], recv_ts)
     elif channel == "positions":
         #mqtt.publish("poloniex/positions", json.dumps(data))
         on_positions(data)
@@ -157,36 +180,73 @@ def on_error(ws, error):
 def on_close(ws, close_status_code, close_msg):
     logging.info(f"WebSocket closed with code: {close_status_code}, message: {close_msg}")
 
-if __name__ == "__main__":
-    # Argument parser
-    parser = argparse.ArgumentParser(description="Poloniex Private WebSocket API to MQTT bridge")
-    parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
-    parser.add_argument("--loglevel", type=str, default="info", help="Set the logging level (debug, info, warning, error)")
-    args = parser.parse_args()
-    # Set logging level
-    logging.basicConfig(level=args.loglevel.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
-    # MQTTクライアント設定
-    mqtt = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2)
-    mqtt.connect(args.mqtt)
-    mqtt.loop_start() # run in a separate thread
+API_KEY_FILE = "~/.config/poloniex-api-key"
 
-    # read api_key and secret from ~/.poloniex_api_secret (json)
-    api_key_file_error = False
+def load_api_key(path=API_KEY_FILE):
+    """path (json) から api_key と api_secret を読む。読めなければ None を返す"""
     try:
-        with open(os.path.expanduser("~/.config/poloniex-api-key"), "r") as f:
+        with open(os.path.expanduser(path), "r") as f:
             api_key_json = json.load(f)
-            api_key = api_key_json.get("api_key")
-            api_secret = api_key_json.get("api_secret")
-            if api_key is None or api_secret is None:
-                logging.error("api_key or api_secret not found in ~/.config/poloniex-api-key")
-                api_key_file_error = True
+            key = api_key_json.get("api_key")
+            secret = api_key_json.get("api_secret")
+            if key is None or secret is None:
+                logging.error(f"api_key or api_secret not found in {path}")
+                return None
+            return key, secret
     except Exception as e:
         logging.error(f"Failed to read api_secret: {e}")
-        api_key_file_error = True
-    
-    if api_key_file_error:
-        logging.error("Please create json file ~/.config/poloniex-api-key with api_key and api_secret")
-        exit(1)
+        return None
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Poloniex Private WebSocket API to MQTT bridge")
+    parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
+    parser.add_argument("--loglevel", type=str, default="info", help="Set the logging level (debug, info, warning, error)")
+    parser.add_argument("--ws-url", type=str, default=ws_url, help="Poloniex private WebSocket URL")
+    parser.add_argument("--api-key-file", type=str, default=API_KEY_FILE, help="JSON file with api_key and api_secret")
+    parser.add_argument("--message-expiry", type=int, default=mqttpublisher.MESSAGE_EXPIRY, help="Seconds the broker may hold an undelivered tile (0 to disable)")
+    parser.add_argument("--snapshot", type=str, default=statesnapshot.default_path("poloprivate2mqtt"), help="File to keep the balance and last tile in across restarts")
+    parser.add_argument("--no-snapshot", action="store_true", help="Do not save or restore the snapshot")
+    parser.add_argument("--alerts", type=str, default=pricealerts.default_path(), help="JSON file of alert rules, reloaded when it changes (source: eq or upl)")
+    parser.add_argument("--no-alerts", action="store_true", help="Do not publish alerts")
+    parser.add_argument("--shm", type=str, nargs="?", const=tilering.default_path("poloprivate"), help="Also write raw BGRA tiles to a shared-memory tile ring (default path: /dev/shm/poloprivate.tiles)")
+    sampleprofiler.add_arguments(parser)
+    return parser
+
+def run(args, client=None):
+    """
+    WebSocket が閉じるまで動かす。client に接続済みのMQTTクライアントを渡すと
+    自前で接続せずにそれを使う(bridge-host から動かす場合)
+    """
+    global mqtt, tile_ring, api_key, api_secret, ws_url, message_expiry, snapshot, eq, upl, alerts
+    ws_url = args.ws_url
+    message_expiry = args.message_expiry
+    # read api_key and secret from ~/.config/poloniex-api-key (json)
+    keys = load_api_key(args.api_key_file)
+    if keys is None:
+        raise RuntimeError(f"Please create json file {args.api_key_file} with api_key and api_secret")
+    #else
+    api_key, api_secret = keys
+
+    if client is None:
+        # MQTTクライアント設定(遅延の追跡用のプロパティを送るため MQTT v5 で接続する)
+        client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5)
+        client.connect(args.mqtt)
+        client.loop_start() # run in a separate thread
+    mqtt = mqttpublisher.get_publisher(client) # ブローカーが詰まったら古い画像を捨てる
+    if args.shm is not None:
+        tile_ring = tilering.TileRingWriter(args.shm, CELL_WIDTH * CELL_HEIGHT * 4, max_tiles=1)
+    state = {}
+    if not args.no_snapshot:
+        # 前回の残高とタイルを読み戻し、次の account が届くのを待たずに配信する
+        snapshot = statesnapshot.Snapshotter(args.snapshot)
+        state, tiles = snapshot.restore()
+        eq, upl = state.get("eq"), state.get("upl")
+        statesnapshot.publish_tiles(mqtt, tiles, message_expiry)
+    if not args.no_alerts:
+        # アラートは捨てられると困るので、まとめたり捨てたりしない send で QoS 1 で送る。
+        # 配信したルールの id はスナップショットに残し、止まっている間に消されたルールの retain も消せるようにする
+        alerts = pricealerts.AlertEngine(args.alerts, mqtt.send, published=state.get("alerts", []),
+                                         on_published=None if snapshot is None else lambda ids: snapshot.update({"alerts": ids})).watch()
 
     # Create WebSocket client
     ws = websocket.WebSocketApp(ws_url,
@@ -196,4 +256,20 @@ if __name__ == "__main__":
                                 on_close=on_close)
     
     # Start WebSocket in a separate thread
-    ws.run_forever()
+    try:
+        ws.run_forever()
+    finally:
+        if snapshot is not None: snapshot.close()
+        if alerts is not None: alerts.close()
+
+if __name__ == "__main__":
+    # Argument parser
+    args = build_parser().parse_args()
+    # Set logging level
+    logging.basicConfig(level=args.loglevel.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    sampleprofiler.setup(args, "poloprivate2mqtt")
+    try:
+        run(args)
+    except RuntimeError as e:
+        logging.error(e)
+        exit(1)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# 価格や残高がしきい値をまたいだら alerts/<id> に配信する。
+#
+# ルールはJSONのファイルに書き、書き換えると再起動しなくても読み直す:
+#   [
+#       {"id": "xmr-400", "source": "XMR_USDT", "above": 400, "hysteresis": 5, "message": "XMR is over 400"},
+#       {"id": "upl-loss", "source": "upl", "below": -50, "hysteresis": 10}
+#   ]
+# source は polo2mqtt ならシンボル(XMR_USDT など)、poloprivate2mqtt なら eq / upl。
+# 発火したルールは、反対側に hysteresis だけ戻るまで再び発火しない(戻ったら "cleared" を配信する)。
+#
+# しきい値は source ごとに上向き・下向きにまたいだときの2つのソート済みの配列に入れておき、
+# 前回の値から今回の値までの間にあるものだけを二分探索で取り出すので、ルールが多くても1回の更新は
+# またいだルールの数 + O(log n) で済む。状態は retain で配信するので、表示側は後から接続しても今の状態がわかる。
+# 止まっている間に消されたルールの retain も消せるよう、配信したルールの id はブリッジのスナップショットに残しておく。
+import os,json,time,bisect,logging,threading
+
+RELOAD_INTERVAL = 2 # ルールのファイルが変わったかを調べる間隔(秒)
+
+def default_path():
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(config_home, "market-streamer", "alerts.json")
+
+def parse_rules(rules):
+    """ファイルの中身から {id: rule} を作る。おかしなルールは警告して飛ばす"""
+    parsed = {}
+    for rule in rules:
+        try:
+            rule_id, source = str(rule["id"]), str(rule["source"])
+            if not rule_id or any(c in rule_id for c in "/+#"):
+                raise ValueError("id must be a non-empty topic level")
+            if ("above" in rule) == ("below" in rule):
+                raise ValueError("exactly one of above or below is required")
+            #else
+            direction = "above" if "above" in rule else "below"
+            parsed[rule_id] = {
+                "id": rule_id, "source": source, "direction": direction,
+                "threshold": float(rule[direction]), "hysteresis": abs(float(rule.get("hysteresis", 0))),
+                "message": rule.get("message"),
+            }
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning(f"Ignoring alert rule {rule}: {e}")
+    return parsed
+
+class ThresholdIndex:
+    """1つの source のしきい値。上向き・下向きにまたいだときの (値, 種類, ルールid) をそれぞれ値の順に持つ"""
+    def __init__(self, rules):
+        up, down = [], []
+        for rule in rules:
+            if rule["direction"] == "above":
+                up.append((rule["threshold"], "fire", rule["id"]))
+                down.append((rule["threshold"] - rule["hysteresis"], "clear", rule["id"]))
+            else:
+                down.append((rule["threshold"], "fire", rule["id"]))
+                up.append((rule["threshold"] + rule["hysteresis"], "clear", rule["id"]))
+        up.sort()
+        down.sort()
+        self.up, self.up_levels = up, [level for level, _, _ in up]
+        self.down, self.down_levels = down, [level for level, _, _ in down]
+
+    def crossed(self, previous, value):
+        """previous から value に動いたときにまたいだもの(またいだ順)"""
+        if value > previous: # (previous, value] の上向きのしきい値
+            return self.up[bisect.bisect_right(self.up_levels, previous):bisect.bisect_right(self.up_levels, value)]
+        #else # [value, previous) の下向きのしきい値を上から
+        return self.down[bisect.bisect_left(self.down_levels, value):bisect.bisect_left(self.down_levels, previous)][::-1]
+
+class AlertEngine:
+    def __init__(self, path, publish, topic_prefix="alerts", published=(), on_published=None):
+        """
+        publish は paho の client.publish と同じ引数(topic, payload, qos, retain)を取る関数(CoalescingPublisher.send など)。
+        published は前回までに状態を配信したルールの id で、on_published はそれが変わるたびに id のリストを受け取る
+        """
+        self.path = path
+        self.publish = publish
+        self.topic_prefix = topic_prefix
+        self.lock = threading.Lock()
+        self.rules = {} # id -> rule
+        self.indexes = {} # source -> ThresholdIndex
+        self.firing = {} # id -> 発火中か。値を受け取ったことのある source のルールだけ
+        self.published = set(published) # 状態を配信した(retain が残っている)ルールの id
+        self.on_published = on_published
+        self.last = {} # source -> 前回の値
+        self.mtime = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def load(self):
+        """ルールのファイルを読み直す。読めなければ今のルールのままにする"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime: return
+        #else
+        self.mtime = mtime
+        if mtime is None:
+            logging.info(f"No alert rules ({self.path} does not exist)")
+            rules = {}
+        else:
+            try:
+                with open(self.path) as f:
+                    rules = parse_rules(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to read alert rules from {self.path}, keeping the current ones: {e}")
+                return
+            #else
+            logging.info(f"Loaded {len(rules)} alert rules from {self.path}")
+        self.set_rules(rules)
+
+    def set_rules(self, rules):
+        with self.lock:
+            by_source = {}
+            for rule in rules.values():
+                by_source.setdefault(rule["source"], []).append(rule)
+            self.indexes = {source: ThresholdIndex(source_rules) for source, source_rules in by_source.items()}
+            for rule_id in list(self.firing):
+                if self.rules.get(rule_id) != rules.get(rule_id):
+                    del self.firing[rule_id] # 消えたか変わったルールの状態は作り直す
+            removed = self.published - rules.keys()
+            for rule_id in removed:
+                self.publish(f"{self.topic_prefix}/{rule_id}", b"", qos=1, retain=True) # retain を消す
+                self.published.discard(rule_id)
+            if removed: self._published_changed()
+            self.rules = rules
+            # 値がわかっている source の新しいルールは、今の値で状態を決める
+            for rule in rules.values():
+                if rule["id"] not in self.firing and rule["source"] in self.last:
+                    self._initialize(rule, self.last[rule["source"]])
+
+    def update(self, source, value):
+        """source の新しい値を受け取り、またいだしきい値のルールだけを調べる"""
+        if value is None: return
+        #else
+        with self.lock:
+            previous = self.last.get(source)
+            self.last[source] = value
+            index = self.indexes.get(source)
+            if index is None: return
+            #else
+            if previous is None:
+                # 最初の値では前回がないので、その source のルールを全部今の値で決める
+                for rule in self.rules.values():
+                    if rule["source"] == source: self._initialize(rule, value)
+                return
+            #else
+            if value == previous: return
+            #else
+            for _, kind, rule_id in index.crossed(previous, value):
+                firing = kind == "fire"
+                if self.firing.get(rule_id) != firing:
+                    self.firing[rule_id] = firing
+                    self._publish(self.rules[rule_id], value)
+
+    def _initialize(self, rule, value):
+        self.firing[rule["id"]] = value >= rule["threshold"] if rule["direction"] == "above" else value <= rule["threshold"]
+        self._publish(rule, value)
+
+    def _publish(self, rule, value):
+        firing = self.firing[rule["id"]]
+        if firing: logging.info(f"Alert {rule['id']}: {rule['source']} {value} is {rule['direction']} {rule['threshold']}")
+        payload = {
+            "id": rule["id"], "source": rule["source"], "state": "firing" if firing else "cleared",
+            "value": value, "direction": rule["direction"], "threshold": rule["threshold"],
+            "message": rule["message"], "ts": int(time.time() * 1000),
+        }
+        self.publish(f"{self.topic_prefix}/{rule['id']}", json.dumps(payload), qos=1, retain=True)
+        if rule["id"] not in self.published:
+            self.published.add(rule["id"])
+            self._published_changed()
+
+    def _published_changed(self):
+        if self.on_published is not None: self.on_published(sorted(self.published))
+
+    def watch(self, interval=RELOAD_INTERVAL):
+        """ルールを読み、以後はファイルが変わるたびに別のスレッドで読み直す"""
+        self.load()
+        def run():
+            while not self.stopped.wait(interval):
+                self.load()
+        self.thread = threading.Thread(target=run, name="alert-rules", daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# ローソク足のストリームから、直近 window 本の統計(VWAP、実現ボラティリティ、SMA/EMA、高値・安値)を
+# 1回の更新あたり O(1) で求める。
+#
+# ストリームでは同じ足(startTime)の終値や出来高が何度も更新され、startTime が進むとその足が確定する。
+# 確定した足の分は累積和と単調キュー(monotonic deque)に入れておき、まだ確定していない足(live)の分は
+# 値を読むときにだけ足し合わせるので、同じ足の更新が何度来ても累積和をやり直す必要がない。
+import math,collections
+
+WINDOW = 144 # 10分足で24時間
+MA_PERIOD = 36 # SMA/EMA の期間(10分足で6時間)
+
+class MonotonicExtreme:
+    """窓の中の最大値(または最小値)を O(1)(償却)で求める単調キュー"""
+    def __init__(self, maximum=True):
+        self.maximum = maximum
+        self.items = collections.deque() # (index, value)。value は単調に減少(最小値なら増加)する
+
+    def push(self, index, value):
+        while self.items and (self.items[-1][1] <= value if self.maximum else self.items[-1][1] >= value):
+            self.items.pop()
+        self.items.append((index, value))
+
+    def evict(self, oldest_index):
+        """oldest_index より古い値を窓から外す"""
+        while self.items and self.items[0][0] < oldest_index:
+            self.items.popleft()
+
+    def value(self):
+        return self.items[0][1] if self.items else None
+
+class RollingStats:
+    def __init__(self, window=WINDOW, ma_period=MA_PERIOD):
+        self.window = window
+        self.ma_period = min(ma_period, window)
+        self.ema_alpha = 2 / (self.ma_period + 1)
+        self.reset()
+
+    def reset(self):
+        self.closed = collections.deque() # 確定した足: (close, quote_volume, base_volume)。窓の中の window - 1 本
+        self.closed_count = 0 # これまでに確定した足の数(単調キューの index)
+        self.returns = collections.deque() # 確定した足の間の対数収益率
+        self.live = None # 確定していない足: {"start", "close", "high", "low", "quote_volume", "base_volume"}
+        self.highs, self.lows = MonotonicExtreme(True), MonotonicExtreme(False)
+        self.ema = None # 確定した足までの EMA
+        self._resum()
+
+    def _resum(self):
+        """累積和を作り直す(足し引きを繰り返した誤差がたまらないよう、window 本ごとにも呼ぶ)"""
+        self.sum_quote = math.fsum(quote for _, quote, _ in self.closed)
+        self.sum_base = math.fsum(base for _, _, base in self.closed)
+        ma = list(self.closed)[-(self.ma_period - 1):] if self.ma_period > 1 else []
+        self.sum_ma = math.fsum(close for close, _, _ in ma)
+        self.sum_r2 = math.fsum(r * r for r in self.returns)
+
+    def seed(self, history):
+        """[[startTime, close], ...] の履歴から作り直す(出来高のない足として扱う)"""
+        self.reset()
+        for start_time, close in history:
+            self.update(start_time, close)
+
+    def update(self, start_time, close, high=None, low=None, quote_volume=None, base_volume=None):
+        """
+        足の更新を1つ取り込む。出来高は取引所が送ってくるその足の累計(USDT 建ての amount と XMR 建ての quantity)。
+        start_time が今の足より古い更新は無視して False を返す
+        """
+        high = close if high is None else high
+        low = close if low is None else low
+        if self.live is not None and start_time < self.live["start"]: return False
+        #else
+        if self.live is not None and start_time > self.live["start"]:
+            self._close_live()
+        self.live = {"start": start_time, "close": close, "high": high, "low": low,
+                     "quote_volume": quote_volume or 0.0, "base_volume": base_volume or 0.0}
+        return True
+
+    def _close_live(self):
+        live = self.live
+        if self.closed:
+            r = math.log(live["close"] / self.closed[-1][0])
+            self.returns.append(r)
+            self.sum_r2 += r * r
+        self.ema = live["close"] if self.ema is None else self.ema + self.ema_alpha * (live["close"] - self.ema)
+        self.closed.append((live["close"], live["quote_volume"], live["base_volume"]))
+        self.sum_quote += live["quote_volume"]
+        self.sum_base += live["base_volume"]
+        self.sum_ma += live["close"]
+        if len(self.closed) >= self.ma_period:
+            self.sum_ma -= self.closed[-self.ma_period][0] # deque は端からの添字なら O(1)
+        self.highs.push(self.closed_count, live["high"])
+        self.lows.push(self.closed_count, live["low"])
+        self.closed_count += 1
+
+        # 新しい足(live)の分を空けて window 本に収める
+        if len(self.closed) > self.window - 1:
+            close, quote, base = self.closed.popleft()
+            self.sum_quote -= quote
+            self.sum_base -= base
+            if len(self.returns) > self.window - 2:
+                r = self.returns.popleft()
+                self.sum_r2 -= r * r
+            self.highs.evict(self.closed_count - len(self.closed))
+            self.lows.evict(self.closed_count - len(self.closed))
+        if self.closed_count % self.window == 0:
+            self._resum()
+
+    def stats(self):
+        """今の統計を JSON にできる dict で返す。まだ足がなければ None"""
+        live = self.live
+        if live is None: return None
+        #else
+        close = live["close"]
+        count = len(self.closed) + 1
+        first = self.closed[0][0] if self.closed else close # 変化率の基準(窓の最初の足の終値)
+        high = max(live["high"], self.highs.value() if self.highs.value() is not None else live["high"])
+        low = min(live["low"], self.lows.value() if self.lows.value() is not None else live["low"])
+
+        base = self.sum_base + live["base_volume"]
+        vwap = (self.sum_quote + live["quote_volume"]) / base if base > 0 else None
+
+        # 収益率の二乗和(確定していない足の分も含む)の平方根を、窓の期間の実現ボラティリティとする
+        sum_r2, returns = self.sum_r2, len(self.returns)
+        if self.closed:
+            r = math.log(close / self.closed[-1][0])
+            sum_r2 += r * r
+            returns += 1
+        volatility = math.sqrt(max(sum_r2, 0.0)) * 100 if returns > 0 else None
+
+        ma_count = min(count, self.ma_period)
+        sma = (self.sum_ma + close) / ma_count
+        ema = close if self.ema is None else self.ema + self.ema_alpha * (close - self.ema)
+
+        return {
+            "start_time": live["start"],
+            "candles": count,
+            "close": close,
+            "change": (close - first) / first * 100 if first else None,
+            "high": high,
+            "low": low,
+            "vwap": vwap,
+            "volume": base,
+            "volatility": volatility,
+            "sma": sma,
+            "ema": ema,
+            "ma_period": self.ma_period,
+        }
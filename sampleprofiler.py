@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# 動いているブリッジを止めずに、どこで時間とメモリを使っているかを調べるためのプロファイラ
+#
+# 一定時間(window)の間、次のものを記録してファイルに書き出す:
+#   <prefix>.folded     : 全スレッドのスタックを interval ごとにサンプリングしたもの(collapsed stack 形式。
+#                         flamegraph.pl や speedscope で開ける)。待ち(recv や sleep)も含む壁時計のサンプル
+#   <prefix>.threads.txt: スレッドごとのCPU時間(WebSocket、ping、MQTT、描画のどれが重いか)
+#   <prefix>.memory.txt : tracemalloc で見た、window の間に増えたメモリの多い行
+#   <prefix>.tracemalloc: window の終わりの tracemalloc のスナップショット(tracemalloc.Snapshot.load で読める)
+#
+# --profile で起動直後から、または SIGUSR2 を送るたびに開始・停止する(kill -USR2 <pid>)。
+import os,sys,time,signal,logging,datetime,threading,tracemalloc,collections
+
+SAMPLE_INTERVAL = 0.01
+PROFILE_WINDOW = 60.0
+TRACEMALLOC_FRAMES = 25
+TOP_ALLOCATIONS = 30
+TOGGLE_SIGNAL = signal.SIGUSR2
+
+def default_dir():
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(state_home, "market-streamer", "profiles")
+
+def thread_cpu_times():
+    """{ident: (スレッド名, CPU秒)}。終了したスレッドや CPU 時計を取れないものは除く"""
+    times = {}
+    for thread in threading.enumerate():
+        try:
+            times[thread.ident] = (thread.name, time.clock_gettime(time.pthread_getcpuclockid(thread.ident)))
+        except (OSError, TypeError, AttributeError):
+            pass
+    return times
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Profiler:
+    def __init__(self, name, directory=None, window=PROFILE_WINDOW, interval=SAMPLE_INTERVAL):
+        self.name = name
+        self.directory = directory or default_dir()
+        self.window = window
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.running: return
+            #else
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """記録を止める(ファイルは記録していたスレッドが書き出す)"""
+        self.stop_event.set()
+
+    def toggle(self):
+        if self.running:
+            logging.info("Stopping profiler")
+            self.stop()
+        else:
+            logging.info(f"Starting profiler for up to {self.window:.0f}s")
+            self.start()
+
+    def install_signal(self, signum=TOGGLE_SIGNAL):
+        """signum で toggle するようにする。シグナルハンドラはメインスレッドでしか登録できない"""
+        if threading.current_thread() is not threading.main_thread():
+            logging.warning("Profiler signal handler can only be installed from the main thread")
+            return
+        #else
+        # ハンドラの中では重いことをせず、別のスレッドに任せる
+        signal.signal(signum, lambda signum, frame: threading.Thread(target=self.toggle, daemon=True).start())
+
+    def _run(self):
+        own_tracemalloc = not tracemalloc.is_tracing()
+        if own_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        memory_before = tracemalloc.take_snapshot()
+        cpu_before = thread_cpu_times()
+        stacks = collections.Counter()
+        names = {}
+        samples = 0
+        started = time.monotonic()
+        me = threading.get_ident()
+        deadline = started + self.window
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                #else
+                labels = []
+                while frame is not None:
+                    labels.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stacks[";".join([names.get(ident, str(ident))] + labels[::-1])] += 1
+            samples += 1
+            self.stop_event.wait(self.interval)
+        elapsed = time.monotonic() - started
+        cpu_after = thread_cpu_times()
+        memory_after = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+        if own_tracemalloc:
+            tracemalloc.stop()
+        try:
+            prefix = self._write(stacks, cpu_before, cpu_after, memory_before, memory_after, traced, peak, elapsed, samples)
+            logging.info(f"Profile of {elapsed:.1f}s ({samples} samples) written to {prefix}.*")
+        except OSError as e:
+            logging.error(f"Failed to write profile: {e}")
+
+    def _write(self, stacks, cpu_before, cpu_after, memory_before, memory_after, traced, peak, elapsed, samples):
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f"{self.name}-{datetime.datetime.now():%Y%m%d-%H%M%S}")
+        with open(f"{prefix}.folded", "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        rows = []
+        for ident, (name, cpu) in cpu_after.items():
+            rows.append((cpu - cpu_before.get(ident, (name, 0.0))[1], name))
+        rows.sort(reverse=True)
+        with open(f"{prefix}.threads.txt", "w") as f:
+            f.write(f"# {elapsed:.1f}s window, {samples} samples, CPU seconds per thread\n")
+            for cpu, name in rows:
+                f.write(f"{cpu:10.3f}s {cpu / elapsed * 100:6.1f}%  {name}\n")
+        busiest = ", ".join(f"{name} {cpu / elapsed * 100:.1f}%" for cpu, name in rows[:3])
+        logging.info(f"Busiest threads: {busiest}")
+
+        memory_after.dump(f"{prefix}.tracemalloc")
+        with open(f"{prefix}.memory.txt", "w") as f:
+            f.write(f"# traced memory at end: {traced / 1024 / 1024:.1f}MB (peak {peak / 1024 / 1024:.1f}MB), top {TOP_ALLOCATIONS} growth by line\n")
+            for stat in memory_after.compare_to(memory_before, "lineno")[:TOP_ALLOCATIONS]:
+                f.write(f"{stat}\n")
+        return prefix
+
+def add_arguments(parser):
+    parser.add_argument("--profile", action="store_true", help=f"Profile from startup for --profile-window seconds (send SIG{TOGGLE_SIGNAL.name[3:]} to toggle at any time)")
+    parser.add_argument("--profile-window", type=float, default=PROFILE_WINDOW, help="Seconds to record each profile")
+    parser.add_argument("--profile-dir", type=str, default=default_dir(), help="Directory to write profiles to")
+
+def setup(args, name):
+    """メインスレッドから呼ぶ。シグナルで切り替えられるようにし、--profile なら記録を始める"""
+    profiler = Profiler(name, args.profile_dir, args.profile_window)
+    profiler.install_signal()
+    if args.profile:
+        profiler.start()
+    return profiler
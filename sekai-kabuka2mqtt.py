@@ -1,31 +1,142 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import json,base64,subprocess,time,logging,tempfile
+import os,re,json,base64,subprocess,time,logging,tempfile,threading,functools,datetime,zoneinfo,collections,queue,zlib,contextlib
+import concurrent.futures
 import urllib.request
 import websocket # dev-python/websocket-client
 import cv2 # media-libs/opencv
 import numpy as np
 import paho.mqtt.client as mqtt_client # dev-python/paho-mqtt
+import tilering,framepacer,mqttpublisher,statesnapshot,sampleprofiler
 
 # コマンドIDを管理するためのカウンタ
 command_id = 0
+# send_command がコマンドの応答を待つ間に受信したイベントのうち、wait_for_event で待つもの。
+# (method, sessionId) ごとに持ち、Network.enable で大量に届くイベントに押し出されないようにする
+WAITED_EVENTS = {"Target.targetCreated", "Page.loadEventFired"}
+cdp_events = collections.defaultdict(lambda: collections.deque(maxlen=100))
 
-previous_screenshot_dow30 = None
-previous_screenshot_bitcoin = None
+# セルごとに最後に配信した画像と時刻
+last_published = {} # name -> (image, time)
 
 CHROME_WIDTH = 1920
 CHROME_HEIGHT = 1440
 CHROME_PORT = 9222
+CHROME_STARTUP_TIMEOUT = 30.0
+PAGE_LOAD_TIMEOUT = 60.0
 
 FPS = 2.0
+MIN_FPS = 0.2
+IDLE_BACKOFF = 1.25 # 変化がないフレームごとにキャプチャ間隔を何倍にするか
+ENCODE_WORKERS = 4
+
+# Chrome watchdog
+CDP_TIMEOUT = 10.0 # CDPコマンドの応答がこれ以上返らなければChromeがハングしたとみなす
+WATCHDOG_INTERVAL = 60.0 # メモリ使用量を調べる間隔(秒)
+MAX_JS_HEAP_MB = 512 # ページごとのJSヒープ上限。超えたらリロード
+MAX_RSS_MB = 3072 # Chromeのプロセスツリー全体のRSS上限。超えたら再起動
+SLOW_CAPTURE_SEC = 2.0
+SLOW_CAPTURE_COUNT = 10 # 連続してこの回数遅かったらリロード
+RELOAD_INTERVAL = 3600
+RESTART_BACKOFF = 5.0 # Chromeを起動し直せなかったときに次に試すまでの秒数(失敗するたびに倍にする)
+MAX_RESTART_BACKOFF = 300.0
+
+# 数値の読み取り
+GLYPH_WIDTH, GLYPH_HEIGHT = 12, 16 # テンプレートと比較する前に文字をこの大きさに揃える
+MIN_GLYPH_SCORE = 0.75 # これ未満の一致度しかない文字は読み取れなかったものとする
+GLYPH_NAMES = {"dot": ".", "comma": ",", "minus": "-", "plus": "+", "percent": "%"}
+
+# ステージごとの処理時間
+TIMING_WINDOW = 1000 # パーセンタイルを計算する直近のサンプル数
+TIMING_REPORT_INTERVAL = 300.0 # パーセンタイルをログに出す間隔(秒)
+
+class StageTimer:
+    """
+    キャプチャ、デコード、差分、エンコード、配信などのステージごとの処理時間を記録し、
+    直近 TIMING_WINDOW 件のパーセンタイルを定期的にログに出す。
+    trace_path を指定すると Chrome のトレースイベント形式(chrome://tracing や Perfetto で開ける)でも書き出す。
+    """
+    def __init__(self, window=TIMING_WINDOW, report_interval=TIMING_REPORT_INTERVAL, trace_path=None):
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.report_interval = report_interval
+        self.last_report = time.time()
+        self.trace = None
+        self.trace_separator = ""
+        self.traced_threads = set()
+        if trace_path is not None:
+            # 途中で終了しても読めるよう、イベントは1行ずつ追記する（閉じ括弧がなくてもビューアは読める）
+            self.trace = open(trace_path, "w", buffering=1)
+            self.trace.write("[")
+
+    @contextlib.contextmanager
+    def stage(self, name, frame=None, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.record(name, start, end, args)
+            if frame is not None:
+                frame[name] = frame.get(name, 0.0) + (end - start)
+
+    def record(self, name, start, end, args=None):
+        with self.lock:
+            self.samples[name].append(end - start)
+            if self.trace is not None:
+                thread = threading.current_thread()
+                if thread.native_id not in self.traced_threads:
+                    self.traced_threads.add(thread.native_id)
+                    self._write_trace({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread.native_id, "args": {"name": thread.name}})
+                self._write_trace({"name": name, "ph": "X", "pid": os.getpid(), "tid": thread.native_id,
+                                   "ts": start * 1e6, "dur": (end - start) * 1e6, "args": args or {}})
+
+    def _write_trace(self, event):
+        self.trace.write(self.trace_separator + "\n" + json.dumps(event))
+        self.trace_separator = ","
+
+    def percentiles(self, name):
+        with self.lock:
+            samples = sorted(self.samples[name])
+        if not samples: return None
+        #else
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))]
+        return percentile(0.5), percentile(0.9), percentile(0.99), samples[-1]
+
+    def end_frame(self, page_name, frame, interval):
+        """1フレーム分の処理時間がキャプチャ間隔を超えていたら内訳を警告する"""
+        elapsed = sum(frame.values())
+        if elapsed > interval:
+            breakdown = ", ".join(f"{name} {duration * 1000:.0f}ms" for name, duration in frame.items())
+            logging.warning(f"Frame of {page_name} took {elapsed * 1000:.0f}ms, longer than interval {interval * 1000:.0f}ms ({breakdown})")
+        now = time.time()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        with self.lock:
+            names = list(self.samples.keys())
+        for name in names:
+            p50, p90, p99, worst = self.percentiles(name)
+            logging.info(f"Stage {name}: p50 {p50 * 1000:.1f}ms, p90 {p90 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms, max {worst * 1000:.1f}ms")
+
+    def close(self):
+        with self.lock:
+            if self.trace is not None:
+                self.trace.write("\n]\n")
+                self.trace.close()
+                self.trace = None
+
+stage_timer = StageTimer()
 
 # ヘルパー関数：Chromeを指定ポートで起動
-def start_chrome(port, user_data_dir, width=CHROME_WIDTH, height=CHROME_HEIGHT, headless=True):
+def start_chrome(port, user_data_dir, width=CHROME_WIDTH, height=CHROME_HEIGHT, headless=True, incognito=True):
     cmdline = [
         "google-chrome-stable",
         "--no-first-run",
         "--no-default-browser-check",
-        "--incognito",
         f"--user-data-dir={user_data_dir}",
         f"--window-size={width},{height}",
         f"--remote-debugging-port={port}",
@@ -39,18 +150,44 @@ def start_chrome(port, user_data_dir, width=CHROME_WIDTH, height=CHROME_HEIGHT,
         "--hide-scrollbars",
         "--enable-unsafe-swiftshader"
     ]
+    if incognito:
+        # シークレットモードではディスクキャッシュが使われないので、プロファイルを残す場合は指定しない
+        cmdline.append("--incognito")
     if headless:
         cmdline.append("--headless")
     logging.debug(f"Starting Chrome with command: {' '.join(cmdline)}")
     process = subprocess.Popen(
-        cmdline
+        cmdline,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace"
     )
-    time.sleep(2)  # Chromeの起動を待つ
     return process
 
+# ヘルパー関数：Chromeが標準エラー出力に書く "DevTools listening on ws://..." からWebSocketデバッグURLを取得
+def wait_for_devtools(process, timeout=CHROME_STARTUP_TIMEOUT):
+    ws_urls = queue.Queue()
+    def read_stderr():
+        for line in process.stderr:
+            line = line.rstrip()
+            match = re.match(r"DevTools listening on (ws://\S+)", line)
+            if match:
+                ws_urls.put(match.group(1))
+            logging.debug(f"Chrome: {line}")
+        ws_urls.put(None) # Chromeが終了した
+    # 見つけた後もパイプが詰まらないよう読み続ける
+    threading.Thread(target=read_stderr, daemon=True).start()
+    try:
+        ws_url = ws_urls.get(timeout=timeout)
+    except queue.Empty:
+        ws_url = None
+    if ws_url is None:
+        raise Exception("Chrome did not start DevTools")
+    return ws_url
+
 # ヘルパー関数：WebSocketデバッグURLを取得
 def get_ws_url(port):
-    for i in range(10):
+    for i in range(100):
         try:
             url = f'http://localhost:{port}/json/version'
             logging.debug(f"Fetching WebSocket URL from {url}")
@@ -58,8 +195,8 @@ def get_ws_url(port):
                 data = json.loads(response.read())
                 return data['webSocketDebuggerUrl']
         except Exception as e:
-            logging.error(f"Error getting WebSocket URL: {e}")
-            time.sleep(1)
+            logging.debug(f"Error getting WebSocket URL: {e}")
+            time.sleep(0.1)
     raise Exception("Failed to get WebSocket URL")
 
 # ヘルパー関数：CDPコマンドを送信
@@ -83,10 +220,39 @@ def send_command(ws, method, params=None, session_id=None):
         elif "method" in response and response["method"] == "Inspector.detached":
             logging.info("Inspector detached")
             break
+        elif "method" in response:
+            buffer_event(response)
 
     command_id += 1
     return response
 
+def buffer_event(event):
+    if event["method"] in WAITED_EVENTS:
+        cdp_events[(event["method"], event.get("sessionId"))].append(event)
+
+# ヘルパー関数：session_id の method のイベント(match があればそれにも合うもの)を待つ
+def wait_for_event(ws, method, session_id=None, match=None, timeout=PAGE_LOAD_TIMEOUT):
+    def matches(event):
+        return event["method"] == method and event.get("sessionId") == session_id and (match is None or match(event))
+    # send_command 中に受信済みのイベントを先に調べる
+    buffered = cdp_events.get((method, session_id), ())
+    for event in list(buffered):
+        if matches(event):
+            buffered.remove(event)
+            return event
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            event = json.loads(ws.recv())
+        except websocket.WebSocketTimeoutException:
+            continue
+        if "method" not in event: continue
+        #else
+        if matches(event):
+            return event
+        buffer_event(event)
+    raise Exception("Timed out waiting for CDP event")
+
 # ヘルパー関数：ターゲットにアタッチしてセッションIDを取得
 def attach_to_target(ws, target_id):
     result = send_command(ws, "Target.attachToTarget", {
@@ -96,13 +262,12 @@ def attach_to_target(ws, target_id):
     return result["result"]["sessionId"]
 
 # ヘルパー関数：初期ターゲットを取得
-def get_initial_target(ws, port=CHROME_PORT):
-    with urllib.request.urlopen(f'http://localhost:{port}/json') as response:
-        targets = json.loads(response.read())
-        for target in targets:
-            if target["type"] == "page":
-                return target["id"]
-    raise Exception("No page target found")
+def get_initial_target(ws):
+    # 有効にすると既存のターゲットについても Target.targetCreated が届く
+    send_command(ws, "Target.setDiscoverTargets", {"discover": True})
+    event = wait_for_event(ws, "Target.targetCreated", match=lambda event: event["params"]["targetInfo"]["type"] == "page",
+                           timeout=CHROME_STARTUP_TIMEOUT)
+    return event["params"]["targetInfo"]["targetId"]
 
 def block_ad(ws, session_id):
     send_command(ws, "Network.setBlockedURLs", {
@@ -113,258 +278,878 @@ def block_ad(ws, session_id):
         ]
     }, session_id=session_id)
 
-def load_pages(ws, port, url1, url2):
-    # 初期ターゲットを取得
-    initial_target_id = get_initial_target(ws, port)
-    logging.info(f"Initial target ID: {initial_target_id}")
-    # 初期ターゲットにアタッチ
-    session_id = attach_to_target(ws, initial_target_id)
-    logging.info(f"Session ID: {session_id}")
-    # 初期ターゲットでPage, Networkを有効化
-    send_command(ws, "Page.enable", session_id=session_id)
-    send_command(ws, "Network.enable", session_id=session_id)
-
-    # 広告ブロック
-    #block_ad(ws, session_id)
-
-    # 初期ターゲットでURLをナビゲート
-    send_command(ws, "Page.navigate", {"url": url1}, session_id=session_id)
-
-    # ページの読み込みを待つ
-    logging.info("Waiting for the page to load...")
-    while True:
-        result = send_command(ws, "Page.getNavigationHistory", session_id=session_id)
-        if result.get("result", {}).get("currentIndex", 0) > 0:
-            break
-        time.sleep(0.5)
-    logging.info("Page loaded successfully.")
-
-    # 新しいウィンドウを作成
-    new_window = send_command(ws, "Target.createTarget", {
-        "url": "about:blank",
-        "newWindow": True
-    })
-    new_target_id = new_window["result"]["targetId"]
-
-    logging.info(f"New target ID: {new_target_id}")
-    # 新しいウィンドウにアタッチ
-    new_session_id = attach_to_target(ws, new_target_id)
-    logging.info(f"New session ID: {new_session_id}")
+def load_pages(ws, urls):
+    """urls を1つずつ別ウィンドウで同時に読み込み、それぞれのセッションIDを返す"""
+    session_ids = []
+    for url in urls:
+        if not session_ids:
+            # 最初のページは初期ターゲットを使う
+            target_id = get_initial_target(ws)
+        else:
+            # 新しいウィンドウを作成
+            new_window = send_command(ws, "Target.createTarget", {
+                "url": "about:blank",
+                "newWindow": True
+            })
+            target_id = new_window["result"]["targetId"]
+        logging.info(f"Target ID: {target_id}")
+        # ターゲットにアタッチ
+        session_id = attach_to_target(ws, target_id)
+        logging.info(f"Session ID: {session_id}")
+        # Page, Networkを有効化
+        send_command(ws, "Page.enable", session_id=session_id)
+        send_command(ws, "Network.enable", session_id=session_id)
+        send_command(ws, "Performance.enable", session_id=session_id)
 
-    # 新しいウィンドウでPage, Networkを有効化
-    send_command(ws, "Page.enable", session_id=new_session_id)
-    send_command(ws, "Network.enable", session_id=new_session_id)
+        # 広告ブロック
+        #block_ad(ws, session_id)
 
-    # 広告ブロック
-    #block_ad(ws, new_session_id)
+        # URLをナビゲート。読み込みの完了は待たずに次のページへ進む
+        send_command(ws, "Page.navigate", {"url": url}, session_id=session_id)
+        session_ids.append(session_id)
 
-    # 新しいウィンドウでURLをナビゲート
-    send_command(ws, "Page.navigate", {"url": url2}, session_id=new_session_id)
+    # 全ページの読み込みを待つ
+    logging.info("Waiting for the pages to load...")
+    for session_id in session_ids:
+        wait_for_event(ws, "Page.loadEventFired", session_id)
+    logging.info("Pages loaded successfully.")
+    return session_ids
 
-    # 新しいウィンドウのページ読み込みを待つ
-    logging.info("Waiting for the new tab to load...")
-    while True:
-        result = send_command(ws, "Page.getNavigationHistory", session_id=new_session_id)
-        if result.get("result", {}).get("currentIndex", 0) > 0:
-            break
-        time.sleep(0.5)
-    logging.info("New tab loaded successfully.")
-    return session_id, new_session_id
-
-def take_screenshot(ws, session_id, clip=None):
+def take_screenshot(ws, session_id, clip=None, frame=None):
     params = {
         "format": "png",
         "fromSurface": True
     }
     if clip:
         params["clip"] = clip
-    screenshot_result = send_command(ws, "Page.captureScreenshot", params, session_id=session_id)
-    return base64.b64decode(screenshot_result["result"]["data"])
+    with stage_timer.stage("capture", frame):
+        screenshot_result = send_command(ws, "Page.captureScreenshot", params, session_id=session_id)
+    if "result" not in screenshot_result:
+        raise Exception(f"Failed to capture screenshot: {screenshot_result.get('error', screenshot_result.get('method'))}")
+    with stage_timer.stage("base64", frame):
+        return base64.b64decode(screenshot_result["result"]["data"])
+
+def get_js_heap_size(ws, session_id):
+    result = send_command(ws, "Performance.getMetrics", session_id=session_id)
+    for metric in result.get("result", {}).get("metrics", []):
+        if metric["name"] == "JSHeapUsedSize":
+            return metric["value"]
+    return None
+
+def get_process_tree_rss(pid):
+    """/proc を調べて pid とその子孫プロセスのRSS合計(バイト)を返す"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit(): continue
+        #else
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm に空白や括弧が含まれることがあるので最後の ')' 以降を使う
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/statm", "r") as f:
+                total += int(f.read().split()[1]) * page_size
+        except OSError:
+            pass
+        stack.extend(children.get(current, []))
+    return total
+
+class ChromeWatchdog:
+    """
+    キャプチャ時間、ページごとのJSヒープ、Chrome全体のRSSを監視し、
+    ページのリロード("reload")またはChromeの再起動("restart")が必要かを判定する。
+    """
+    def __init__(self, max_js_heap_mb=MAX_JS_HEAP_MB, max_rss_mb=MAX_RSS_MB, slow_capture_sec=SLOW_CAPTURE_SEC,
+                 reload_interval=RELOAD_INTERVAL, interval=WATCHDOG_INTERVAL):
+        self.max_js_heap = max_js_heap_mb * 1024 * 1024
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.slow_capture_sec = slow_capture_sec
+        self.reload_interval = reload_interval
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        now = time.time()
+        self.last_sample = now
+        self.last_reload = now
+        self.slow_captures = 0
+        self.reloaded_for_resource = False
+
+    def record_capture(self, elapsed):
+        if elapsed > self.slow_capture_sec:
+            self.slow_captures += 1
+            logging.debug(f"Slow capture: {elapsed:.2f}s ({self.slow_captures} in a row)")
+        else:
+            self.slow_captures = 0
+
+    def _reload_or_restart(self, reason):
+        # リロードしても解消しなければ再起動する
+        if self.reloaded_for_resource:
+            logging.warning(f"{reason} persists after reload, restarting Chrome")
+            return "restart"
+        #else
+        logging.warning(f"{reason}, reloading pages")
+        self.reloaded_for_resource = True
+        self.last_reload = time.time()
+        return "reload"
 
-def process_screenshot(screenshot, coords, diff = None):
+    def check(self, chrome, ws, session_ids):
+        if chrome.poll() is not None:
+            logging.error(f"Chrome exited with code {chrome.returncode}")
+            return "restart"
+        if self.slow_captures >= SLOW_CAPTURE_COUNT:
+            self.slow_captures = 0
+            return self._reload_or_restart(f"{SLOW_CAPTURE_COUNT} slow captures in a row")
+        now = time.time()
+        if now - self.last_sample >= self.interval:
+            self.last_sample = now
+            rss = get_process_tree_rss(chrome.pid)
+            js_heaps = [get_js_heap_size(ws, session_id) for session_id in session_ids]
+            logging.debug(f"Chrome RSS: {rss / 1024 / 1024:.0f}MB, JS heap: {', '.join('%.0fMB' % (heap / 1024 / 1024) for heap in js_heaps if heap is not None)}")
+            if rss > self.max_rss:
+                logging.warning(f"Chrome RSS {rss / 1024 / 1024:.0f}MB exceeds {self.max_rss / 1024 / 1024:.0f}MB, restarting Chrome")
+                return "restart"
+            if any(heap is not None and heap > self.max_js_heap for heap in js_heaps):
+                return self._reload_or_restart("JS heap size exceeds limit")
+            self.reloaded_for_resource = False
+        if self.reload_interval > 0 and now - self.last_reload > self.reload_interval:
+            logging.info("Reloading pages...")
+            self.last_reload = now
+            return "reload"
+        return None
+
+class ChangePolicy:
+    """
+    セルを再配信するかどうかの判定基準。
+    min_delta: 画素値の差(チャンネルの最大値)がこれ以上の画素を変化とみなす
+    min_pixels: 変化した画素がこれ以上あれば再配信する
+    ignore: 判定から除外するセル内の矩形 [[x, y, width, height], ...]
+    min_interval: 再配信の最小間隔(秒)。間隔内の変化は捨てずに次の機会に配信する
+    """
+    def __init__(self, min_delta=1, min_pixels=1, ignore=(), min_interval=0.0):
+        self.min_delta = min_delta
+        self.min_pixels = min_pixels
+        self.ignore = [tuple(rect) for rect in ignore]
+        self.min_interval = min_interval
+        self.masks = {} # shape -> mask
+
+    def mask(self, shape):
+        if not self.ignore: return None
+        #else
+        if shape not in self.masks:
+            mask = np.ones(shape, dtype=bool)
+            for x, y, width, height in self.ignore:
+                mask[y:y+height, x:x+width] = False
+            self.masks[shape] = mask
+        return self.masks[shape]
+
+    def changed(self, previous, current):
+        diff = cv2.absdiff(previous, current)
+        if diff.ndim == 3:
+            diff = diff.max(axis=2)
+        changed_pixels = diff >= self.min_delta
+        mask = self.mask(changed_pixels.shape)
+        if mask is not None:
+            changed_pixels &= mask
+        return np.count_nonzero(changed_pixels) >= self.min_pixels
+
+DEFAULT_CHANGE_POLICY = ChangePolicy()
+
+def load_change_policies(path):
+    """
+    セルごとの ChangePolicy をJSONファイルから読み込む。形式:
+    {"*": {"min_delta": 16, "min_pixels": 4}, "date": {"ignore": [[0, 100, 187, 14]], "min_interval": 10}}
+    "*" は全セルの既定値で、個別の指定はそれを上書きする。
+    """
+    with open(path, "r") as f:
+        config = json.load(f)
+    defaults = config.pop("*", {})
+    policies = {name: ChangePolicy(**{**defaults, **policy}) for name, policy in config.items()}
+    policies["*"] = ChangePolicy(**defaults)
+    return policies
+
+def process_screenshot(screenshot, rois, policies=None, now=None):
+    """最後に配信した時から変化のあったセルの切り抜き画像を返す（エンコードは CellEncoder で行う）"""
     cells = {}
-    if diff is not None:
-        diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-    for name, (x, y, width, height) in coords.items():
-        if diff is not None:
-            roi = diff[y:y+height, x:x+width]
-            if np.sum(roi) == 0:
-                continue
+    now = now if now is not None else time.time()
+    for name, roi in rois:
         # crop the image
-        cropped_image = screenshot[y:y+height, x:x+width]
-        success, encoded_image = cv2.imencode('.png', cropped_image)
-        cells[name] = encoded_image.tobytes()
+        cropped_image = screenshot[roi]
+        policy = policies.get(name, policies["*"]) if policies else DEFAULT_CHANGE_POLICY
+        previous = last_published.get(name)
+        if previous is not None:
+            previous_image, previous_time = previous
+            if now - previous_time < policy.min_interval: continue
+            if not policy.changed(previous_image, cropped_image): continue
+        last_published[name] = (cropped_image.copy(), now)
+        cells[name] = cropped_image
     return cells
 
-def process_screenshot_dow30(screenshot, diff = None):
-    coords = {}
+def encode_cell(image):
+    success, encoded_image = cv2.imencode('.png', image)
+    if not success:
+        raise Exception("Failed to encode cell")
+    return encoded_image.tobytes()
 
-    origin_x, origin_y = 0, 0
-    width, height = 187, 154
-    x_gap = 8
-    x_gap2 = 9
-    y_gap_small = 1
-    y_gap_large = 27
+def binarize(image, dark_text=None):
+    """文字を白(255)、背景を黒(0)にした2値画像を返す。dark_text が None なら多い方を背景とみなす"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    if dark_text is None:
+        dark_text = np.count_nonzero(binary) > binary.size / 2
+    if dark_text:
+        binary = cv2.bitwise_not(binary)
+    return binary
 
-    x, y = origin_x, origin_y
-    x += width
-    coords["sunday_dow"] = (x, y, width, height)
-    y += height + y_gap_small
-    coords["nasdaq100_sunday"] = (x, y, width, height)
-    y += height + y_gap_small
-    coords["sp500_cfd"] = (x, y, width, height)
+def segment_glyphs(binary):
+    """2値画像を空白の列で区切って1文字ずつの画像を返す。上下は行全体の高さで切り出す"""
+    rows = np.flatnonzero(binary.any(axis=1))
+    if len(rows) == 0: return []
+    #else
+    line = binary[rows[0]:rows[-1] + 1]
+    columns = line.any(axis=0)
+    glyphs = []
+    start = None
+    for x, filled in enumerate(np.append(columns, False)):
+        if filled and start is None:
+            start = x
+        elif not filled and start is not None:
+            glyphs.append(line[:, start:x])
+            start = None
+    return glyphs
 
-    y += height + y_gap_large
-    coords["n225_cfd"] = (x, y, width, height)
+def glyph_features(glyph):
+    """
+    行の高さで切り出した文字画像から、文字の外接矩形を一定サイズにした画像と、
+    行に対する高さ・縦位置・縦横比を返す（"." "," "-" などを区別するため）
+    """
+    line_height = glyph.shape[0]
+    rows = np.flatnonzero(glyph.any(axis=1))
+    top, bottom = rows[0], rows[-1] + 1
+    box = glyph[top:bottom]
+    normalized = cv2.resize(box, (GLYPH_WIDTH, GLYPH_HEIGHT), interpolation=cv2.INTER_AREA).astype(np.float32)
+    return normalized, (bottom - top) / line_height, (top + bottom) / 2 / line_height, box.shape[1] / box.shape[0]
 
-    x, y, width, height = coords["sunday_dow"]
-    x += width + x_gap + width
-    coords["russel2000_cfd"] = (x, y, width, height)
-    y += height + y_gap_small
-    coords["vix"] = (x, y, width, height)
-    y += height + y_gap_small
-    coords["yield"] = (x, y, width, height)
+def glyph_similarity(a, b):
+    """正規化相互相関。どちらかが一様な画像(塗りつぶされた "-" など)なら平均値の近さで代用する"""
+    if a.std() == 0 or b.std() == 0:
+        return 1.0 - abs(float(a.mean()) - float(b.mean())) / 255
+    #else
+    return float(cv2.matchTemplate(a, b, cv2.TM_CCOEFF_NORMED)[0][0])
 
-    x += width + x_gap2
-    y += height + y_gap_large
-    coords["sunday_dollar"] = (x, y, width, height)
+def parse_number(text):
+    try:
+        return float(text.replace(",", "").rstrip("%"))
+    except ValueError:
+        return None
 
-    x += width + width + x_gap2
-    coords["gold_sunday"] = (x, y, width, height)
+class DigitRecognizer:
+    """
+    サイトの固定フォントの文字画像をテンプレートとして、セル内の数値をテンプレートマッチングで読み取る。
+    template_dir には 0.png〜9.png, dot.png, comma.png, minus.png, plus.png, percent.png
+    (同じ文字の別パターンは 0_2.png のように _ 以降を付ける) と、読み取る領域を示す regions.json を置く:
+    {"*": {"price": [x, y, width, height], "change": [x, y, width, height]}, "date": {}}
+    dump_glyphs を指定すると、読み取れなかった文字を template_dir/unlabeled/ に書き出すので
+    ファイル名を文字に変えてテンプレートにする。
+    """
+    def __init__(self, template_dir, min_score=MIN_GLYPH_SCORE, dump_glyphs=False):
+        self.min_score = min_score
+        self.dump_dir = os.path.join(template_dir, "unlabeled") if dump_glyphs else None
+        with open(os.path.join(template_dir, "regions.json"), "r") as f:
+            self.regions = json.load(f)
+        self.templates = []
+        for filename in sorted(os.listdir(template_dir)):
+            if not filename.endswith(".png"): continue
+            #else
+            label = filename[:-4].split("_")[0]
+            char = GLYPH_NAMES.get(label, label)
+            if len(char) != 1:
+                logging.warning(f"Ignoring glyph template with unknown name: {filename}")
+                continue
+            template = cv2.imread(os.path.join(template_dir, filename), cv2.IMREAD_GRAYSCALE)
+            # テンプレートは白地に黒文字で保存する
+            self.templates.append((char, glyph_features(binarize(template, dark_text=True))))
+        logging.info(f"Loaded {len(self.templates)} glyph templates")
+        if self.dump_dir is not None:
+            os.makedirs(self.dump_dir, exist_ok=True)
 
-    y += height + y_gap_small
-    coords["wti"] = (x, y, width, height)
+    def match(self, features):
+        normalized, height, center, aspect = features
+        best_char, best_score = None, self.min_score
+        for char, (template, template_height, template_center, template_aspect) in self.templates:
+            # 大きさ・位置・縦横比が大きく違うものは比較しない
+            if abs(height - template_height) > 0.3 or abs(center - template_center) > 0.3: continue
+            if not 0.5 < aspect / template_aspect < 2.0: continue
+            #else
+            score = glyph_similarity(normalized, template)
+            if score > best_score:
+                best_char, best_score = char, score
+        return best_char
 
-    x += width
-    coords["lng"] = (x, y, width, height)
+    def read(self, image):
+        text = ""
+        for glyph in segment_glyphs(binarize(image)):
+            char = self.match(glyph_features(glyph))
+            if char is None:
+                if self.dump_dir is not None:
+                    path = os.path.join(self.dump_dir, "%08x.png" % zlib.crc32(glyph.tobytes()))
+                    if not os.path.exists(path):
+                        cv2.imwrite(path, cv2.bitwise_not(glyph))
+                return None
+            text += char
+        return text
 
-    y += height + y_gap_small
-    coords["copper"] = (x, y, width, height)
+    def recognize(self, name, image):
+        """セル画像から regions.json の各領域の数値を読み取り、dictで返す。読み取れなければ None"""
+        regions = self.regions.get(name, self.regions.get("*"))
+        if not regions: return None
+        #else
+        value = {}
+        for field, (x, y, width, height) in regions.items():
+            text = self.read(image[y:y+height, x:x+width])
+            number = parse_number(text) if text else None
+            if number is None:
+                logging.debug(f"Could not read {field} of {name}: {text}")
+                return None
+            value[field] = number
+        return value
 
-    x, y, width, height = coords["russel2000_cfd"]
-    x += width + x_gap + width + width + x_gap2 + 1 + width + 1
-    coords["date"] = (x, y, width, 114) # exclude minutes bar
+def encode_and_recognize(name, image, recognizer=None):
+    with stage_timer.stage("encode", cell=name):
+        png = encode_cell(image)
+    value = None
+    if recognizer is not None:
+        with stage_timer.stage("recognize", cell=name):
+            value = recognizer.recognize(name, image)
+    return png, value
 
-    return process_screenshot(screenshot, coords, diff)
+class CellEncoder:
+    """
+    変化したセルのPNGエンコード(と recognizer があれば数値の読み取り)をスレッドプールで並列に行い、
+    終わったものから publish(name, png, value, trace) に渡す。trace は submit に渡した時刻(ミリ秒)に
+    エンコードし終えた時刻 render_ts を加えた dict。
+    同じセルの新しいフレームが来たら、エンコード待ち・エンコード中の古いフレームは捨てる。
+    ワーカーが終わる順番は前後するので、配信はロックの中で行い、配信済みより古いフレームは配信しない。
+    """
+    def __init__(self, publish, max_workers=ENCODE_WORKERS, recognizer=None):
+        self.publish = publish
+        self.recognizer = recognizer
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cell-encoder")
+        self.lock = threading.RLock()
+        self.pending = {} # name -> (seq, future)
+        self.published = {} # name -> 最後に配信したフレームの seq
+        self.seq = 0
+        self.dropped = 0
 
-def process_screenshot_bitcoin(screenshot, diff = None):
-    coords = {}
+    def submit(self, cells, trace=None):
+        with self.lock:
+            self.seq += 1
+            for name, image in cells.items():
+                previous = self.pending.get(name)
+                if previous is not None and previous[1].cancel():
+                    self.dropped += 1
+                    logging.debug(f"Dropped pending frame of {name}")
+                future = self.executor.submit(encode_and_recognize, name, image, self.recognizer)
+                self.pending[name] = (self.seq, future)
+                future.add_done_callback(functools.partial(self._on_encoded, name, self.seq, trace or {}))
 
-    origin_x, origin_y = 0, 0
-    width, height = 187, 154
-    x_gap = 8
-    x_gap2 = 9
-    y_gap_small = 1
-    y_gap_large = 27
+    def _on_encoded(self, name, seq, trace, future):
+        if future.cancelled(): return
+        #else
+        trace = dict(trace, render_ts=mqttpublisher.now_ms())
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error(f"Error encoding {name}: {e}")
+            return
+        #else
+        with self.lock:
+            current = self.pending.get(name)
+            if current is not None and current[0] == seq:
+                del self.pending[name]
+            elif current is not None and current[0] > seq or self.published.get(name, 0) > seq:
+                # より新しいフレームが来ている(か、もう配信した)ので捨てる
+                self.dropped += 1
+                logging.debug(f"Dropped stale frame of {name}")
+                return
+            #else
+            self.published[name] = seq
+            try:
+                with stage_timer.stage("publish", cell=name):
+                    self.publish(name, *result, trace)
+            except Exception as e:
+                logging.error(f"Error publishing {name}: {e}")
 
-    x, y = origin_x, origin_y
-    x += width + width + width
-    y += height + y_gap_small
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
-    coords["btcusd"] = (x, y, width, height)
+# キャプチャするページとセルの配置。--layout で同じ形式のJSONファイルを指定すると置き換えられる
+# clip はページ内のキャプチャ範囲、cells の座標は clip 内の [x, y, width, height]
+DEFAULT_LAYOUT = {
+    "pages": [
+        {
+            "name": "dow30",
+            "url": "https://sekai-kabuka.com/dow30.html",
+            "clip": [188, 185, 1530, 960],
+            "priority": 1.0,
+            "cells": {
+                "sunday_dow": [187, 0, 187, 154],
+                "nasdaq100_sunday": [187, 155, 187, 154],
+                "sp500_cfd": [187, 310, 187, 154],
+                "n225_cfd": [187, 491, 187, 154],
+                "russel2000_cfd": [569, 0, 187, 154],
+                "vix": [569, 155, 187, 154],
+                "yield": [569, 310, 187, 154],
+                "sunday_dollar": [765, 491, 187, 154],
+                "gold_sunday": [1148, 491, 187, 154],
+                "wti": [1148, 646, 187, 154],
+                "lng": [1335, 646, 187, 154],
+                "copper": [1335, 801, 187, 154],
+                "date": [1336, 0, 187, 114] # exclude minutes bar
+            }
+        },
+        {
+            "name": "bitcoin",
+            "url": "https://sekai-kabuka.com/bitcoin.html",
+            "clip": [193, 265, 800, 600],
+            "priority": 1.0,
+            "cells": {
+                "btcusd": [561, 155, 187, 154]
+            }
+        }
+    ]
+}
+
+class Page:
+    """レイアウトの1ページ分。セルの座標は切り抜き用のスライスにしておく"""
+    def __init__(self, name, url, clip, cells, priority=1.0):
+        self.name = name
+        self.url = url
+        clip_x, clip_y, clip_width, clip_height = clip
+        self.clip = {"x": clip_x, "y": clip_y, "width": clip_width, "height": clip_height, "scale": 1}
+        self.priority = priority
+        self.rois = []
+        for cell_name, (x, y, width, height) in cells.items():
+            if x < 0 or y < 0 or x + width > clip_width or y + height > clip_height:
+                raise ValueError(f"Cell {cell_name} is outside the clip of page {name}")
+            self.rois.append((cell_name, (slice(y, y + height), slice(x, x + width))))
+        self.session_id = None
+
+def compile_layout(layout):
+    pages = [Page(page["name"], page["url"], page["clip"], page["cells"], page.get("priority", 1.0)) for page in layout["pages"]]
+    cell_names = [name for page in pages for name, _ in page.rois]
+    duplicates = set(name for name in cell_names if cell_names.count(name) > 1)
+    if duplicates:
+        raise ValueError(f"Duplicate cell names in layout: {', '.join(sorted(duplicates))}")
+    return pages
+
+def load_layout(path):
+    with open(path, "r") as f:
+        return compile_layout(json.load(f))
+
+def write_cells_to_ring(tile_ring, cells):
+    for name, image in cells.items():
+        bgra = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA) if image.shape[2] == 3 else np.ascontiguousarray(image)
+        tile_ring.write(name, bgra, bgra.shape[1], bgra.shape[0], bgra.strides[0])
+
+def parse_hhmm(hhmm):
+    hour, minute = hhmm.split(":")
+    return int(hour) * 60 + int(minute)
+
+def load_trading_calendar(path):
+    """
+    セルごとの取引時間をJSONファイルから読み込む。形式:
+    {"n225_cfd": {"tz": "Asia/Tokyo", "sessions": [{"days": [0, 1, 2, 3, 4], "open": "08:00", "close": "06:00"}]}, ...}
+    days は月曜=0。close が open 以前の場合は翌日の close までとみなす。
+    sessions が空のセルは常に閉場扱いになり、その変化はキャプチャ頻度に影響しない。
+    """
+    with open(path, "r") as f:
+        calendar = json.load(f)
+    compiled = {}
+    for name, entry in calendar.items():
+        tz = zoneinfo.ZoneInfo(entry.get("tz", "UTC"))
+        sessions = []
+        for session in entry.get("sessions", []):
+            days = set(session.get("days", range(7)))
+            sessions.append((days, parse_hhmm(session.get("open", "00:00")), parse_hhmm(session.get("close", "24:00"))))
+        compiled[name] = (tz, sessions)
+    return compiled
+
+def is_market_open(calendar, name, now=None):
+    if calendar is None or name not in calendar: return True
+    #else
+    tz, sessions = calendar[name]
+    local = datetime.datetime.fromtimestamp(now if now is not None else time.time(), tz)
+    minutes = local.hour * 60 + local.minute
+    weekday = local.weekday()
+    for days, open_minutes, close_minutes in sessions:
+        if open_minutes < close_minutes:
+            if weekday in days and open_minutes <= minutes < close_minutes: return True
+        else:
+            # 日付をまたぐセッション
+            if weekday in days and minutes >= open_minutes: return True
+            if (weekday - 1) % 7 in days and minutes < close_minutes: return True
+    return False
+
+class AdaptiveRate:
+    """
+    セルの変化に応じてキャプチャ間隔を 1/max_fps〜1/min_fps の間で調整する。
+    取引時間中のセルが変化したら最速に戻し、変化がなければ IDLE_BACKOFF 倍ずつ間隔を延ばす。
+    """
+    def __init__(self, min_fps=MIN_FPS, max_fps=FPS, backoff=IDLE_BACKOFF, calendar=None):
+        self.min_interval = 1.0 / max_fps
+        self.max_interval = max(self.min_interval, 1.0 / min_fps)
+        self.backoff = backoff
+        self.calendar = calendar
+        self.interval = self.min_interval
+
+    def update(self, changed_cells, now=None):
+        active = [name for name in changed_cells if is_market_open(self.calendar, name, now)]
+        previous_interval = self.interval
+        if active:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        if self.interval == self.max_interval and previous_interval < self.max_interval:
+            logging.info(f"No activity, capture rate lowered to {1.0 / self.interval:.2f} fps")
+        elif active and previous_interval > self.min_interval:
+            logging.info(f"Activity detected on {', '.join(active)}, capture rate raised to {1.0 / self.interval:.2f} fps")
+        return self.interval
+
+    def reset(self):
+        self.interval = self.min_interval
 
-    return process_screenshot(screenshot, coords, diff)
+class CaptureScheduler:
+    """
+    1秒あたりのキャプチャ回数 budget を priority に比例して各ページに割り振り、
+    ページごとの AdaptiveRate で決まる時刻が最も早いページを次にキャプチャする。時刻は time.monotonic() の値
+    """
+    def __init__(self, pages, budget, min_fps=MIN_FPS, calendar=None):
+        self.pages = pages
+        total_priority = sum(page.priority for page in pages)
+        self.rates = {}
+        for page in pages:
+            share = budget * page.priority / total_priority
+            self.rates[page.name] = AdaptiveRate(min_fps=min(min_fps, share), max_fps=share, calendar=calendar)
+            logging.info(f"Page {page.name}: up to {share:.2f} captures per second")
+        self.reset()
+
+    def next(self):
+        """次にキャプチャするページとその時刻を返す"""
+        page = min(self.pages, key=lambda page: self.next_capture[page.name])
+        return page, self.next_capture[page.name]
+
+    def captured(self, page, changed_cells, start_time):
+        interval = self.rates[page.name].update(changed_cells)
+        self.next_capture[page.name] = start_time + interval
+
+    def reset(self):
+        for rate in self.rates.values():
+            rate.reset()
+        now = time.monotonic()
+        self.next_capture = {page.name: now for page in self.pages}
+
+def publish_cell(client, name, png, value=None, properties=None):
+    client.publish("sekai-kabuka/%s" % name, payload=png, properties=properties)
+    if value is not None:
+        client.publish("sekai-kabuka/%s/value" % name, payload=json.dumps(value), properties=properties)
+
+class CellCache:
+    """
+    セルごとに最後に配信したPNGと数値を持っておき、全セル再送要求にはキャプチャを待たずにそこから応える。
+    エンコーダのスレッドからの配信と paho のスレッドからの再送が入れ違って古い画像が後に届かないよう、
+    キャッシュの更新と配信は同じロックの中で行う。
+    再送にも最初の配信と同じプロパティ(時刻)を付け、受け取った側でセルがどれだけ古いか分かるようにする
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cells = {} # name -> (png, value, properties)
+
+    def publish(self, client, name, png, value=None, properties=None):
+        with self.lock:
+            self.cells[name] = (png, value, properties)
+            publish_cell(client, name, png, value, properties)
+
+    def republish(self, client):
+        with self.lock:
+            for name, (png, value, properties) in self.cells.items():
+                publish_cell(client, name, png, value, properties)
+            return len(self.cells)
+
+cell_cache = CellCache()
+
+def restore_cells(snapshot, publisher, names, message_expiry=mqttpublisher.MESSAGE_EXPIRY):
+    """前回のスナップショットのセルのうち names にあるものをキャッシュに戻して配信し、その数を返す"""
+    _, tiles = snapshot.restore()
+    count = 0
+    for name, (png, meta) in tiles.items():
+        if name not in names: continue
+        #else
+        properties = mqttpublisher.trace_properties(**meta.get("trace", {}), expiry=message_expiry)
+        cell_cache.publish(publisher, name, png, meta.get("value"), properties)
+        count += 1
+    return count
 
 def on_connect(client, userdata, flags, rc, properties):
     logging.info(f"Connected to MQTT broker with result code {rc}")
     client.subscribe("sekai-kabuka", qos=1)
 
 def on_message(client, userdata, message):
-    global previous_screenshot_dow30, previous_screenshot_bitcoin
     topic = message.topic
     logging.info(f"Received message: {topic}")
     if topic == "sekai-kabuka":
-        previous_screenshot_dow30 = None
-        previous_screenshot_bitcoin = None
-
-def main(mqtt_host, chrome_port, chrome_user_dir, save_images=False, fps=FPS, debug=False):
-    global previous_screenshot_dow30, previous_screenshot_bitcoin
+        # まだ一度もエンコードされていないセルは、最初のキャプチャで配信される
+        count = cell_cache.republish(mqttpublisher.get_publisher(client))
+        logging.info(f"Republished {count} cells from cache")
 
+def open_browser(chrome_port, chrome_user_dir, pages, debug=False, incognito=True):
     # create a new Chrome browser instance
-    chrome = start_chrome(chrome_port, chrome_user_dir, width=CHROME_WIDTH, height=CHROME_HEIGHT, headless=not debug)
+    chrome = start_chrome(chrome_port, chrome_user_dir, width=CHROME_WIDTH, height=CHROME_HEIGHT, headless=not debug, incognito=incognito)
     try:
-        ws_url = get_ws_url(chrome_port)
+        try:
+            ws_url = wait_for_devtools(chrome)
+        except Exception as e:
+            logging.warning(f"{e}, falling back to polling")
+            ws_url = get_ws_url(chrome_port)
+        ws = websocket.WebSocket(skip_utf8_validation=True)
+        ws.connect(ws_url)
+        ws.settimeout(CDP_TIMEOUT)
+        logging.info("Connected to WebSocket")
+        cdp_events.clear()
+
+        # ページを読み込む
+        session_ids = load_pages(ws, [page.url for page in pages])
+        for page, session_id in zip(pages, session_ids):
+            page.session_id = session_id
     except Exception as e:
-        logging.error(f"Error getting WebSocket URL: {e}")
-        chrome.terminate()
+        logging.error(f"Error opening browser: {e}")
+        close_browser(chrome)
         raise
+    logging.info("Browser opened")
+    return chrome, ws
 
-    ws = websocket.WebSocket(skip_utf8_validation=True)
-    ws.connect(ws_url)
+def reopen_browser(chrome_port, chrome_user_dir, pages, debug=False, incognito=True):
+    """
+    ウォッチドッグの再起動用。DevTools が応答しない、ポートがまだ使われているなどで起動できなければ、
+    間隔を伸ばしながら起動できるまで繰り返す(ブリッジごと落ちないように)
+    """
+    backoff = RESTART_BACKOFF
+    while True:
+        try:
+            return open_browser(chrome_port, chrome_user_dir, pages, debug, incognito)
+        except Exception as e:
+            logging.error(f"Failed to restart Chrome, retrying in {backoff:.0f}s: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_RESTART_BACKOFF)
 
-    logging.info("Connected to WebSocket")
+def close_browser(chrome, ws=None):
+    if ws is not None:
+        try:
+            ws.close()
+        except Exception as e:
+            logging.debug(f"Error closing WebSocket: {e}")
+    chrome.terminate()
+    try:
+        chrome.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        logging.warning("Chrome did not terminate, killing it")
+        chrome.kill()
+        chrome.wait()
 
-    # ページを読み込む
-    dow30, bitcoin = load_pages(ws, chrome_port, "https://sekai-kabuka.com/dow30.html", "https://sekai-kabuka.com/bitcoin.html")
-    logging.info("Browser opened")
+def main(mqtt_host, chrome_port, chrome_user_dir, save_images=False, fps=FPS, debug=False, encode_workers=ENCODE_WORKERS,
+         min_fps=MIN_FPS, calendar=None, watchdog=None, incognito=True, policies=None, recognizer=None,
+         pages=None, capture_budget=None, shm_path=None, mqtt=None, message_expiry=mqttpublisher.MESSAGE_EXPIRY,
+         snapshot_path=None):
+    """
+    mqtt に接続済みのクライアントを渡すと、自前で接続せずにそれを使う(bridge-host から動かす場合)。
+    snapshot_path を渡すと、前回のセルを読み戻して Chrome の起動を待たずに配信する
+    """
+    if pages is None:
+        pages = compile_layout(DEFAULT_LAYOUT)
+    if capture_budget is None:
+        capture_budget = fps * len(pages)
+    tile_ring = None
+    if shm_path is not None:
+        # タイルリングの名前の欄に入らないセルは、キャプチャを始めてから落ちないよう起動時に断る
+        long_names = [name for page in pages for name, _ in page.rois if len(name.encode("utf-8")) > tilering.NAME_SIZE]
+        if long_names:
+            raise ValueError(f"Cell names longer than {tilering.NAME_SIZE} bytes cannot go in the tile ring: {', '.join(long_names)}")
+        # 最も大きいセルが入る大きさのスロットを用意する
+        slot_size = max((roi[0].stop - roi[0].start) * (roi[1].stop - roi[1].start) * 4 for page in pages for _, roi in page.rois)
+        tile_ring = tilering.TileRingWriter(shm_path, slot_size, max_tiles=sum(len(page.rois) for page in pages))
+        logging.info(f"Writing raw cells to {shm_path}")
+
+    if watchdog is None:
+        watchdog = ChromeWatchdog()
 
-    mqtt = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2)
-    mqtt.on_connect = on_connect
-    mqtt.on_message = on_message
-    mqtt.connect(mqtt_host)
-    mqtt.loop_start()
+    own_mqtt = mqtt is None
+    if own_mqtt:
+        # 遅延の追跡用のプロパティを送るため MQTT v5 で接続する
+        mqtt = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5)
+        mqtt.on_connect = on_connect
+        mqtt.on_message = on_message
+        mqtt.connect(mqtt_host)
+        mqtt.loop_start()
+    else:
+        mqtt.message_callback_add("sekai-kabuka", on_message)
+        mqtt.subscribe("sekai-kabuka", qos=1)
+    # ブローカーが遅い・つながらない間は、セルごとに最新の画像だけを送信待ちにしておく
+    publisher = mqttpublisher.get_publisher(mqtt)
+    snapshot = None
+    if snapshot_path is not None:
+        snapshot = statesnapshot.Snapshotter(snapshot_path)
+        restore_cells(snapshot, publisher, {name for page in pages for name, _ in page.rois}, message_expiry)
 
-    last_reload_time = time.time()
+    def publish(name, cell, value=None, trace=None):
+        logging.debug(f"Publishing {name}")
+        # save the image to a file if debug
+        if save_images:
+            with open("%s.png" % name, "wb") as f:
+                f.write(cell)
+        # publish the image to MQTT.
+        properties = mqttpublisher.trace_properties(**(trace or {}), expiry=message_expiry)
+        cell_cache.publish(publisher, name, cell, value, properties)
+        if snapshot is not None:
+            snapshot.update(tiles={name: (cell, {"trace": trace or {}, "value": value})})
 
+    encoder = CellEncoder(publish, max_workers=encode_workers, recognizer=recognizer)
+    scheduler = CaptureScheduler(pages, capture_budget, min_fps=min_fps, calendar=calendar)
+    pacing = framepacer.JitterStats("capture")
+
+    chrome, ws = None, None
     try:
+        chrome, ws = open_browser(chrome_port, chrome_user_dir, pages, debug, incognito)
         while True:
-            start_time = time.time()
-            screenshot_png = take_screenshot(ws, dow30, clip={"x": 188, "y": 185, "width": 1530, "height": 960, "scale":1})
-            screenshot = cv2.imdecode(np.frombuffer(screenshot_png, np.uint8), cv2.IMREAD_UNCHANGED)
-            diff = cv2.absdiff(previous_screenshot_dow30, screenshot) if previous_screenshot_dow30 is not None else None
-            cells_dow30 = process_screenshot_dow30(screenshot, diff) if diff is not None else {}
-            previous_screenshot_dow30 = screenshot
-
-            screenshot_png = take_screenshot(ws, bitcoin, clip={"x": 193, "y": 265, "width": 800, "height": 600, "scale":1})
-            screenshot = cv2.imdecode(np.frombuffer(screenshot_png, np.uint8), cv2.IMREAD_UNCHANGED)
-            diff = cv2.absdiff(previous_screenshot_bitcoin, screenshot) if previous_screenshot_bitcoin is not None else None
-            cells_bitcoin = process_screenshot_bitcoin(screenshot, diff) if diff is not None else {}
-            previous_screenshot_bitcoin = screenshot
-
-            # merge the two dictionaries
-            cells = {**cells_dow30, **cells_bitcoin}
-
-            for name, cell in cells.items():
-                logging.debug(f"Publishing {name}")
-                # save the image to a file if debug
-                if save_images:
-                    with open("%s.png" % name, "wb") as f:
-                        f.write(cell)
-                # publish the image to MQTT.
-                mqtt.publish("sekai-kabuka/%s" % name, payload=cell)
-            
-            # reload the page if 1 hour have passed
-            if time.time() - last_reload_time > 3600:
-                logging.info("Reloading pages...")
-                send_command(ws, "Page.reload", session_id=dow30)
-                send_command(ws, "Page.reload", session_id=bitcoin)
-                last_reload_time = time.time()
-
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            if elapsed_time < 1.0 / fps:
-                time.sleep(1.0 / fps - elapsed_time)
+            page, capture_time = scheduler.next()
+            framepacer.sleep_until(capture_time)
+            pacing.record(time.monotonic() - capture_time)
+
+            start_time = time.monotonic()
+            frame = {}
+            try:
+                # ページに表示されている値の元の時刻は分からないので、キャプチャを始めた時刻をイベントの時刻とする
+                event_ts = mqttpublisher.now_ms()
+                screenshot_png = take_screenshot(ws, page.session_id, clip=page.clip, frame=frame)
+                watchdog.record_capture(time.monotonic() - start_time)
+                with stage_timer.stage("decode", frame, page=page.name):
+                    screenshot = cv2.imdecode(np.frombuffer(screenshot_png, np.uint8), cv2.IMREAD_UNCHANGED)
+                recv_ts = mqttpublisher.now_ms()
+                with stage_timer.stage("diff", frame, page=page.name):
+                    cells = process_screenshot(screenshot, page.rois, policies)
+                if tile_ring is not None:
+                    with stage_timer.stage("shm", frame, page=page.name):
+                        write_cells_to_ring(tile_ring, cells)
+                encoder.submit(cells, {"event_ts": event_ts, "recv_ts": recv_ts})
+                scheduler.captured(page, cells.keys(), start_time)
+                stage_timer.end_frame(page.name, frame, scheduler.rates[page.name].min_interval)
+
+                action = watchdog.check(chrome, ws, [loaded_page.session_id for loaded_page in pages])
+                if action == "reload":
+                    for loaded_page in pages:
+                        send_command(ws, "Page.reload", session_id=loaded_page.session_id)
+            except Exception as e:
+                # 応答なし(タイムアウト)、WebSocket切断、レンダラのクラッシュなど
+                logging.error(f"Capture failed (Chrome hung or crashed?): {e}")
+                action = "restart"
+
+            if action == "restart":
+                # 同じユーザーデータディレクトリでChromeを起動し直す
+                close_browser(chrome, ws)
+                chrome, ws = None, None
+                chrome, ws = reopen_browser(chrome_port, chrome_user_dir, pages, debug, incognito)
+                watchdog.reset()
+                scheduler.reset()
     except KeyboardInterrupt:
         logging.info("Exiting...")
     finally:
-        mqtt.loop_stop()
-        mqtt.disconnect()
-        logging.info("MQTT disconnected")
-        chrome.terminate()
-        logging.info("Browser closed")
+        encoder.shutdown()
+        stage_timer.close()
+        if tile_ring is not None: tile_ring.close()
+        if snapshot is not None: snapshot.close()
+        if own_mqtt:
+            mqtt.loop_stop()
+            mqtt.disconnect()
+            logging.info("MQTT disconnected")
+        else:
+            mqtt.unsubscribe("sekai-kabuka")
+            mqtt.message_callback_remove("sekai-kabuka")
+        if chrome is not None:
+            close_browser(chrome, ws)
+            logging.info("Browser closed")
 
-if __name__ == "__main__":
+def build_parser():
     import argparse
     parser = argparse.ArgumentParser(description="Kabuka Pakuri")
     parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker hostname")
     parser.add_argument("--chrome-port", type=int, default=CHROME_PORT, help="Chrome remote debugging port")
+    parser.add_argument("--user-data-dir", type=str, help="Keep Chrome profile (and its caches) in this directory across restarts")
     parser.add_argument("--save-images", action="store_true", help="Save images to disk")
-    parser.add_argument("--fps", type=float, default=FPS, help="Frames per second")
+    parser.add_argument("--layout", type=str, help="JSON file listing pages and their cells (see DEFAULT_LAYOUT)")
+    parser.add_argument("--dump-layout", action="store_true", help="Print the default layout as JSON and exit")
+    parser.add_argument("--fps", type=float, default=FPS, help="Frames per second per page (upper limit while cells are changing)")
+    parser.add_argument("--capture-budget", type=float, help="Total captures per second shared by all pages by priority (default: fps x pages)")
+    parser.add_argument("--min-fps", type=float, default=MIN_FPS, help="Lower limit of frames per second while no cell is changing")
+    parser.add_argument("--calendar", type=str, help="JSON file describing trading sessions per cell")
+    parser.add_argument("--cell-policy", type=str, help="JSON file with per-cell change thresholds, ignore masks and republish intervals")
+    parser.add_argument("--encode-workers", type=int, default=ENCODE_WORKERS, help="Number of threads encoding changed cells")
+    parser.add_argument("--max-js-heap", type=int, default=MAX_JS_HEAP_MB, help="Reload pages when JS heap of a page exceeds this size (MB)")
+    parser.add_argument("--max-rss", type=int, default=MAX_RSS_MB, help="Restart Chrome when its total RSS exceeds this size (MB)")
+    parser.add_argument("--slow-capture", type=float, default=SLOW_CAPTURE_SEC, help="Captures slower than this (seconds) count towards a reload")
+    parser.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL, help="Reload pages unconditionally at this interval (seconds, 0 to disable)")
+    parser.add_argument("--digit-templates", type=str, help="Directory with glyph templates and regions.json for reading values out of cells")
+    parser.add_argument("--dump-glyphs", action="store_true", help="Write unrecognized glyphs to <digit-templates>/unlabeled/")
+    parser.add_argument("--trace", type=str, help="Write per-stage timings to this file in Chrome trace event format")
+    parser.add_argument("--message-expiry", type=int, default=mqttpublisher.MESSAGE_EXPIRY, help="Seconds the broker may hold an undelivered cell (0 to disable)")
+    parser.add_argument("--shm", type=str, nargs="?", const=tilering.default_path("sekai-kabuka"), help="Also write raw BGRA cells to a shared-memory tile ring (default path: /dev/shm/sekai-kabuka.tiles)")
+    parser.add_argument("--snapshot", type=str, default=statesnapshot.default_path("sekai-kabuka2mqtt"), help="File to keep the last cells in across restarts")
+    parser.add_argument("--no-snapshot", action="store_true", help="Do not save or restore the snapshot")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
-    args = parser.parse_args()
+    sampleprofiler.add_arguments(parser)
+    return parser
+
+def run(args, mqtt=None):
+    """build_parser() の引数で動かす。mqtt は main() と同じ"""
+    global stage_timer
+    pages = load_layout(args.layout) if args.layout else compile_layout(DEFAULT_LAYOUT)
+    if args.trace:
+        stage_timer = StageTimer(trace_path=args.trace)
+
+    calendar = load_trading_calendar(args.calendar) if args.calendar else None
+    policies = load_change_policies(args.cell_policy) if args.cell_policy else None
+    recognizer = DigitRecognizer(args.digit_templates, dump_glyphs=args.dump_glyphs) if args.digit_templates else None
+    watchdog = ChromeWatchdog(max_js_heap_mb=args.max_js_heap, max_rss_mb=args.max_rss,
+                              slow_capture_sec=args.slow_capture, reload_interval=args.reload_interval)
+    snapshot_path = None if args.no_snapshot else args.snapshot
+
+    if args.user_data_dir:
+        os.makedirs(args.user_data_dir, exist_ok=True)
+        main(args.mqtt, args.chrome_port, args.user_data_dir, args.save_images, args.fps, args.debug, args.encode_workers,
+             args.min_fps, calendar, watchdog, incognito=False, policies=policies, recognizer=recognizer,
+             pages=pages, capture_budget=args.capture_budget, shm_path=args.shm, mqtt=mqtt,
+             message_expiry=args.message_expiry, snapshot_path=snapshot_path)
+    else:
+        with tempfile.TemporaryDirectory(prefix="chrome_debug_") as user_data_dir:
+            main(args.mqtt, args.chrome_port, user_data_dir, args.save_images, args.fps, args.debug, args.encode_workers,
+                 args.min_fps, calendar, watchdog, policies=policies, recognizer=recognizer,
+                 pages=pages, capture_budget=args.capture_budget, shm_path=args.shm, mqtt=mqtt,
+                 message_expiry=args.message_expiry, snapshot_path=snapshot_path)
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
                         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    with tempfile.TemporaryDirectory(prefix="chrome_debug_") as user_data_dir:
-        main(args.mqtt, args.chrome_port, user_data_dir, args.save_images, args.fps, args.debug)
-
+    if args.dump_layout:
+        print(json.dumps(DEFAULT_LAYOUT, indent=4))
+        exit(0)
+    sampleprofiler.setup(args, "sekai-kabuka2mqtt")
+    run(args)
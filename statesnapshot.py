@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# 再起動してもすぐにタイルを出せるよう、ブリッジのメモリ上の状態(価格の履歴、残高、最後に配信したタイル)を
+# ローカルのファイルに定期的に書き出し、起動時に読み戻す
+#
+# ファイルの構成:
+#   ヘッダ: magic(8) version(4) JSONの長さ(4)
+#   JSON  : {"saved": UNIX時刻, "state": {...}, "tiles": {名前: {"offset", "length", "meta"}}}
+#   データ: タイルのPNGを続けて並べたもの(offset はデータの先頭から)
+#
+# 書き込みは一時ファイルに書いてから置き換えるので、書いている途中で落ちても前回のファイルが残る。
+import os,json,time,struct,logging,threading
+import mqttpublisher
+
+MAGIC = b"SNAPSHOT"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+SNAPSHOT_INTERVAL = 10 # 変化があればこの間隔(秒)で書き出す
+
+def default_path(name):
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(state_home, "market-streamer", f"{name}.snapshot")
+
+def save(path, state, tiles):
+    """state (JSONにできる dict) と tiles ({名前: (png, meta)}) を path に書く"""
+    entries, blobs, offset = {}, [], 0
+    for name, (png, meta) in tiles.items():
+        entries[name] = {"offset": offset, "length": len(png), "meta": meta}
+        blobs.append(png)
+        offset += len(png)
+    header = json.dumps({"saved": time.time(), "state": state, "tiles": entries}, separators=(",", ":")).encode("utf-8")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+def load(path):
+    """(state, tiles, saved) を返す。ファイルがない・壊れている場合は ({}, {}, None)"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, header_length = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"not a snapshot (version {VERSION})")
+        #else
+        header = json.loads(data[HEADER.size:HEADER.size + header_length])
+        base = HEADER.size + header_length
+        tiles = {}
+        for name, entry in header["tiles"].items():
+            start = base + entry["offset"]
+            png = data[start:start + entry["length"]]
+            if len(png) != entry["length"]:
+                raise ValueError(f"tile {name} is truncated")
+            tiles[name] = (png, entry["meta"])
+        return header["state"], tiles, header["saved"]
+    except FileNotFoundError:
+        return {}, {}, None
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        logging.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return {}, {}, None
+
+class Snapshotter:
+    """update() で受け取った最新の状態を、変化があれば interval ごとに別のスレッドで書き出す"""
+    def __init__(self, path, interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.state = {}
+        self.tiles = {}
+        self.dirty = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="snapshot", daemon=True)
+        self.thread.start()
+
+    def restore(self):
+        """前回の (state, tiles) を読み、以後の書き出しの初期値にする"""
+        state, tiles, saved = load(self.path)
+        if saved is not None:
+            logging.info(f"Restored {len(state)} state entries and {len(tiles)} tiles from {self.path} (saved {time.time() - saved:.0f}s ago)")
+        with self.lock:
+            self.state = dict(state, **self.state)
+            self.tiles = dict(tiles, **self.tiles)
+        return state, tiles
+
+    def update(self, state=None, tiles=None):
+        """state のキーと tiles ({名前: (png, meta)}) の要素を置き換える。渡した値は後から書き換えないこと"""
+        with self.lock:
+            if state: self.state.update(state)
+            if tiles: self.tiles.update(tiles)
+            self.dirty = True
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty: return
+            #else
+            state, tiles = dict(self.state), dict(self.tiles)
+            self.dirty = False
+        try:
+            save(self.path, state, tiles)
+        except OSError as e:
+            logging.warning(f"Failed to write snapshot {self.path}: {e}")
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
+
+def publish_tiles(publisher, tiles, expiry=mqttpublisher.MESSAGE_EXPIRY):
+    """復元したタイル ({トピック: (png, meta)}) を、保存したときの時刻を付けて配信する"""
+    for topic, (png, meta) in tiles.items():
+        publisher.publish(topic, png, properties=mqttpublisher.trace_properties(**meta.get("trace", {}), expiry=expiry))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# 同じホスト上のコンシューマ向けに、タイル画像(BGRA)をMQTTを経由せず共有メモリで渡すためのリングバッファ
+#
+# ファイルの構成:
+#   ヘッダ  : magic(8) version(4) max_tiles(4) depth(4) slot_size(4) 予約(40)
+#   インデックス: max_tiles 個のエントリ
+#       name(32) seq(8) width(4) height(4) stride(4) slot(4) timestamp(8)
+#   データ  : タイルごとに depth 個のスロット(各 slot_size バイト)
+#
+# 書き込み側はタイルごとに次のスロットへ画素を書いてから、seq に書き換え中のビットを立てて
+# インデックスのエントリを更新し、最後に新しい seq を書く。読み込み側は書き換え中なら待ち、
+# 読み終わった後に seq を読み直して、読んでいる間に更新されていないことを確かめる。
+# 書き込み側がリングを一周するまでは、読み込み側は mmap 上のスロットをコピーせずに参照できる。
+import os,mmap,struct,time
+
+MAGIC = b"TILERING"
+VERSION = 1
+HEADER = struct.Struct("<8sIIII40x")
+NAME_SIZE = 32 # タイルの名前(UTF-8)の最大バイト数
+ENTRY = struct.Struct(f"<{NAME_SIZE}sQIIIId")
+ENTRY_SEQ = struct.Struct("<Q")
+ENTRY_SEQ_OFFSET = NAME_SIZE
+WRITING = 1 << 63 # インデックスのエントリを書き換え中の seq に立てるビット
+
+DEFAULT_MAX_TILES = 32
+DEFAULT_DEPTH = 3
+MAX_RETRIES = 100000 # 書き込み側が書き換え中のまま止まっている(落ちた)とみなすまでの読み直し回数
+
+def default_path(name):
+    return f"/dev/shm/{name}.tiles"
+
+class TileRingWriter:
+    def __init__(self, path, slot_size, max_tiles=DEFAULT_MAX_TILES, depth=DEFAULT_DEPTH):
+        self.path = path
+        self.slot_size = slot_size
+        self.max_tiles = max_tiles
+        self.depth = depth
+        self.index_offset = HEADER.size
+        self.data_offset = self.index_offset + ENTRY.size * max_tiles
+        size = self.data_offset + slot_size * depth * max_tiles
+        # 一時ファイルに作ってから置き換え、読み込み側が作りかけのファイルを開かないようにする
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, max_tiles, depth, slot_size)
+        os.replace(tmp_path, path)
+        self.tiles = {} # name -> (index, seq)
+
+    def write(self, name, data, width, height, stride):
+        """タイルを書き込み、その seq を返す。data は stride * height バイトのBGRA画素"""
+        length = stride * height
+        if length > self.slot_size:
+            raise ValueError(f"Tile {name} ({length} bytes) does not fit in a slot ({self.slot_size} bytes)")
+        if name not in self.tiles:
+            # struct は長い名前を黙って切り詰めるので、先頭が同じ名前のタイルを取り違えないよう断る
+            if len(name.encode("utf-8")) > NAME_SIZE:
+                raise ValueError(f"Tile name {name} is longer than {NAME_SIZE} bytes in UTF-8")
+            if len(self.tiles) >= self.max_tiles:
+                raise ValueError(f"Too many tiles (max {self.max_tiles})")
+            self.tiles[name] = (len(self.tiles), 0)
+        index, seq = self.tiles[name]
+        seq += 1
+        slot = seq % self.depth
+        offset = self.data_offset + (index * self.depth + slot) * self.slot_size
+        self.mm[offset:offset + length] = memoryview(data).cast("B")[:length]
+        entry_offset = self.index_offset + index * ENTRY.size
+        ENTRY_SEQ.pack_into(self.mm, entry_offset + ENTRY_SEQ_OFFSET, (seq - 1) | WRITING)
+        ENTRY.pack_into(self.mm, entry_offset, name.encode("utf-8"), (seq - 1) | WRITING, width, height, stride, slot, time.time())
+        ENTRY_SEQ.pack_into(self.mm, entry_offset + ENTRY_SEQ_OFFSET, seq)
+        self.tiles[name] = (index, seq)
+        return seq
+
+    def close(self):
+        self.mm.close()
+
+class TileRingReader:
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # 書き込み側は起動するたびにファイルを置き換えるので、開いたファイルを見分けられるようにしておく
+            self.inode = os.fstat(fd).st_ino
+            self.mm = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, version, self.max_tiles, self.depth, self.slot_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a tile ring (version {VERSION})")
+        self.index_offset = HEADER.size
+        self.data_offset = self.index_offset + ENTRY.size * self.max_tiles
+        self.view = memoryview(self.mm)
+
+    def _entry(self, index):
+        entry_offset = self.index_offset + index * ENTRY.size
+        for _ in range(MAX_RETRIES):
+            name, seq, width, height, stride, slot, timestamp = ENTRY.unpack_from(self.mm, entry_offset)
+            if seq & WRITING: continue
+            # 読んでいる間に書き換えられていたら読み直す
+            if ENTRY_SEQ.unpack_from(self.mm, entry_offset + ENTRY_SEQ_OFFSET)[0] == seq:
+                return name.rstrip(b"\0").decode("utf-8"), seq, width, height, stride, slot, timestamp
+        raise RuntimeError(f"Tile ring entry {index} is stuck in the middle of a write")
+
+    def index(self):
+        """書き込まれているタイルの {name: (index, seq)} を返す"""
+        tiles = {}
+        for index in range(self.max_tiles):
+            name, seq = self._entry(index)[:2]
+            if seq == 0: break
+            #else
+            tiles[name] = (index, seq)
+        return tiles
+
+    def read(self, index):
+        """
+        タイルの (seq, width, height, stride, timestamp, pixels) を返す。pixels は mmap を直接参照する
+        memoryview なので、使い終わったら is_valid で書き込み側に上書きされていないことを確かめる
+        """
+        name, seq, width, height, stride, slot, timestamp = self._entry(index)
+        if seq == 0: return None
+        #else
+        offset = self.data_offset + (index * self.depth + slot) * self.slot_size
+        return seq, width, height, stride, timestamp, self.view[offset:offset + stride * height]
+
+    def is_valid(self, index, seq):
+        """seq のスロットがまだ上書きされていなければ True"""
+        return self._entry(index)[1] - seq < self.depth - 1
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Show the index of a tile ring")
+    parser.add_argument("path", type=str, help="Tile ring file (e.g. /dev/shm/sekai-kabuka.tiles)")
+    args = parser.parse_args()
+    reader = TileRingReader(args.path)
+    for name, (index, seq) in reader.index().items():
+        seq, width, height, stride, timestamp, pixels = reader.read(index)
+        print(f"{name}: seq={seq} {width}x{height} stride={stride} age={time.time() - timestamp:.1f}s")
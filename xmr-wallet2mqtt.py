@@ -1,6 +1,7 @@
 #!/usr/bin/python3
-import logging,time,io,argparse
+import logging,io,argparse
 import requests,cairo
+import framepacer,mqttpublisher,statesnapshot,sampleprofiler
 import paho.mqtt.client as mqtt_client # dev-python/paho-mqtt
 
 from gi import require_version
@@ -16,6 +17,7 @@ CELL_WIDTH, CELL_HEIGHT = 187, 114
 
 DEFAULT_WALLET_RPC_URL = "http://localhost:18082/json_rpc"  # Monero wallet RPC URL
 DEFAULT_P2POOL_STATUS_URL = "http://xmr/local/stratum"  # p2pool status URL
+UPDATE_INTERVAL = 10
 
 def fetch_xmr_balance(url):
     """ウォレットを同期し、残高を確認"""
@@ -127,8 +129,8 @@ def fit_text_to_rect(text, font_family, rect_w_px, rect_h_px,
     layout.set_font_description(desc)
     return layout, best
 
-def draw(xmr_balance, xmr_unlocked_balance, p2pool_status):
-
+def render(xmr_balance, xmr_unlocked_balance, p2pool_status):
+    """残高とp2poolの状態のタイルを描いた surface を返す"""
     xmr_balance_str = "N/A"
     if xmr_balance is not None and xmr_unlocked_balance is not None:
         xmr_balance_str = f"{xmr_unlocked_balance:.4f}{'+' if xmr_balance > xmr_unlocked_balance else ''}XMR"
@@ -165,41 +167,84 @@ def draw(xmr_balance, xmr_unlocked_balance, p2pool_status):
 
     ctx.rectangle(0, 0, CELL_WIDTH, CELL_HEIGHT)
     ctx.stroke()
+    return surface
 
-    # return as PNG binary
+def encode_png(surface):
     buf = io.BytesIO()
     surface.write_to_png(buf)
     return buf.getvalue()
 
-def main(mqtt_host, wallet_rpc_url, p2pool_status_url):
-    mqtt = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2)
-    mqtt.connect(mqtt_host)
-    mqtt.loop_start()  # run in a separate thread
+def draw(xmr_balance, xmr_unlocked_balance, p2pool_status):
+    # return as PNG binary
+    return encode_png(render(xmr_balance, xmr_unlocked_balance, p2pool_status))
 
+def main(mqtt_host, wallet_rpc_url, p2pool_status_url, mqtt=None, interval=UPDATE_INTERVAL, message_expiry=mqttpublisher.MESSAGE_EXPIRY,
+         snapshot_path=None):
+    """
+    mqtt に接続済みのクライアントを渡すと、自前で接続せずにそれを使う(bridge-host から動かす場合)。
+    snapshot_path を渡すと、前回の残高とタイルを読み戻してウォレットの refresh を待たずに配信する
+    """
+    own_mqtt = mqtt is None
+    if own_mqtt:
+        # 遅延の追跡用のプロパティを送るため MQTT v5 で接続する
+        mqtt = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5)
+        mqtt.connect(mqtt_host)
+        mqtt.loop_start()  # run in a separate thread
+
+    publisher = mqttpublisher.get_publisher(mqtt)
     xmr_balance, xmr_unlocked_balance = None, None
+    snapshot = None
+    restored = False
+    if snapshot_path is not None:
+        snapshot = statesnapshot.Snapshotter(snapshot_path)
+        state, tiles = snapshot.restore()
+        xmr_balance, xmr_unlocked_balance = state.get("xmr_balance"), state.get("xmr_unlocked_balance")
+        restored = xmr_balance is not None
+        statesnapshot.publish_tiles(publisher, tiles, message_expiry)
+    pacer = framepacer.FramePacer(interval, framepacer.SKIP, name="xmr-wallet")
 
     try:
         while True:
-            xmr_balance, xmr_unlocked_balance = fetch_xmr_balance(wallet_rpc_url)
+            pacer.wait()
+            balance = fetch_xmr_balance(wallet_rpc_url)
+            # 起動直後にウォレットがまだ応答しなければ、一度取得できるまでは読み戻した残高を出す
+            if balance[0] is not None or not restored:
+                xmr_balance, xmr_unlocked_balance = balance
+                restored = False
             p2pool_status = fetch_p2pool_status(p2pool_status_url)
+            recv_ts = mqttpublisher.now_ms() # ウォレットの残高にはイベントの時刻がないので、取得し終えた時刻から
             png = draw(xmr_balance, xmr_unlocked_balance, p2pool_status)
-            mqtt.publish("xmr/balance", png)
-            time.sleep(10)
+            trace = {"recv_ts": recv_ts, "render_ts": mqttpublisher.now_ms()}
+            publisher.publish("xmr/balance", png, properties=mqttpublisher.trace_properties(**trace, expiry=message_expiry))
+            if snapshot is not None:
+                snapshot.update({"xmr_balance": xmr_balance, "xmr_unlocked_balance": xmr_unlocked_balance}, {"xmr/balance": (png, {"trace": trace})})
     finally:
-        mqtt.loop_stop()
-        mqtt.disconnect()
+        if snapshot is not None: snapshot.close()
+        if own_mqtt:
+            mqtt.loop_stop()
+            mqtt.disconnect()
 
-if __name__ == "__main__":
+def build_parser():
     import argparse
     parser = argparse.ArgumentParser(description="Market streamer")
     parser.add_argument("--mqtt", type=str, default="localhost", help="MQTT broker address")
     parser.add_argument("--wallet-rpc-url", type=str, default=DEFAULT_WALLET_RPC_URL, help="Monero wallet RPC URL")
     parser.add_argument("--p2pool-status-url", type=str, default=DEFAULT_P2POOL_STATUS_URL, help="p2pool status URL")
+    parser.add_argument("--interval", type=float, default=UPDATE_INTERVAL, help="Seconds between updates")
+    parser.add_argument("--message-expiry", type=int, default=mqttpublisher.MESSAGE_EXPIRY, help="Seconds the broker may hold an undelivered tile (0 to disable)")
+    parser.add_argument("--snapshot", type=str, default=statesnapshot.default_path("xmr-wallet2mqtt"), help="File to keep the balance and last tile in across restarts")
+    parser.add_argument("--no-snapshot", action="store_true", help="Do not save or restore the snapshot")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
-    args = parser.parse_args()
+    sampleprofiler.add_arguments(parser)
+    return parser
 
-    wallet_rpc_url = args.wallet_rpc_url
-    p2pool_status_url = args.p2pool_status_url
+def run(args, mqtt=None):
+    main(args.mqtt, args.wallet_rpc_url, args.p2pool_status_url, mqtt, args.interval, args.message_expiry,
+         None if args.no_snapshot else args.snapshot)
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    sampleprofiler.setup(args, "xmr-wallet2mqtt")
 
-    main(args.mqtt, wallet_rpc_url, p2pool_status_url)
+    run(args)